@@ -1,10 +1,9 @@
-import sqlite3
 from functools import wraps
-import inspect
-from safe_data import decrypt_data, private_key
-from log_config import logmanager as log_manager
-
-log_instance = log_manager()
+import os
+import threading
+import time
+import database
+from log_config import log_instance
 
 # Role hierarchy (higher number = more privileges)
 ROLE_RANK = {
@@ -13,55 +12,102 @@ ROLE_RANK = {
     'super_admin': 3
 }
 
+# Seconds a session trusts its cached role before reading it from the database again
+ROLE_CACHE_TTL = float(os.environ.get('UM_ROLE_CACHE_TTL', '300'))
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+class Session:
+    """A logged-in user, created by login(). Holds the user id and role that require_role checks."""
+
+    def __init__(self, username, user_id, role):
+        self.username = username
+        self.user_id = user_id
+        self.role = role
+        self.checked_at = time.monotonic()
+
+    def expired(self):
+        return time.monotonic() - self.checked_at > ROLE_CACHE_TTL
+
+
+def login(username, user_id, role):
+    """Start a session for a user who has just authenticated."""
+    session = Session(username, user_id, role)
+    with _sessions_lock:
+        _sessions[username] = session
+    return session
+
+
+def logout(username):
+    with _sessions_lock:
+        _sessions.pop(username, None)
+
+
+def invalidate(user_id=None):
+    """Make sessions re-read their role on the next check: of one user, or all with user_id None."""
+    with _sessions_lock:
+        for session in _sessions.values():
+            if user_id is None or session.user_id == user_id:
+                session.checked_at = float('-inf')
+
 
 def _role_rank(role_name: str) -> int:
     return ROLE_RANK.get(role_name, 0)
 
 
-def _get_role_for_username(username: str):
+def _lookup_role(username: str):
     # Hard-coded super admin
     if username == 'super_admin':
-        return 'super_admin'
-
-    conn = sqlite3.connect('scooterfleet.db')
-    cur = conn.cursor()
-    try:
-        cur.execute('SELECT id, username, role_level FROM Users')
-        rows = cur.fetchall()
-        for _id, enc_uname, role in rows:
-            try:
-                dec = decrypt_data(private_key(), enc_uname)
-            except Exception:
-                continue
-            if dec == username:
-                return role
-    finally:
-        conn.close()
-    return None
+        return None, 'super_admin'
+
+    row = database.find_user_by_username(username)
+    if row is None:
+        return None, None
+    return row[0], row[5]
+
+
+def _get_role_for_username(username: str):
+    session = _sessions.get(username)
+    if session is None:
+        # Not logged in through login() (scripts, maintenance): check the database every time
+        return _lookup_role(username)[1]
+    if session.expired():
+        user_id, role = _lookup_role(username)
+        if role is None or user_id != session.user_id:
+            # Deleted or renamed since login
+            logout(username)
+            return None
+        session.role = role
+        session.checked_at = time.monotonic()
+    return session.role
+
+
+def _username_position(f):
+    """Index of the `username` parameter among f's positional parameters (0 when it has none)."""
+    import inspect
+    positional = [name for name, param in inspect.signature(f).parameters.items()
+                  if param.kind in (param.POSITIONAL_ONLY, param.POSITIONAL_OR_KEYWORD)]
+    return positional.index('username') if 'username' in positional else 0
 
 
 def require_role(min_role: str):
     """Decorator to require at least min_role to call the function.
 
-    The decorated function must accept `username` as the first positional
-    argument or as a keyword argument named 'username'.
+    The decorated function must accept `username` as a positional or keyword argument;
+    functions without one get the first positional argument checked (legacy behavior).
     """
 
     def decorator(f):
-        sig = inspect.signature(f)
+        # Worked out once here instead of binding the signature on every call
+        position = _username_position(f)
 
         @wraps(f)
         def wrapper(*args, **kwargs):
-            # Try to get the username from bound arguments (supports positional or keyword args)
-            try:
-                bound = sig.bind_partial(*args, **kwargs)
-            except Exception:
-                bound = None
-
-            username = None
-            if bound:
-                username = bound.arguments.get('username')
-
+            username = kwargs.get('username')
+            if not username and len(args) > position:
+                username = args[position]
             # Fallback: if still missing, accept first positional argument as username (legacy behavior)
             if not username and len(args) > 0:
                 username = args[0]
@@ -1,5 +1,4 @@
 # System admin.
-import sqlite3
 
 from getpass import getpass
 import bcrypt
@@ -8,19 +7,19 @@ import time
 
 import um_members
 from super_admin import scooter_menu, service_engineer_menu, system_menu, traveller_menu, list_users
-from safe_data import private_key, decrypt_data
+import database
+from db_connection import get_connection
 from validation import validate_password
 
 # logging
-from log_config import logmanager as log_manager
-log_instance = log_manager()
+from log_config import log_instance
 
 def menu(username):
     while True:
         um_members.clear()
         print("\n--- System Admin Menu ---")
         print(f"--Welcome {username}--")
-        log_instance.show_notifications()
+        log_instance.show_notifications(username)
     #Own account
         print("1. Update password")
         print("2. List of users")
@@ -59,27 +58,15 @@ def menu(username):
             time.sleep(2)
 
 def update_password(username):
-    connection = sqlite3.connect("scooterfleet.db")
-    cursor = connection.cursor()
-
     um_members.clear()
     print("\n--- Update Password ---")
-    cursor.execute("SELECT * FROM Users")
-    user_data = cursor.fetchall()
-    decrypted_username = ""
-    found_password = ""
-    for i in range(len(user_data)):
-        decrypted_username = decrypt_data(private_key(), user_data[i][1])
-        if decrypted_username == username:
-            found_password = user_data[i][2]
-            break
+    user_row = database.find_user_by_username(username)
+    if user_row is None:
+        print("User not found")
+        log_instance.log_activity(username, "Update password", "Nonexistent service engineer tried to update password", "Yes")
+        exit()
+    found_password = user_row[2]
 
-        # check if have reached end of loop
-        if i == len(user_data) - 1:
-            print("User not found")
-            log_instance.log_activity(username, "Update password", "Nonexistent service engineer tried to update password", "Yes")
-            exit()
-            
     # Check if password is correct
     input_password = getpass("Enter your current password: ")
     if not bcrypt.checkpw(input_password.encode('utf-8'), found_password):
@@ -112,19 +99,7 @@ def update_password(username):
             else:
                 hashed_password = bcrypt.hashpw(new_password.encode('utf-8'), bcrypt.gensalt())
 
-                cursor.execute("SELECT * FROM Users")
-                user_data = cursor.fetchall()
-                decrypted_username = ""
-                for i in range(len(user_data)):
-                    decrypted_username = decrypt_data(private_key(), user_data[i][1])
-                    if decrypted_username == username:
-                        encrypted_username = user_data[i][1]
-                        break
-
-                cursor.execute("UPDATE Users SET password = ? WHERE username = ?", (hashed_password, encrypted_username))
-
-                connection.commit()
-                connection.close()
+                get_connection().execute("UPDATE Users SET password = ? WHERE id = ?", (hashed_password, user_row[0]))
                 um_members.clear()
                 print("Password updated successfully")
                 log_instance.log_activity(username, "Update password", f"Password updated successfully for user: '{username}'", "No")
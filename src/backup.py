@@ -0,0 +1,247 @@
+"""Database snapshots through the SQLite backup API, restores, and reading of older archives.
+
+New backups are made by backup_repo from snapshot(), which copies the live database in small
+steps so other connections keep working while it runs. restore_archive() restores a
+backup_repo manifest or an archive written by earlier versions: a full archive
+(`backup/full_<time>.zip`, a database copy plus the SHA-256 of every page), an incremental
+one (`backup/incr_<time>.zip`, the pages that differ from a full one), both with a
+`manifest.json` of member checksums, or an older `backup.sql` dump zip. Those formats are
+only read here anymore.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import struct
+import tempfile
+import zipfile
+
+import database
+import db_connection
+import row_cache
+from db_connection import get_connection
+
+BACKUP_DIR = 'backup'
+# Pages copied per backup step, and the pause between steps that lets writers in
+STEP_PAGES = int(os.environ.get('UM_BACKUP_STEP_PAGES', '256'))
+STEP_SLEEP = float(os.environ.get('UM_BACKUP_STEP_SLEEP', '0.005'))
+# Codec for backup_repo chunks: stored, deflate, bzip2 or lzma; the level applies to deflate (0-9) and bzip2 (1-9)
+CODECS = ('stored', 'deflate', 'bzip2', 'lzma')
+COMPRESSION = os.environ.get('UM_BACKUP_COMPRESSION', 'deflate')
+COMPRESSION_LEVEL = int(os.environ['UM_BACKUP_COMPRESSION_LEVEL']) if os.environ.get('UM_BACKUP_COMPRESSION_LEVEL') else None
+# Bytes read per step when streaming archive members
+CHUNK_SIZE = 1024 * 1024
+
+DATABASE_ENTRY = 'database.db'
+HASHES_ENTRY = 'database.pages'
+DELTA_ENTRY = 'database.delta'
+BASE_ENTRY = 'base.txt'
+LOG_PREFIX = 'logs/'
+MANIFEST_ENTRY = 'manifest.json'
+LEGACY_DUMP_ENTRY = 'backup.sql'
+
+DELTA_HEADER = struct.Struct('<8sIII32s')
+DELTA_MAGIC = b'UMDELTA1'
+PAGE_NUMBER = struct.Struct('<I')
+
+
+class BackupError(Exception):
+    pass
+
+
+def configure(compression=None, level=None, step_pages=None, step_sleep=None):
+    global COMPRESSION, COMPRESSION_LEVEL, STEP_PAGES, STEP_SLEEP
+    if compression is not None:
+        if compression not in CODECS:
+            raise ValueError(f"Unknown compression {compression!r}, expected one of {', '.join(CODECS)}")
+        COMPRESSION = compression
+    if level is not None:
+        COMPRESSION_LEVEL = int(level)
+    if step_pages is not None:
+        STEP_PAGES = max(1, int(step_pages))
+    if step_sleep is not None:
+        STEP_SLEEP = float(step_sleep)
+
+
+def snapshot(dest_path):
+    """Copy the live database to dest_path in steps of STEP_PAGES pages. Returns the page size."""
+    if os.path.exists(dest_path):
+        os.remove(dest_path)
+    target = sqlite3.connect(dest_path)
+    try:
+        get_connection().backup(target, pages=STEP_PAGES, sleep=STEP_SLEEP)
+        # A standalone file is easier to restore than one that needs its WAL
+        target.execute("PRAGMA journal_mode=DELETE")
+        page_size = target.execute("PRAGMA page_size").fetchone()[0]
+    finally:
+        target.close()
+    return page_size
+
+
+def stamp_key(name):
+    """Sort key for '<date>-<time>[-<n>].<ext>' names, so a second backup within a second sorts last."""
+    parts = name.rsplit('.', 1)[0].split('-')
+    return parts[0], parts[1] if len(parts) > 1 else '', int(parts[2]) if len(parts) > 2 and parts[2].isdigit() else 1
+
+
+def archives(kind=None):
+    """Archive paths, oldest first; kind is 'full', 'incr' or None for both."""
+    if not os.path.isdir(BACKUP_DIR):
+        return []
+    prefixes = ('full_', 'incr_') if kind is None else (kind + '_',)
+    names = [n for n in os.listdir(BACKUP_DIR) if n.endswith('.zip') and n.startswith(prefixes)]
+    return [os.path.join(BACKUP_DIR, n) for n in sorted(names, key=lambda n: stamp_key(n.split('_', 1)[1]))]
+
+
+def latest_archive():
+    found = archives()
+    return found[-1] if found else None
+
+
+def read_manifest(archive):
+    """The member checksums of an open archive, or None for archives written without a manifest."""
+    if MANIFEST_ENTRY not in archive.namelist():
+        return None
+    return json.loads(archive.read(MANIFEST_ENTRY))['members']
+
+
+def _apply_delta(db_path, delta, base_hashes):
+    """Write the pages of the delta stream (a file object) over the database file at db_path."""
+    with open(db_path, 'r+b') as db_file:
+        magic, page_size, page_count, changed, base_sha = DELTA_HEADER.unpack(delta.read(DELTA_HEADER.size))
+        if magic != DELTA_MAGIC:
+            raise BackupError("Not an incremental backup")
+        if base_sha != hashlib.sha256(base_hashes).digest():
+            raise BackupError("The incremental backup does not belong to this full backup")
+        for _ in range(changed):
+            (number,) = PAGE_NUMBER.unpack(delta.read(PAGE_NUMBER.size))
+            db_file.seek(number * page_size)
+            db_file.write(delta.read(page_size))
+        db_file.truncate(page_count * page_size)
+
+
+class _CheckedReader:
+    """Wraps an archive member so everything read from it is hashed, to compare with the manifest."""
+
+    def __init__(self, member):
+        self._member = member
+        self.digest = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self._member.read(size)
+        self.digest.update(data)
+        return data
+
+
+def _check(archive_path, manifest, name, reader):
+    if manifest is not None and manifest[name]['sha256'] != reader.digest.hexdigest():
+        raise BackupError(f"{archive_path}: {name} does not match its checksum")
+
+
+def extract_database(archive_path, dest_path):
+    """Rebuild the backed-up database file of an archive (full or incremental) at dest_path.
+
+    Members are streamed, never read whole, and checked against the manifest when there is one.
+    """
+    with zipfile.ZipFile(archive_path) as archive:
+        names = archive.namelist()
+        manifest = read_manifest(archive)
+        if DATABASE_ENTRY in names:
+            with archive.open(DATABASE_ENTRY) as member, open(dest_path, 'wb') as dest:
+                reader = _CheckedReader(member)
+                for chunk in iter(lambda: reader.read(CHUNK_SIZE), b''):
+                    dest.write(chunk)
+            _check(archive_path, manifest, DATABASE_ENTRY, reader)
+            return
+        if DELTA_ENTRY not in names:
+            raise BackupError(f"{archive_path} holds no database backup")
+        base = os.path.join(os.path.dirname(archive_path), archive.read(BASE_ENTRY).decode('utf-8').strip())
+        if not os.path.exists(base):
+            raise BackupError(f"The full backup {os.path.basename(base)} this increment is based on is missing")
+        extract_database(base, dest_path)
+        with zipfile.ZipFile(base) as base_zip:
+            base_hashes = base_zip.read(HASHES_ENTRY)
+        with archive.open(DELTA_ENTRY) as member:
+            reader = _CheckedReader(member)
+            _apply_delta(dest_path, reader, base_hashes)
+            # Read to the end so the checksum covers the whole member
+            while reader.read(CHUNK_SIZE):
+                pass
+        _check(archive_path, manifest, DELTA_ENTRY, reader)
+
+
+def _load_sql_dump(archive_path, db_path):
+    # Archives from before the backup API hold a backup.sql dump; it is replayed one statement at a time
+    target = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        with zipfile.ZipFile(archive_path) as archive, archive.open(LEGACY_DUMP_ENTRY) as member:
+            statement = ''
+            for raw in member:
+                statement += raw.decode('utf-8')
+                if sqlite3.complete_statement(statement):
+                    target.execute(statement)
+                    statement = ''
+    finally:
+        target.close()
+
+
+def prepare_restore(archive_path, dest_path):
+    """Build the database of an archive (or backup_repo manifest) at dest_path and check it; raises BackupError if it is unfit."""
+    import backup_repo
+    if backup_repo.is_manifest(archive_path):
+        backup_repo.extract_database(archive_path, dest_path)
+    elif is_archive(archive_path):
+        extract_database(archive_path, dest_path)
+    else:
+        _load_sql_dump(archive_path, dest_path)
+    check = sqlite3.connect(dest_path)
+    try:
+        if check.execute("PRAGMA integrity_check").fetchone()[0] != 'ok':
+            raise BackupError("The backed-up database is damaged")
+    finally:
+        check.close()
+
+
+def restore_archive(archive_path):
+    """Replace the contents of the live database with the database in the archive.
+
+    The database is rebuilt and checked in a temporary file first; until then the live
+    database stays untouched. It is then copied into the live database with the backup API
+    in one step, i.e. one write transaction, so other connections and processes (a
+    telemetry ingester, a second instance) see either the old or the restored data and
+    their WAL and shared memory stay valid.
+    """
+    live_path = os.path.abspath(db_connection.DB_PATH)
+    fd, temp_path = tempfile.mkstemp(prefix='.restore-', suffix='.db', dir=os.path.dirname(live_path))
+    os.close(fd)
+    try:
+        prepare_restore(archive_path, temp_path)
+        source = sqlite3.connect(temp_path, isolation_level=None)
+        try:
+            live = db_connection.get_connection()
+            # A WAL database can't change its page size, so the copy is brought to the live one
+            page_size = live.execute("PRAGMA page_size").fetchone()[0]
+            if source.execute("PRAGMA page_size").fetchone()[0] != page_size:
+                source.execute("PRAGMA journal_mode=DELETE")
+                source.execute(f"PRAGMA page_size={int(page_size)}")
+                source.execute("VACUUM")
+            source.backup(live)
+        finally:
+            source.close()
+    finally:
+        for leftover in (temp_path, temp_path + '-wal', temp_path + '-shm', temp_path + '-journal'):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+    database.create_or_connect_db()
+    row_cache.clear()
+
+
+def is_archive(path):
+    """True for archives made by this module, False for older SQL-dump zips."""
+    with zipfile.ZipFile(path) as archive:
+        names = archive.namelist()
+    if DATABASE_ENTRY in names or DELTA_ENTRY in names:
+        return True
+    if LEGACY_DUMP_ENTRY in names:
+        return False
+    raise BackupError(f"{path} holds no database backup")
@@ -0,0 +1,257 @@
+"""Deduplicated backup repository: files are stored as content-addressed chunks, backups as manifests.
+
+    backup/repo/chunks/<ab>/<sha256>      one chunk, a codec byte followed by the (compressed) data
+    backup/repo/manifests/<time>.json     one backup: for every file its size, SHA-256 and chunk list
+
+The database snapshot and the log files are cut into CHUNK_SIZE pieces named by the SHA-256
+of their content, so a piece that is already in the repository (an unchanged database page
+range, a rotated log, the start of the active log) is not stored again. prune() applies the
+retention policy to the manifests and then deletes the chunks no manifest refers to.
+"""
+import bz2
+import datetime
+import hashlib
+import json
+import lzma
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import zlib
+
+import backup
+from db_connection import get_connection
+
+CHUNK_SIZE = int(os.environ.get('UM_BACKUP_CHUNK_KB', '256')) * 1024
+# Retention: the newest backup of each of the last KEEP_DAILY days and of the last KEEP_WEEKLY weeks
+KEEP_DAILY = int(os.environ.get('UM_BACKUP_KEEP_DAILY', '7'))
+KEEP_WEEKLY = int(os.environ.get('UM_BACKUP_KEEP_WEEKLY', '4'))
+
+# backup.COMPRESSION name -> (codec byte stored in front of each chunk, module)
+CHUNK_CODECS = {'stored': (b'0', None), 'deflate': (b'z', zlib), 'bzip2': (b'b', bz2), 'lzma': (b'x', lzma)}
+_BY_BYTE = {byte: module for byte, module in CHUNK_CODECS.values()}
+
+MANIFEST_SUFFIX = '.json'
+
+_lock = threading.Lock()
+
+
+def configure(keep_daily=None, keep_weekly=None, chunk_kb=None):
+    global KEEP_DAILY, KEEP_WEEKLY, CHUNK_SIZE
+    if keep_daily is not None:
+        KEEP_DAILY = max(0, int(keep_daily))
+    if keep_weekly is not None:
+        KEEP_WEEKLY = max(0, int(keep_weekly))
+    if chunk_kb is not None:
+        CHUNK_SIZE = max(4, int(chunk_kb)) * 1024
+
+
+def repo_dir():
+    return os.path.join(backup.BACKUP_DIR, 'repo')
+
+
+def _chunks_dir():
+    return os.path.join(repo_dir(), 'chunks')
+
+
+def _manifests_dir():
+    return os.path.join(repo_dir(), 'manifests')
+
+
+def _chunk_path(digest):
+    return os.path.join(_chunks_dir(), digest[:2], digest)
+
+
+def _compress(data):
+    byte, module = CHUNK_CODECS[backup.COMPRESSION]
+    if module is None:
+        return byte + data
+    if module is lzma:
+        return byte + lzma.compress(data)
+    level = backup.COMPRESSION_LEVEL
+    return byte + module.compress(data, level if level is not None else (6 if module is zlib else 9))
+
+
+def _store_chunk(data, stats):
+    digest = hashlib.sha256(data).hexdigest()
+    path = _chunk_path(digest)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        stored = _compress(data)
+        with open(path + '.tmp', 'wb') as chunk_file:
+            chunk_file.write(stored)
+        os.replace(path + '.tmp', path)
+        stats['new_chunks'] += 1
+        stats['new_bytes'] += len(stored)
+    return digest
+
+
+def load_chunk(digest):
+    with open(_chunk_path(digest), 'rb') as chunk_file:
+        stored = chunk_file.read()
+    module = _BY_BYTE.get(stored[:1], False)
+    if module is False:
+        raise backup.BackupError(f"Chunk {digest} has an unknown codec")
+    data = stored[1:] if module is None else module.decompress(stored[1:])
+    if hashlib.sha256(data).hexdigest() != digest:
+        raise backup.BackupError(f"Chunk {digest} is damaged")
+    return data
+
+
+def _store_file(path, stats):
+    digest = hashlib.sha256()
+    chunks = []
+    size = 0
+    with open(path, 'rb') as source:
+        for data in iter(lambda: source.read(CHUNK_SIZE), b''):
+            chunks.append(_store_chunk(data, stats))
+            digest.update(data)
+            size += len(data)
+    stats['total_bytes'] += size
+    return {'size': size, 'sha256': digest.hexdigest(), 'chunks': chunks}
+
+
+def manifests():
+    """Manifest paths, oldest first."""
+    directory = _manifests_dir()
+    if not os.path.isdir(directory):
+        return []
+    names = [name for name in os.listdir(directory) if name.endswith(MANIFEST_SUFFIX)]
+    return [os.path.join(directory, name) for name in sorted(names, key=backup.stamp_key)]
+
+
+def latest_manifest():
+    found = manifests()
+    return found[-1] if found else None
+
+
+def is_manifest(path):
+    return path.endswith(MANIFEST_SUFFIX) and os.path.dirname(os.path.abspath(path)) == os.path.abspath(_manifests_dir())
+
+
+def read_manifest(path):
+    with open(path) as manifest_file:
+        return json.load(manifest_file)
+
+
+def _new_manifest_path():
+    os.makedirs(_manifests_dir(), exist_ok=True)
+    stamp = time.strftime('%Y%m%d-%H%M%S')
+    path = os.path.join(_manifests_dir(), stamp + MANIFEST_SUFFIX)
+    number = 1
+    while os.path.exists(path):
+        number += 1
+        path = os.path.join(_manifests_dir(), f'{stamp}-{number}{MANIFEST_SUFFIX}')
+    return path
+
+
+def create_backup(log_files=()):
+    """Store a snapshot of the database and log_files. Returns (manifest path, stats).
+
+    stats holds total_bytes (backed up), new_chunks and new_bytes (actually written).
+    """
+    stats = {'total_bytes': 0, 'new_chunks': 0, 'new_bytes': 0}
+    with _lock:
+        os.makedirs(repo_dir(), exist_ok=True)
+        files = {}
+        with tempfile.TemporaryDirectory(prefix='um-backup-', dir=repo_dir()) as work:
+            db_path = os.path.join(work, backup.DATABASE_ENTRY)
+            backup.snapshot(db_path)
+            files[backup.DATABASE_ENTRY] = _store_file(db_path, stats)
+        for log_file in log_files:
+            files[backup.LOG_PREFIX + os.path.basename(log_file)] = _store_file(log_file, stats)
+        path = _new_manifest_path()
+        with open(path + '.tmp', 'w') as manifest_file:
+            json.dump({'created': time.time(), 'files': files}, manifest_file)
+        os.replace(path + '.tmp', path)
+    return path, stats
+
+
+def extract_file(manifest_path, name, dest_path):
+    """Write one file of a backup to dest_path, checking every chunk and the whole file."""
+    entry = read_manifest(manifest_path)['files'].get(name)
+    if entry is None:
+        raise backup.BackupError(f"{os.path.basename(manifest_path)} holds no {name}")
+    digest = hashlib.sha256()
+    with open(dest_path, 'wb') as dest:
+        for chunk in entry['chunks']:
+            try:
+                data = load_chunk(chunk)
+            except FileNotFoundError:
+                raise backup.BackupError(f"Chunk {chunk} of {os.path.basename(manifest_path)} is missing")
+            dest.write(data)
+            digest.update(data)
+    if digest.hexdigest() != entry['sha256']:
+        raise backup.BackupError(f"{name} in {os.path.basename(manifest_path)} does not match its checksum")
+
+
+def extract_database(manifest_path, dest_path):
+    extract_file(manifest_path, backup.DATABASE_ENTRY, dest_path)
+
+
+def _protected():
+    # Backups linked to a restore code that has not been used yet are never pruned
+    try:
+        rows = get_connection().execute("SELECT backup_filename FROM RestoreCodes WHERE used = 0").fetchall()
+    except sqlite3.Error:
+        return set()
+    return {os.path.abspath(row[0]) for row in rows if row[0]}
+
+
+def _retained(found, keep_daily, keep_weekly):
+    keep = set(found[-1:])
+    days, weeks = set(), set()
+    created = {path: read_manifest(path)['created'] for path in found}
+    for path in sorted(found, key=created.get, reverse=True):
+        day = datetime.date.fromtimestamp(created[path])
+        week = day.isocalendar()[:2]
+        if day not in days and len(days) < keep_daily:
+            days.add(day)
+            keep.add(path)
+        if week not in weeks and len(weeks) < keep_weekly:
+            weeks.add(week)
+            keep.add(path)
+    return keep
+
+
+def prune(keep_daily=None, keep_weekly=None):
+    """Delete the backups outside the retention policy, then the chunks nothing refers to anymore.
+
+    Returns (manifests removed, chunks removed, bytes freed).
+    """
+    keep_daily = KEEP_DAILY if keep_daily is None else keep_daily
+    keep_weekly = KEEP_WEEKLY if keep_weekly is None else keep_weekly
+    with _lock:
+        found = manifests()
+        keep = _retained(found, keep_daily, keep_weekly)
+        protected = _protected()
+        removed_manifests = 0
+        for path in found:
+            if path not in keep and os.path.abspath(path) not in protected:
+                os.remove(path)
+                removed_manifests += 1
+
+        referenced = set()
+        for path in manifests():
+            for entry in read_manifest(path)['files'].values():
+                referenced.update(entry['chunks'])
+        removed_chunks = freed = 0
+        chunks_dir = _chunks_dir()
+        if os.path.isdir(chunks_dir):
+            for prefix in os.listdir(chunks_dir):
+                for name in os.listdir(os.path.join(chunks_dir, prefix)):
+                    if name not in referenced:
+                        chunk_path = os.path.join(chunks_dir, prefix, name)
+                        freed += os.path.getsize(chunk_path)
+                        os.remove(chunk_path)
+                        removed_chunks += 1
+    return removed_manifests, removed_chunks, freed
+
+
+def disk_usage():
+    """Bytes used by the chunks of the repository."""
+    chunks_dir = _chunks_dir()
+    if not os.path.isdir(chunks_dir):
+        return 0
+    return sum(entry.stat().st_size for prefix in os.scandir(chunks_dir) for entry in os.scandir(prefix.path))
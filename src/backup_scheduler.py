@@ -0,0 +1,204 @@
+"""Backups in a background thread: on a timer, or started from the system menu without waiting.
+
+Every INTERVAL seconds the scheduler makes a backup_repo backup, unless nothing was written
+to the database since the last one (PRAGMA data_version of the scheduler's own connection,
+or for the first check after a start, the file times against the last backup); after a failed
+backup the next check tries again whether or not anything was written. One job runs
+at a time, and restores wait for it through exclusive(). The outcome of the last job is kept
+in backup/schedule.json, so status() also covers runs of earlier sessions.
+"""
+import datetime
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import db_connection
+from db_connection import get_connection
+from log_config import log_instance
+
+# Seconds between scheduled backups; 0 turns the schedule off (menu backups still run in the background)
+INTERVAL = int(os.environ.get('UM_BACKUP_INTERVAL', str(24 * 3600)))
+LOG_DAYS = 30
+
+_job_lock = threading.Lock()
+_state_lock = threading.Lock()
+_stop = threading.Event()
+_wake = threading.Event()
+_thread = None
+_running = None
+_last_version = None
+
+
+def configure(interval=None):
+    global INTERVAL
+    if interval is not None:
+        INTERVAL = max(0, int(interval))
+        _wake.set()
+
+
+def _status_path():
+    import backup
+    return os.path.join(backup.BACKUP_DIR, 'schedule.json')
+
+
+def _read_status():
+    try:
+        with open(_status_path()) as status_file:
+            return json.load(status_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_status(status):
+    os.makedirs(os.path.dirname(_status_path()), exist_ok=True)
+    with open(_status_path() + '.tmp', 'w') as status_file:
+        json.dump(status, status_file)
+    os.replace(_status_path() + '.tmp', _status_path())
+
+
+def recent_log_files(log_dir, days=LOG_DAYS):
+    """Log files in log_dir modified in the last days days."""
+    if not os.path.isdir(log_dir):
+        return []
+    since = datetime.date.today() - datetime.timedelta(days=days)
+    log_files = []
+    for filename in os.listdir(log_dir):
+        filepath = os.path.join(log_dir, filename)
+        if os.path.isfile(filepath) and datetime.date.fromtimestamp(os.path.getmtime(filepath)) >= since:
+            log_files.append(filepath)
+    return log_files
+
+
+def _changed_since_last_backup():
+    """(changed, data_version). The caller records the version once the backup has been made."""
+    version = get_connection().execute("PRAGMA data_version").fetchone()[0]
+    if _last_version is not None:
+        return version != _last_version, version
+    # data_version only compares against this connection's previous reading, so the first
+    # check after a start looks at the files instead
+    last_run = _read_status().get('last_run')
+    if last_run is None:
+        return True, version
+    db_path = db_connection.DB_PATH
+    times = [os.path.getmtime(path) for path in (db_path, db_path + '-wal') if os.path.exists(path)]
+    return not times or max(times) > last_run, version
+
+
+@contextmanager
+def exclusive():
+    """Hold off backup jobs for the duration of the block (a restore, for one)."""
+    with _job_lock:
+        yield
+
+
+def run_now(trigger='manual'):
+    """Make a backup on this thread, waiting for a running job first. Returns (manifest path, stats)."""
+    global _running
+    # The backup modules (zipfile, lzma, ...) are loaded by the first job, not at startup
+    import backup_repo
+    with _job_lock:
+        with _state_lock:
+            _running = {'trigger': trigger, 'started': time.time()}
+        started = time.time()
+        status = _read_status()
+        try:
+            log_instance.flush()
+            manifest_path, stats = backup_repo.create_backup(recent_log_files(log_instance.log_dir))
+            backup_repo.prune()
+        except Exception as e:
+            status.update(last_error=str(e), last_error_at=started)
+            _write_status(status)
+            raise
+        finally:
+            with _state_lock:
+                _running = None
+        status.update(last_run=started, duration=time.time() - started, trigger=trigger, manifest=manifest_path,
+                      total_bytes=stats['total_bytes'], new_bytes=stats['new_bytes'], last_error=None)
+        _write_status(status)
+    return manifest_path, stats
+
+
+def start_backup(trigger='manual'):
+    """Run a backup on a background thread. Returns False if a job is running already."""
+    if _job_lock.locked():
+        return False
+
+    def job():
+        try:
+            run_now(trigger)
+            log_instance.log_activity("System", "Backup created", trigger, "No")
+        except Exception as e:
+            log_instance.log_activity("System", "Backup failed", str(e), "No")
+
+    threading.Thread(target=job, name='backup-job', daemon=True).start()
+    return True
+
+
+def _last_check(saved):
+    # A skipped or failed run counts as a check, so the next one comes an interval later
+    return max(saved.get('last_run') or 0, saved.get('skipped_at') or 0, saved.get('last_error_at') or 0)
+
+
+def _sleep_time():
+    if INTERVAL <= 0:
+        return 3600
+    return max(1.0, _last_check(_read_status()) + INTERVAL - time.time())
+
+
+def _tick():
+    """One scheduled check: a backup if the database changed since the last successful one."""
+    global _last_version
+    changed, version = _changed_since_last_backup()
+    if changed:
+        try:
+            run_now('scheduled')
+        except Exception as e:
+            # _last_version stays behind, so the next check tries again
+            log_instance.log_activity("System", "Backup failed", str(e), "No")
+            return
+        _last_version = version
+        log_instance.log_activity("System", "Backup created", "scheduled", "No")
+    else:
+        _last_version = version
+        saved = _read_status()
+        saved['skipped_at'] = time.time()
+        _write_status(saved)
+
+
+def _schedule_loop():
+    while not _stop.is_set():
+        if INTERVAL > 0 and _sleep_time() <= 1.0 and not _job_lock.locked():
+            _tick()
+        _wake.wait(_sleep_time())
+        _wake.clear()
+
+
+def start():
+    """Start the schedule thread (once per process)."""
+    global _thread
+    if _thread is not None and _thread.is_alive():
+        return
+    _stop.clear()
+    _thread = threading.Thread(target=_schedule_loop, name='backup-scheduler', daemon=True)
+    _thread.start()
+
+
+def stop(timeout=None):
+    """Stop the schedule and wait for a running job, so the program does not exit halfway through one."""
+    _stop.set()
+    _wake.set()
+    with _job_lock:
+        pass
+    if _thread is not None:
+        _thread.join(timeout)
+
+
+def status():
+    """The state of the scheduler for display: running job, last run and its outcome, next check."""
+    saved = _read_status()
+    with _state_lock:
+        running = dict(_running) if _running else None
+    next_run = _last_check(saved) + INTERVAL if INTERVAL > 0 else None
+    return dict(saved, running=running, next_run=next_run, interval=INTERVAL)
@@ -0,0 +1,411 @@
+"""Microbenchmarks for the hot paths of the application.
+
+Run from the src directory, e.g. `python benchmark.py cipher --rows 5000`.
+Benchmarks use a throwaway key, so no passphrase is needed and no real data is touched.
+"""
+import argparse
+import os
+import sys
+import time
+
+from cryptography.fernet import Fernet
+
+import safe_data
+
+
+def _use_throwaway_key():
+    safe_data._cached_key = Fernet.generate_key()
+    safe_data._cached_index_key = None
+    safe_data._cipher = None
+
+
+def _timed(fn):
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+def bench_cipher(rows=2000, columns=11):
+    """Rows/sec for decrypting a table: Fernet built per call (old decrypt_data) vs the shared cipher."""
+    _use_throwaway_key()
+    key = safe_data.private_key()
+    table = [safe_data.encrypt_many([f"value {r}-{c}" for c in range(columns)]) for r in range(rows)]
+
+    def per_call():
+        for row in table:
+            for token in row:
+                Fernet(key).decrypt(token).decode('utf-8')
+
+    def shared():
+        for row in table:
+            safe_data.decrypt_many(row)
+
+    before = _timed(per_call)
+    after = _timed(shared)
+    print(f"cipher: {rows} rows x {columns} columns")
+    print(f"  Fernet per call: {rows / before:10.0f} rows/sec")
+    print(f"  shared cipher:   {rows / after:10.0f} rows/sec  ({before / after:.2f}x)")
+
+
+def bench_search_pool(rows=20000, columns=11):
+    """Rows/sec for crypto_pool.match_rows, serial vs process pool."""
+    import crypto_pool
+    _use_throwaway_key()
+    table = [[r] + safe_data.encrypt_many([f"value {r}-{c}" for c in range(columns)]) for r in range(rows)]
+
+    crypto_pool.configure(workers=1)
+    serial = _timed(lambda: crypto_pool.match_rows(table, "value 1"))
+    crypto_pool.configure(workers=os.cpu_count() or 1, threshold=0)
+    crypto_pool.match_rows(table[:crypto_pool.WORKERS], "warm-up")
+    parallel = _timed(lambda: crypto_pool.match_rows(table, "value 1"))
+    crypto_pool.shutdown()
+    print(f"search pool: {rows} rows x {columns} columns, {crypto_pool.WORKERS} workers")
+    print(f"  serial:   {rows / serial:10.0f} rows/sec")
+    print(f"  parallel: {rows / parallel:10.0f} rows/sec  ({serial / parallel:.2f}x)")
+
+
+def _use_throwaway_db():
+    import tempfile
+    import db_connection
+    import database
+    directory = tempfile.mkdtemp(prefix='um-bench-')
+    db_connection.configure(db_path=os.path.join(directory, 'bench.db'))
+    database.create_or_connect_db()
+    return directory
+
+
+def bench_spatial(rows=100000, queries=200):
+    """Milliseconds per nearest / radius / bounding-box query over the ScooterLocations R*Tree."""
+    import random
+    import shutil
+    import spatial
+    from db_connection import transaction, close_all
+    _use_throwaway_key()
+    directory = _use_throwaway_db()
+    rng = random.Random(42)
+    # Scooters spread over the greater Rotterdam area
+    scooters = [(b'brand', b'model', b'serial', 25.0, 500, rng.randint(0, 100), 20, 90,
+                 rng.uniform(51.80, 52.05), rng.uniform(4.20, 4.65), 0, 100.0, '2024-01-01') for _ in range(rows)]
+    with transaction() as conn:
+        conn.executemany(
+            """INSERT INTO Scooters (brand, model, serial_number, top_speed, battery_capacity, state_of_charge,
+                target_range_min_soc, target_range_max_soc, latitude, longitude, out_of_service, mileage,
+                last_maintenance_date) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", scooters)
+    points = [(rng.uniform(51.80, 52.05), rng.uniform(4.20, 4.65)) for _ in range(queries)]
+
+    def per_query(fn):
+        return _timed(lambda: [fn(lat, lon) for lat, lon in points]) / queries * 1000
+
+    print(f"spatial: {rows} scooters, {queries} queries each")
+    print(f"  nearest 10:      {per_query(lambda lat, lon: spatial.nearest(lat, lon, 10)):8.3f} ms/query")
+    print(f"  radius 250 m:    {per_query(lambda lat, lon: spatial.within_radius(lat, lon, 0.25)):8.3f} ms/query")
+    print(f"  box 500 x 500 m: {per_query(lambda lat, lon: spatial.in_bbox(lat, lon, lat + 0.0045, lon + 0.0073)):8.3f} ms/query")
+    close_all()
+    shutil.rmtree(directory)
+
+
+def bench_logging(rows=5000):
+    """Microseconds per log_activity call on the caller's thread: synchronous vs queued writer."""
+    import shutil
+    import tempfile
+    import log_config
+    _use_throwaway_key()
+    directory = tempfile.mkdtemp(prefix='um-bench-')
+    log = log_config.logmanager(log_dir=directory)
+
+    def write_entries():
+        for i in range(rows):
+            log.log_activity("bench", "Invalid input", f"entry {i}", "No")
+
+    log_config.configure(async_mode=False)
+    sync = _timed(write_entries)
+    log_config.configure(async_mode=True)
+    queued = _timed(write_entries)
+    drain = _timed(log_config.flush)
+    print(f"logging: {rows} entries")
+    print(f"  synchronous: {sync / rows * 1e6:8.1f} us/call")
+    print(f"  queued:      {queued / rows * 1e6:8.1f} us/call  ({sync / queued:.1f}x), {drain * 1000:.0f} ms to drain")
+    shutil.rmtree(directory)
+
+
+def bench_log_segments(rows=20000):
+    """Size and bulk-decrypt speed of a text log (one Fernet token per line) vs its block-encrypted segment."""
+    import shutil
+    import tempfile
+    import log_config
+    import log_segments
+    _use_throwaway_key()
+    directory = tempfile.mkdtemp(prefix='um-bench-')
+    path = os.path.join(directory, 'scooterfleet.log.2024-01-01')
+    with open(path, 'w') as log_file:
+        for i in range(rows):
+            entry = f"user{i % 50} - Modify scooter - Updated mileage of scooter id: {i * 7919 % 100000} - Suspicious: No"
+            token = safe_data.get_cipher().encrypt(entry.encode('utf-8'))
+            log_file.write(f"2024-01-01 12:00:{i % 60:02d},000 - INFO - {log_config.base64.b64encode(token).decode('ascii')}\n")
+    text_size = os.path.getsize(path)
+    with open(path) as log_file:
+        text_read = _timed(lambda: [log_config.decrypt_log_line(line) for line in log_file])
+    log_segments.convert(path)
+    segment_size = os.path.getsize(path + log_segments.EXTENSION)
+    with log_segments.SegmentReader(path + log_segments.EXTENSION) as reader:
+        segment_read = _timed(lambda: list(reader))
+    print(f"log segments: {rows} entries")
+    print(f"  text log: {text_size:10d} bytes, {rows / text_read:10.0f} entries/sec decrypted")
+    print(f"  segment:  {segment_size:10d} bytes, {rows / segment_read:10.0f} entries/sec decrypted"
+          f"  ({text_size / segment_size:.1f}x smaller, {text_read / segment_read:.1f}x faster)")
+    shutil.rmtree(directory)
+
+
+def bench_backup(rows=200000):
+    """Time and size of a first backup: the old SQL dump in a stored zip vs a backup_repo snapshot per codec.
+
+    Scooter fields are random Fernet-sized tokens, so the data compresses like the real thing;
+    about 2,300,000 rows make a 1 GB database.
+    """
+    import base64
+    import shutil
+    import zipfile
+    import backup
+    import backup_repo
+    from db_connection import transaction, close_all, get_connection
+    _use_throwaway_key()
+    directory = _use_throwaway_db()
+    backup.BACKUP_DIR = os.path.join(directory, 'backup')
+    os.makedirs(backup.BACKUP_DIR)
+
+    def token():
+        return base64.urlsafe_b64encode(os.urandom(88))
+
+    for start in range(0, rows, 50000):
+        with transaction() as conn:
+            conn.executemany(
+                """INSERT INTO Scooters (brand, model, serial_number, top_speed, battery_capacity, state_of_charge,
+                    target_range_min_soc, target_range_max_soc, latitude, longitude, out_of_service, mileage,
+                    last_maintenance_date) VALUES (?, ?, ?, 25.0, 500, 80, 20, 90, 51.9, 4.4, 0, ?, '2024-01-01')""",
+                [(token(), token(), token(), float(i)) for i in range(start, min(start + 50000, rows))])
+    log_files = []
+    for day in range(5):
+        log_path = os.path.join(directory, f'scooterfleet.log.2024-01-0{day + 1}')
+        with open(log_path, 'wb') as log_file:
+            log_file.write(b''.join(b'2024-01-01 12:00:00,000 - INFO - ' + base64.b64encode(os.urandom(140)) + b'\n'
+                                    for _ in range(20000)))
+        log_files.append(log_path)
+    get_connection().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    db_size = os.path.getsize(os.path.join(directory, 'bench.db'))
+
+    def legacy():
+        # What create_zip used to do: dump to SQL, copy the logs aside, store both uncompressed
+        dump_path = os.path.join(directory, 'backup.sql')
+        temp_dir = os.path.join(directory, 'temp_logs')
+        with open(dump_path, 'w') as dump:
+            for line in get_connection().iterdump():
+                dump.write('%s\n' % line)
+        os.makedirs(temp_dir)
+        for log_path in log_files:
+            shutil.copy(log_path, temp_dir)
+        zip_path = os.path.join(directory, 'legacy.zip')
+        with zipfile.ZipFile(zip_path, 'w') as archive:
+            archive.write(dump_path, 'backup.sql')
+            for name in os.listdir(temp_dir):
+                archive.write(os.path.join(temp_dir, name), name)
+        shutil.rmtree(temp_dir)
+        os.remove(dump_path)
+        return zip_path
+
+    print(f"backup: {rows} scooters, {db_size / 1e6:.0f} MB database, {sum(map(os.path.getsize, log_files)) / 1e6:.0f} MB of logs")
+    results = {}
+    elapsed = _timed(lambda: results.update(path=legacy()))
+    print(f"  {'sql dump, stored':18s} {elapsed:7.2f} s {os.path.getsize(results['path']) / 1e6:9.1f} MB")
+    for codec in ('stored', 'deflate', 'lzma'):
+        backup.configure(compression=codec)
+        elapsed = _timed(lambda: backup_repo.create_backup(log_files))
+        print(f"  {'repository, ' + codec:18s} {elapsed:7.2f} s {backup_repo.disk_usage() / 1e6:9.1f} MB")
+        shutil.rmtree(backup_repo.repo_dir())
+    close_all()
+    shutil.rmtree(directory)
+
+
+def bench_acl(rows=20000):
+    """Microseconds per @require_role call: role read from the database per call vs a logged-in session."""
+    import shutil
+    import acl
+    import database
+    from db_connection import close_all
+    _use_throwaway_key()
+    directory = _use_throwaway_db()
+    for i in range(200):
+        database.get_connection().execute(
+            "INSERT INTO Users (username, password, first_name, last_name, role_level, username_index) VALUES (?, ?, ?, ?, ?, ?)",
+            (safe_data.encrypt_many([f"user{i}"])[0], b'x', b'x', b'x', 'system_admin', safe_data.blind_index(f"user{i}")))
+
+    @acl.require_role('system_admin')
+    def protected(role, username):
+        return role
+
+    without_session = _timed(lambda: [protected('traveller', 'user7') for _ in range(rows)])
+    acl.login('user7', 8, 'system_admin')
+    with_session = _timed(lambda: [protected('traveller', 'user7') for _ in range(rows)])
+    acl.logout('user7')
+    print(f"acl: {rows} protected calls")
+    print(f"  database lookup: {without_session / rows * 1e6:8.1f} us/call")
+    print(f"  session:         {with_session / rows * 1e6:8.1f} us/call  ({without_session / with_session:.0f}x)")
+    close_all()
+    shutil.rmtree(directory)
+
+
+def bench_import(rows=2000):
+    """Rows/sec for registering travellers: one transaction per traveller (add_traveller) vs bulk_import."""
+    import csv
+    import shutil
+    import bulk_import
+    import database
+    import search_index
+    from db_connection import transaction, close_all
+    _use_throwaway_key()
+    directory = _use_throwaway_db()
+    csv_path = os.path.join(directory, 'travellers.csv')
+    with open(csv_path, 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(bulk_import.COLUMNS)
+        for i in range(rows):
+            writer.writerow(['Anna', 'de Vries', '1990-01-15', 'Female', 'Main Street', str(i % 999 + 1), '3011AB',
+                             'Rotterdam', f'anna{i}@example.nl', f'{i:08d}', f'AB{i:07d}'])
+
+    def one_by_one():
+        with open(csv_path, newline='') as csv_file:
+            for record in csv.DictReader(csv_file):
+                values = bulk_import.check_record(record)
+                cells = [database.validate_and_prepare_value('Travellers', column, value)
+                         for column, value in zip(bulk_import.COLUMNS, values)]
+                with transaction() as conn:
+                    customer_id = database.unused_customer_ids(conn, 1)[0]
+                    conn.execute(bulk_import._INSERT, [customer_id] + cells)
+                    search_index.index_row(conn, 'Travellers', customer_id, dict(zip(bulk_import.COLUMNS, values)))
+
+    cwd = os.getcwd()
+    os.chdir(directory)  # the import's log entry goes to the throwaway directory
+    try:
+        single = _timed(one_by_one)
+        bulk = _timed(lambda: bulk_import.import_travellers(csv_path))
+    finally:
+        os.chdir(cwd)
+    print(f"import: {rows} travellers")
+    print(f"  one transaction each: {rows / single:8.0f} rows/sec")
+    print(f"  bulk_import:          {rows / bulk:8.0f} rows/sec  ({single / bulk:.1f}x)")
+    bulk_import.log_instance.flush()
+    close_all()
+    shutil.rmtree(directory)
+
+
+def bench_telemetry(rows=20000, scooters=2000):
+    """Telemetry records/sec: four update_column calls per record (as modify_scooter edits) vs telemetry.Ingestor.
+
+    The ingestor is flushed every 10,000 records, one window at the 10k/sec the fleet sends.
+    """
+    import random
+    import shutil
+    import database
+    import telemetry
+    from db_connection import transaction, close_all
+    _use_throwaway_key()
+    directory = _use_throwaway_db()
+    serials = [f"SN{i:010d}" for i in range(scooters)]
+    with transaction() as conn:
+        conn.executemany(
+            """INSERT INTO Scooters (brand, model, serial_number, top_speed, battery_capacity, state_of_charge,
+                target_range_min_soc, target_range_max_soc, latitude, longitude, out_of_service, mileage,
+                last_maintenance_date, serial_index) VALUES (?, ?, ?, 25.0, 500, 80, 20, 90, 51.9, 4.4, 0, 0, '2024-01-01', ?)""",
+            [safe_data.encrypt_many(['Brand', 'Model', serial]) + [safe_data.blind_index(serial)] for serial in serials])
+    now = time.time()
+    lines = [f"{random.choice(serials)},{random.randrange(101)},{51.8 + random.random() / 5:.5f},"
+             f"{4.3 + random.random() / 5:.5f},{i / 10:.1f},{now + i / 10000:.4f}" for i in range(rows)]
+
+    def per_record(count):
+        for line in lines[:count]:
+            serial, soc, lat, lon, mileage, _ts = telemetry.parse_record(line)
+            scooter_id = database.get_connection().execute(
+                "SELECT scooter_id FROM Scooters WHERE serial_index = ?", (safe_data.blind_index(serial),)).fetchone()[0]
+            for column, value in (('state_of_charge', soc), ('latitude', lat), ('longitude', lon), ('mileage', mileage)):
+                database.update_column('Scooters', column, 'scooter_id', scooter_id, value)
+
+    def ingested():
+        ingestor = telemetry.Ingestor()
+        for start in range(0, rows, 10000):
+            for line in lines[start:start + 10000]:
+                ingestor.add_line(line)
+            ingestor.flush()
+
+    sample = min(rows, 500)
+    single = _timed(lambda: per_record(sample))
+    batched = _timed(ingested)
+    print(f"telemetry: {rows} records for {scooters} scooters")
+    print(f"  update_column per value: {sample / single:8.0f} records/sec")
+    print(f"  ingestor, batched:       {rows / batched:8.0f} records/sec  ({single / sample * rows / batched:.0f}x)")
+    close_all()
+    shutil.rmtree(directory)
+
+
+# Startup budget for `import um_members`, and modules that should only load once a menu needs them
+IMPORT_BUDGET_MS = float(os.environ.get('UM_IMPORT_BUDGET_MS', '50'))
+DEFERRED_MODULES = ('engineer', 'admin', 'super_admin', 'scooter_logic', 'log_query', 'search', 'crypto_pool',
+                    'backup', 'backup_repo', 'bcrypt', 'cryptography', 'ctypes', 'zipfile', 'lzma')
+
+
+def measure_imports(runs=5, cwd=None):
+    """(best import time of um_members in ms over runs `python -X importtime` runs, deferred modules it loaded)."""
+    import subprocess
+    here = os.path.dirname(os.path.abspath(__file__))
+    check = f"import sys, um_members; print(','.join(m for m in {DEFERRED_MODULES!r} if m in sys.modules))"
+    env = dict(os.environ, PYTHONPATH=here)
+    timings = []
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', check],
+                                cwd=cwd or here, env=env, capture_output=True, text=True, check=True)
+        for line in result.stderr.splitlines():
+            fields = [field.strip() for field in line.split('|')]
+            if len(fields) == 3 and fields[2] == 'um_members':
+                timings.append(int(fields[1]) / 1000)
+    loaded = [module for module in result.stdout.strip().split(',') if module]
+    return min(timings), loaded
+
+
+def bench_imports(rows=5):
+    """Import time of um_members from `python -X importtime` (best of rows runs) against IMPORT_BUDGET_MS.
+
+    Returns 1, for a failing exit status, when over budget or when a deferred module is loaded at startup.
+    """
+    best, loaded = measure_imports(rows)
+    print(f"imports: um_members, best of {rows} runs")
+    print(f"  {best:8.1f} ms (budget {IMPORT_BUDGET_MS:.0f} ms)")
+    if loaded:
+        print(f"  loaded at startup but should be deferred: {', '.join(loaded)}")
+    return 1 if best > IMPORT_BUDGET_MS or loaded else 0
+
+
+BENCHMARKS = {
+    'acl': bench_acl,
+    'backup': bench_backup,
+    'cipher': bench_cipher,
+    'import': bench_import,
+    'imports': bench_imports,
+    'logging': bench_logging,
+    'log-segments': bench_log_segments,
+    'search-pool': bench_search_pool,
+    'spatial': bench_spatial,
+    'telemetry': bench_telemetry,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a microbenchmark")
+    parser.add_argument('name', choices=sorted(BENCHMARKS))
+    parser.add_argument('--rows', type=int, default=None)
+    args = parser.parse_args()
+    kwargs = {}
+    if args.rows is not None:
+        kwargs['rows'] = args.rows
+    return BENCHMARKS[args.name](**kwargs) or 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
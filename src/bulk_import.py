@@ -0,0 +1,267 @@
+"""Bulk registration of travellers from a CSV, JSON Lines (.jsonl/.ndjson) or JSON array (.json) file.
+
+Every record needs the columns of add_traveller: first_name, last_name, birthday, gender,
+street_name, house_number, zip_code, city, email, mobile_phone (8 digits, with or without the
++31-6- prefix) and driving_license_number. Records are checked with the validation functions,
+encrypted and tokenised for the search index in batches (on the crypto_pool workers once the
+file is large enough) and inserted with executemany, one transaction per batch. CSV and JSON
+Lines files are read as a stream and only a few batches are in flight at a time, so memory use
+does not grow with the input; a JSON array is parsed whole first.
+
+Rejected records go to an error file in the input's format (JSON Lines for a JSON array) with
+`line` and `error` added, so they can be corrected and imported again. Batches are committed
+one at a time: an import that stops halfway keeps the batches before the failure.
+
+Usage: python bulk_import.py travellers.csv|travellers.jsonl|travellers.json [--errors FILE] [--batch N]
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from collections import deque
+
+import database
+import search_index
+from db_connection import transaction
+from log_config import log_instance
+from validation import (validate_first_name, validate_last_name, validate_birthday, validate_gender,
+                        validate_street, validate_house_number, validate_postal_code, validate_city,
+                        validate_email, validate_phone_number, validate_driving_license)
+
+BATCH_SIZE = int(os.environ.get('UM_IMPORT_BATCH', '1000'))
+MOBILE_PREFIX = "+31-6-"
+
+# Column -> validator, in the column order of the Travellers table
+VALIDATORS = {
+    'first_name': validate_first_name,
+    'last_name': validate_last_name,
+    'birthday': validate_birthday,
+    'gender': validate_gender,
+    'street_name': validate_street,
+    'house_number': validate_house_number,
+    'zip_code': validate_postal_code,
+    'city': validate_city,
+    'email': validate_email,
+    'mobile_phone': validate_phone_number,
+    'driving_license_number': validate_driving_license,
+}
+COLUMNS = tuple(VALIDATORS)
+
+_INSERT = (f"INSERT INTO Travellers (customer_id, {', '.join(COLUMNS)}) "
+           f"VALUES ({', '.join('?' for _ in range(len(COLUMNS) + 1))})")
+
+
+def _is_jsonl(path):
+    return path.lower().endswith(('.jsonl', '.ndjson'))
+
+
+def _is_json(path):
+    return path.lower().endswith('.json')
+
+
+def _records(path):
+    """Yield (line number, record dict or None, raw line) from a CSV, JSON Lines or JSON array file.
+
+    A JSON array is loaded whole and numbered by position in the array instead of by line.
+    """
+    if _is_json(path):
+        with open(path, encoding='utf-8') as source:
+            try:
+                records = json.load(source)
+            except ValueError as e:
+                raise ValueError(f"{os.path.basename(path)} is not valid JSON: {e}")
+        if not isinstance(records, list):
+            raise ValueError(f"{os.path.basename(path)} must hold a JSON array of travellers")
+        for number, record in enumerate(records, start=1):
+            yield number, record if isinstance(record, dict) else None, json.dumps(record)
+    elif _is_jsonl(path):
+        with open(path, encoding='utf-8') as source:
+            for number, line in enumerate(source, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    record = None
+                yield number, record if isinstance(record, dict) else None, line.rstrip('\n')
+    else:
+        with open(path, newline='', encoding='utf-8') as source:
+            reader = csv.DictReader(source)
+            for record in reader:
+                yield reader.line_num, record, None
+
+
+def check_record(record):
+    """The plaintext values of a record in COLUMNS order, or raise ValueError saying what is wrong."""
+    values = []
+    for column, validate in VALIDATORS.items():
+        value = record.get(column)
+        if value is None or str(value).strip() == "":
+            raise ValueError(f"missing {column}")
+        value = str(value).strip()
+        if column == 'mobile_phone' and value.startswith(MOBILE_PREFIX):
+            value = value[len(MOBILE_PREFIX):]
+        if not validate(value):
+            raise ValueError(f"invalid {column}")
+        values.append(MOBILE_PREFIX + value if column == 'mobile_phone' else value)
+    return values
+
+
+def _encrypt_batch(rows):
+    """Encrypted cells and search tokens per column for each row; runs on a pool worker or in-process."""
+    import crypto_pool
+    import safe_data
+    cipher = crypto_pool.worker_cipher()
+    index_key = safe_data.index_key(crypto_pool.worker_key())
+    return [([cipher.encrypt(value.encode('utf-8')) for value in values],
+             [safe_data.ngram_tokens(value, search_index.NGRAM, index_key) for value in values])
+            for values in rows]
+
+
+def _insert_batch(prepared):
+    with transaction() as conn:
+        ids = database.unused_customer_ids(conn, len(prepared))
+        conn.executemany(_INSERT, ([customer_id] + cells for customer_id, (cells, _tokens) in zip(ids, prepared)))
+        search_index.insert_tokens(conn, 'Travellers', (
+            (customer_id, column, column_tokens)
+            for customer_id, (_cells, tokens) in zip(ids, prepared)
+            for column, column_tokens in zip(COLUMNS, tokens)))
+    return len(ids)
+
+
+class _ErrorFile:
+    """Rejected records, written in the format of the input. The file is only created on the first one."""
+
+    def __init__(self, path, jsonl):
+        self.path = path
+        self.jsonl = jsonl
+        self.count = 0
+        self._file = None
+        self._writer = None
+
+    def write(self, number, record, raw, reason):
+        if self._file is None:
+            self._file = open(self.path, 'w', newline='', encoding='utf-8')
+            if not self.jsonl:
+                self._writer = csv.DictWriter(self._file, fieldnames=('line', 'error') + COLUMNS, extrasaction='ignore')
+                self._writer.writeheader()
+        self.count += 1
+        if self.jsonl:
+            entry = dict(record) if record is not None else {'raw': raw}
+            entry.update(line=number, error=reason)
+            self._file.write(json.dumps(entry) + '\n')
+        else:
+            self._writer.writerow(dict(record, line=number, error=reason))
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+
+def default_errors_path(path):
+    base, extension = os.path.splitext(path)
+    # Rejected records of a JSON array are written one per line
+    if _is_json(path):
+        extension = '.jsonl'
+    return f"{base}.errors{extension or '.csv'}"
+
+
+def import_travellers(path, errors_path=None, batch_size=None, username="System", report=None):
+    """Import the travellers in path. Returns {'imported', 'rejected', 'seconds', 'errors_path'}.
+
+    report(stats) is called after every committed batch, e.g. to show progress.
+    """
+    import crypto_pool
+    batch_size = batch_size or BATCH_SIZE
+    errors = _ErrorFile(errors_path or default_errors_path(path), _is_jsonl(path) or _is_json(path))
+    stats = {'imported': 0, 'rejected': 0, 'seconds': 0.0, 'errors_path': None}
+    started = time.perf_counter()
+    pending = deque()
+    read = 0
+
+    def commit(prepared):
+        stats['imported'] += _insert_batch(prepared)
+        stats['seconds'] = time.perf_counter() - started
+        if report:
+            report(stats)
+
+    def batches():
+        nonlocal read
+        batch = []
+        for number, record, raw in _records(path):
+            read += 1
+            try:
+                if record is None:
+                    raise ValueError("not a JSON object")
+                batch.append(check_record(record))
+            except ValueError as e:
+                errors.write(number, record, raw, str(e))
+                stats['rejected'] = errors.count
+                continue
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    try:
+        for batch in batches():
+            # Small files are encrypted in-process; the pool pays off once the file turns out to be large
+            if crypto_pool.WORKERS <= 1 or (not pending and read < crypto_pool.PARALLEL_THRESHOLD):
+                commit(_encrypt_batch(batch))
+                continue
+            pending.append(crypto_pool.submit(_encrypt_batch, batch))
+            if len(pending) >= crypto_pool.WORKERS * 2:
+                commit(pending.popleft().result())
+        while pending:
+            commit(pending.popleft().result())
+    finally:
+        for future in pending:
+            future.cancel()
+        errors.close()
+
+    stats['seconds'] = time.perf_counter() - started
+    if errors.count:
+        stats['errors_path'] = errors.path
+    log_instance.log_activity(username, "Bulk import",
+                              f"Imported {stats['imported']} travellers from {os.path.basename(path)}, "
+                              f"{stats['rejected']} rejected", "No")
+    return stats
+
+
+def _rate(stats):
+    return stats['imported'] / stats['seconds'] if stats['seconds'] else 0.0
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Import travellers from a CSV, JSON Lines or JSON array file")
+    parser.add_argument('path')
+    parser.add_argument('--errors', help="file for rejected records (default: <input>.errors.<ext>)")
+    parser.add_argument('--batch', type=int, default=None, help=f"rows per transaction (default {BATCH_SIZE})")
+    args = parser.parse_args(argv[1:])
+    if not os.path.isfile(args.path):
+        print(f"No such file: {args.path}")
+        return 1
+
+    database.create_or_connect_db()
+
+    def progress(stats):
+        print(f"\r{stats['imported']} imported, {stats['rejected']} rejected, {_rate(stats):.0f} rows/sec",
+              end='', flush=True)
+
+    try:
+        stats = import_travellers(args.path, args.errors, args.batch, report=progress)
+    except ValueError as e:
+        print(e)
+        return 1
+    print(f"\rImported {stats['imported']} travellers in {stats['seconds']:.1f} s ({_rate(stats):.0f} rows/sec), "
+          f"{stats['rejected']} rejected")
+    if stats['errors_path']:
+        print(f"Rejected records: {stats['errors_path']}")
+    return 1 if stats['rejected'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
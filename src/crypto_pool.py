@@ -0,0 +1,207 @@
+import atexit
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from cryptography.fernet import Fernet
+
+import safe_data
+
+# Tables smaller than this are decrypted in-process; spinning up workers costs more than it saves
+PARALLEL_THRESHOLD = int(os.environ.get('UM_PARALLEL_THRESHOLD', '2000'))
+CHUNK_SIZE = int(os.environ.get('UM_DECRYPT_CHUNK_SIZE', '500'))
+WORKERS = int(os.environ.get('UM_DECRYPT_WORKERS', '0')) or (os.cpu_count() or 1)
+
+_executor = None
+_worker_cipher = None
+_worker_key = None
+
+
+def configure(workers=None, threshold=None, chunk_size=None):
+    """Change the pool settings. A running pool is shut down so the next search picks them up."""
+    global WORKERS, PARALLEL_THRESHOLD, CHUNK_SIZE
+    if workers is not None:
+        WORKERS = max(1, int(workers))
+    if threshold is not None:
+        PARALLEL_THRESHOLD = int(threshold)
+    if chunk_size is not None:
+        CHUNK_SIZE = max(1, int(chunk_size))
+    shutdown()
+
+
+def _init_worker(key):
+    # Runs once per worker process, so the key is loaded once instead of per task
+    global _worker_cipher, _worker_key
+    _worker_key = key
+    _worker_cipher = Fernet(key)
+
+
+def _decrypt_cell(cipher, value):
+    if isinstance(value, (bytes, bytearray)):
+        try:
+            return cipher.decrypt(value).decode('utf-8')
+        except Exception:
+            pass
+    return value
+
+
+class LazyRow:
+    """A result row whose encrypted cells are decrypted the first time they are read.
+
+    Indexes and slices like the list rows search used to return. If store is given it is
+    called as store(raw_row, {index: plaintext}) for every cell decrypted later on.
+    """
+    __slots__ = ('_raw', '_plain', '_store')
+
+    def __init__(self, raw, plain=None, store=None):
+        self._raw = raw
+        self._plain = dict(plain) if plain else {}
+        self._store = store
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self._raw)))]
+        if index < 0:
+            index += len(self._raw)
+        if index not in self._plain:
+            value = self._raw[index]
+            self._plain[index] = _decrypt_cell(safe_data.get_cipher(), value)
+            if self._store and isinstance(value, (bytes, bytearray)):
+                self._store(self._raw, {index: self._plain[index]})
+        return self._plain[index]
+
+    def __len__(self):
+        return len(self._raw)
+
+    def __iter__(self):
+        for i in range(len(self._raw)):
+            yield self[i]
+
+    def __repr__(self):
+        return f"LazyRow({self._raw[0]!r}, decrypted={sorted(self._plain)})"
+
+
+def _match_cells(cipher, row, term, match_columns, known):
+    """Match row against term. Returns (matched, cells decrypted along the way).
+
+    Known cells (already decrypted elsewhere) and plaintext cells are checked first since they
+    cost nothing; encrypted cells are then decrypted one at a time and matching stops at the first hit.
+    """
+    decrypted = {}
+    encrypted = []
+    for i in match_columns:
+        if known and i in known:
+            value = known[i]
+        elif isinstance(row[i], (bytes, bytearray)):
+            encrypted.append(i)
+            continue
+        else:
+            value = row[i]
+        if term in str(value).lower():
+            return True, decrypted
+    for i in encrypted:
+        decrypted[i] = _decrypt_cell(cipher, row[i])
+        if term in str(decrypted[i]).lower():
+            return True, decrypted
+    return False, decrypted
+
+
+def _iter_match(cipher, rows, term, match_columns, knowns):
+    for position, row in enumerate(rows):
+        known = knowns[position] if knowns else None
+        matched, decrypted = _match_cells(cipher, row, term, match_columns or range(len(row)), known)
+        if matched or decrypted:
+            yield position, matched, decrypted
+
+
+def _match_chunk(rows, term, match_columns, knowns):
+    return list(_iter_match(_worker_cipher, rows, term, match_columns, knowns))
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(
+            max_workers=WORKERS,
+            initializer=_init_worker,
+            initargs=(safe_data.private_key(),)
+        )
+    return _executor
+
+
+def submit(fn, *args):
+    """Run fn(*args) on the shared pool; fn can use worker_cipher()."""
+    return _get_executor().submit(fn, *args)
+
+
+def worker_cipher():
+    """The cipher of the current pool worker (the shared cipher when called in-process)."""
+    return _worker_cipher or safe_data.get_cipher()
+
+
+def worker_key():
+    """The key the current pool worker was started with (the loaded key when called in-process)."""
+    return _worker_key or safe_data.private_key()
+
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True, cancel_futures=True)
+        _executor = None
+
+
+atexit.register(shutdown)
+
+
+def _emit(rows, knowns, outcomes, store):
+    for position, matched, decrypted in outcomes:
+        row = rows[position]
+        if store and decrypted:
+            store(row, decrypted)
+        if matched:
+            plain = dict(knowns[position]) if knowns and knowns[position] else {}
+            plain.update(decrypted)
+            yield LazyRow(row, plain, store)
+
+
+def iter_matches(chunks, term, total_rows=None, match_columns=None, lookup=None, store=None):
+    """Yield LazyRows for the rows that contain term (case-insensitive), in order, from an iterable of row chunks.
+
+    Only match_columns (default: every column) are looked at, and only until the first hit;
+    all other cells stay encrypted until the row is read.
+    lookup(row) may return {index: plaintext} for cells that are already known (no decrypt needed),
+    and store(row, {index: plaintext}) is called with every cell that had to be decrypted.
+    Small tables (total_rows below PARALLEL_THRESHOLD) or a single worker decrypt in-process, row by row.
+    Otherwise chunks go to the process pool with at most two per worker in flight, so a consumer that
+    stops early does not pay for the rest of the table.
+    """
+    term = term.lower()
+    if WORKERS <= 1 or (total_rows is not None and total_rows < PARALLEL_THRESHOLD):
+        cipher = safe_data.get_cipher()
+        for chunk in chunks:
+            knowns = [lookup(row) for row in chunk] if lookup else None
+            yield from _emit(chunk, knowns, _iter_match(cipher, chunk, term, match_columns, knowns), store)
+        return
+
+    executor = _get_executor()
+    pending = deque()
+    try:
+        for chunk in chunks:
+            knowns = [lookup(row) for row in chunk] if lookup else None
+            pending.append((chunk, knowns, executor.submit(_match_chunk, chunk, term, match_columns, knowns)))
+            if len(pending) >= WORKERS * 2:
+                chunk_rows, chunk_knowns, future = pending.popleft()
+                yield from _emit(chunk_rows, chunk_knowns, future.result(), store)
+        while pending:
+            chunk_rows, chunk_knowns, future = pending.popleft()
+            yield from _emit(chunk_rows, chunk_knowns, future.result(), store)
+    finally:
+        for _chunk, _knowns, future in pending:
+            future.cancel()
+
+
+def match_rows(rows, term, match_columns=None):
+    """Return LazyRows for the rows that contain term (case-insensitive), in input order."""
+    chunks = (rows[i:i + CHUNK_SIZE] for i in range(0, len(rows), CHUNK_SIZE))
+    return list(iter_matches(chunks, term, total_rows=len(rows), match_columns=match_columns))
@@ -1,94 +1,124 @@
-import sqlite3
+from db_connection import get_connection, transaction
 
 Roles = ('system_admin', 'service_engineer')
 Genders = ('Male', 'Female')
 Cities = ('Rotterdam', 'Schiedam', 'Vlaardingen', 'Capelle aan den IJssel', 'Barendrecht', 'Ridderkerk', 'Spijkenisse', 'Maassluis', 'Krimpen aan den IJssel', 'Dordrecht')
 
+# Telemetry columns are plaintext and typed so range filters run in SQL (see scooter_logic.filter_scooters)
+SCOOTERS_SCHEMA = """CREATE TABLE {name} (
+            scooter_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            brand BLOB NOT NULL,
+            model BLOB NOT NULL,
+            serial_number BLOB NOT NULL,
+            top_speed REAL NOT NULL,
+            battery_capacity INTEGER NOT NULL,
+            state_of_charge INTEGER NOT NULL,
+            target_range_min_soc INTEGER NOT NULL,
+            target_range_max_soc INTEGER NOT NULL,
+            latitude REAL NOT NULL,
+            longitude REAL NOT NULL,
+            out_of_service INTEGER NOT NULL,
+            mileage REAL NOT NULL,
+            last_maintenance_date TEXT NOT NULL,
+            in_service_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            serial_index TEXT
+        )"""
+
+SCOOTER_INDEXED_COLUMNS = ("state_of_charge", "out_of_service", "mileage", "last_maintenance_date")
+
 def create_or_connect_db():
-    connection = sqlite3.connect("scooterfleet.db")
-    cursor = connection.cursor()
-
-    roles_str = str(Roles).replace('[', '(').replace(']', ')')
-
-    cursor.execute(f"""CREATE TABLE IF NOT EXISTS Users (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        username BLOB NOT NULL,
-        password BLOB NOT NULL,
-        first_name BLOB NOT NULL,
-        last_name BLOB NOT NULL,
-        registered_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        role_level TEXT NOT NULL CHECK(role_level IN {roles_str})
-    )""")
-
-    cursor.execute("""CREATE TABLE IF NOT EXISTS Travellers (
-        customer_id TEXT PRIMARY KEY,
-        first_name BLOB NOT NULL,
-        last_name BLOB NOT NULL,
-        birthday BLOB NOT NULL,
-        gender BLOB NOT NULL,
-        street_name BLOB NOT NULL,
-        house_number BLOB NOT NULL,
-        zip_code BLOB NOT NULL,
-        city BLOB NOT NULL,
-        email BLOB NOT NULL,
-        mobile_phone BLOB NOT NULL,
-        driving_license_number BLOB NOT NULL,
-        registration_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )""")
-
-    cursor.execute("""CREATE TABLE IF NOT EXISTS Scooters (
-        scooter_id INTEGER PRIMARY KEY AUTOINCREMENT,
-        brand BLOB NOT NULL,
-        model BLOB NOT NULL,
-        serial_number BLOB NOT NULL,
-        top_speed BLOB NOT NULL,
-        battery_capacity BLOB NOT NULL,
-        state_of_charge BLOB NOT NULL,
-        target_range_min_soc BLOB NOT NULL,
-        target_range_max_soc BLOB NOT NULL,
-        latitude BLOB NOT NULL,
-        longitude BLOB NOT NULL,
-        out_of_service BLOB NOT NULL,
-        mileage BLOB NOT NULL,
-        last_maintenance_date BLOB NOT NULL,
-        in_service_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )""")
-
-    cursor.execute("""CREATE TABLE IF NOT EXISTS RestoreCodes (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        code TEXT NOT NULL,
-        admin_user_id INTEGER NOT NULL,
-        backup_filename TEXT NOT NULL,
-        used INTEGER NOT NULL DEFAULT 0,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        FOREIGN KEY (admin_user_id) REFERENCES Users(id)
-    )""")
-
-    cursor.execute("""CREATE TABLE IF NOT EXISTS PasswordRecoveryTokens (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER NOT NULL,
-        token_hash TEXT NOT NULL,
-        expires_at TIMESTAMP NOT NULL,
-        used INTEGER NOT NULL DEFAULT 0,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        FOREIGN KEY (user_id) REFERENCES Users(id)
-    )""")
-
-    connection.commit()
-    connection.close()
+    with transaction() as connection:
+        cursor = connection.cursor()
+
+        roles_str = str(Roles).replace('[', '(').replace(']', ')')
+
+        cursor.execute(f"""CREATE TABLE IF NOT EXISTS Users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username BLOB NOT NULL,
+            password BLOB NOT NULL,
+            first_name BLOB NOT NULL,
+            last_name BLOB NOT NULL,
+            registered_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            role_level TEXT NOT NULL CHECK(role_level IN {roles_str}),
+            username_index TEXT
+        )""")
+        _ensure_blind_indexes(cursor, 'Users')
+
+        cursor.execute("""CREATE TABLE IF NOT EXISTS Travellers (
+            customer_id TEXT PRIMARY KEY,
+            first_name BLOB NOT NULL,
+            last_name BLOB NOT NULL,
+            birthday BLOB NOT NULL,
+            gender BLOB NOT NULL,
+            street_name BLOB NOT NULL,
+            house_number BLOB NOT NULL,
+            zip_code BLOB NOT NULL,
+            city BLOB NOT NULL,
+            email BLOB NOT NULL,
+            mobile_phone BLOB NOT NULL,
+            driving_license_number BLOB NOT NULL,
+            registration_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )""")
+
+        cursor.execute(SCOOTERS_SCHEMA.format(name="IF NOT EXISTS Scooters"))
+        _migrate_scooter_columns(cursor)
+        _ensure_blind_indexes(cursor, 'Scooters')
+        for column in SCOOTER_INDEXED_COLUMNS:
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_scooters_{column} ON Scooters({column})")
+        _ensure_scooter_locations(cursor)
+
+        cursor.execute("""CREATE TABLE IF NOT EXISTS RestoreCodes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            code TEXT NOT NULL,
+            admin_user_id INTEGER NOT NULL,
+            backup_filename TEXT NOT NULL,
+            used INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (admin_user_id) REFERENCES Users(id)
+        )""")
+
+        cursor.execute("""CREATE TABLE IF NOT EXISTS PasswordRecoveryTokens (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            token_hash TEXT NOT NULL,
+            expires_at TIMESTAMP NOT NULL,
+            used INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES Users(id)
+        )""")
+
+        # Keyed n-gram tokens of encrypted columns (see search_index); row_id keeps the primary key's own type
+        cursor.execute("""CREATE TABLE IF NOT EXISTS SearchTokens (
+            table_name TEXT NOT NULL,
+            row_id NOT NULL,
+            column_name TEXT NOT NULL,
+            token TEXT NOT NULL
+        )""")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_search_tokens_lookup ON SearchTokens(table_name, token, row_id, column_name)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_search_tokens_row ON SearchTokens(table_name, row_id)")
+
+        cursor.execute("""CREATE TABLE IF NOT EXISTS SearchIndexState (
+            table_name TEXT PRIMARY KEY,
+            built INTEGER NOT NULL DEFAULT 0
+        )""")
+        for table in search_index.INDEXED_TABLES:
+            # An empty table is trivially indexed; existing data needs `python search_index.py rebuild`
+            cursor.execute(f"SELECT EXISTS (SELECT 1 FROM {table})")
+            built = 0 if cursor.fetchone()[0] else 1
+            cursor.execute("INSERT OR IGNORE INTO SearchIndexState (table_name, built) VALUES (?, ?)", (table, built))
 
 def clear_database():
-    connection = sqlite3.connect("scooterfleet.db")
-    cursor = connection.cursor()
-
-    cursor.execute("DROP TABLE IF EXISTS PasswordRecoveryTokens")
-    cursor.execute("DROP TABLE IF EXISTS RestoreCodes")
-    cursor.execute("DROP TABLE IF EXISTS Scooters")
-    cursor.execute("DROP TABLE IF EXISTS Travellers")
-    cursor.execute("DROP TABLE IF EXISTS Users")
+    with transaction() as connection:
+        cursor = connection.cursor()
 
-    connection.commit()
-    connection.close()
+        cursor.execute("DROP TABLE IF EXISTS SearchIndexState")
+        cursor.execute("DROP TABLE IF EXISTS SearchTokens")
+        cursor.execute("DROP TABLE IF EXISTS PasswordRecoveryTokens")
+        cursor.execute("DROP TABLE IF EXISTS RestoreCodes")
+        cursor.execute("DROP TABLE IF EXISTS ScooterLocations")
+        cursor.execute("DROP TABLE IF EXISTS Scooters")
+        cursor.execute("DROP TABLE IF EXISTS Travellers")
+        cursor.execute("DROP TABLE IF EXISTS Users")
 
 
 ALLOWED_COLUMNS = {
@@ -129,6 +159,22 @@ ALLOWED_COLUMNS = {
     }
 }
 
+PRIMARY_KEYS = {
+    "Users": "id",
+    "Travellers": "customer_id",
+    "Scooters": "scooter_id"
+}
+
+# Encrypted columns that also carry a keyed blind index for exact lookups
+BLIND_INDEXES = {
+    "Users": {
+        "username": "username_index"
+    },
+    "Scooters": {
+        "serial_number": "serial_index"
+    }
+}
+
 TYPE_MAP = {
     "Scooters": {
         "top_speed": float,
@@ -154,13 +200,149 @@ TYPE_MAP = {
 }
 
 
-from safe_data import encrypt_data, public_key
+from safe_data import get_cipher
 from safe_data import decrypt_data, private_key
+from safe_data import blind_index
+import search_index
+import row_cache
 import secrets
 import hashlib
 import datetime
 
 
+def _ensure_blind_indexes(cursor, table):
+    """Add and backfill the BLIND_INDEXES columns of table for databases created before they existed."""
+    cursor.execute(f"PRAGMA table_info({table})")
+    columns = [info[1] for info in cursor.fetchall()]
+    pk = PRIMARY_KEYS[table]
+    for column, index_column in BLIND_INDEXES[table].items():
+        if index_column not in columns:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {index_column} TEXT")
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{table.lower()}_{index_column} ON {table}({index_column})")
+
+        cursor.execute(f"SELECT {pk}, {column} FROM {table} WHERE {index_column} IS NULL")
+        for row_id, encrypted in cursor.fetchall():
+            try:
+                index = blind_index(decrypt_data(private_key(), encrypted))
+            except Exception:
+                continue
+            cursor.execute(f"UPDATE {table} SET {index_column} = ? WHERE {pk} = ?", (index, row_id))
+
+
+def _normalise_scooter_value(column, value):
+    """Plaintext, correctly typed value for a Scooters telemetry column, or the original value if it can't be read."""
+    if isinstance(value, (bytes, bytearray)):
+        try:
+            value = decrypt_data(private_key(), value)
+        except Exception:
+            return value
+    if column == "out_of_service" and isinstance(value, str) and value.strip().lower() in ("y", "n", "yes", "no"):
+        return 1 if value.strip().lower() in ("y", "yes") else 0
+    try:
+        return validate_and_prepare_value("Scooters", column, value.strip() if isinstance(value, str) else value)
+    except ValueError:
+        return value
+
+
+def _migrate_scooter_columns(cursor):
+    """Rebuild Scooters with typed telemetry columns for databases created when they were all BLOB.
+
+    Values are decrypted where modify_scooter used to encrypt them and converted to the TYPE_MAP type.
+    scooter_id is kept, so search tokens and other references stay valid.
+    """
+    cursor.execute("PRAGMA table_info(Scooters)")
+    declared = {info[1]: info[2].upper() for info in cursor.fetchall()}
+    if declared.get("state_of_charge") != "BLOB":
+        return
+
+    cursor.execute(SCOOTERS_SCHEMA.format(name="Scooters_migrated"))
+    columns = list(declared)
+    telemetry = [c for c in columns if c in TYPE_MAP["Scooters"]]
+    placeholders = ", ".join("?" for _ in columns)
+    cursor.execute(f"SELECT {', '.join(columns)} FROM Scooters")
+    for row in cursor.fetchall():
+        values = dict(zip(columns, row))
+        for column in telemetry:
+            values[column] = _normalise_scooter_value(column, values[column])
+        cursor.execute(f"INSERT INTO Scooters_migrated ({', '.join(columns)}) VALUES ({placeholders})",
+                       [values[c] for c in columns])
+    cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'Scooters'")
+    sequence = cursor.fetchone()
+    cursor.execute("DROP TABLE Scooters")
+    cursor.execute("ALTER TABLE Scooters_migrated RENAME TO Scooters")
+    if sequence:
+        # Keep AUTOINCREMENT from handing out ids of scooters deleted before the migration
+        cursor.execute("DELETE FROM sqlite_sequence WHERE name = 'Scooters'")
+        cursor.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('Scooters', ?)", (sequence[0],))
+
+
+def _ensure_scooter_locations(cursor):
+    """Create the R*Tree over scooter positions (see spatial) and the triggers that keep it in sync with Scooters."""
+    cursor.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS ScooterLocations USING rtree(
+            id,
+            min_lat, max_lat,
+            min_lon, max_lon
+        )""")
+    located = "typeof({0}.latitude) IN ('integer', 'real') AND typeof({0}.longitude) IN ('integer', 'real')"
+    cursor.execute(f"""CREATE TRIGGER IF NOT EXISTS scooter_locations_insert AFTER INSERT ON Scooters
+        WHEN {located.format('new')}
+        BEGIN
+            INSERT INTO ScooterLocations VALUES (new.scooter_id, new.latitude, new.latitude, new.longitude, new.longitude);
+        END""")
+    cursor.execute(f"""CREATE TRIGGER IF NOT EXISTS scooter_locations_update AFTER UPDATE OF latitude, longitude ON Scooters
+        BEGIN
+            DELETE FROM ScooterLocations WHERE id = old.scooter_id;
+            INSERT INTO ScooterLocations SELECT new.scooter_id, new.latitude, new.latitude, new.longitude, new.longitude
+                WHERE {located.format('new')};
+        END""")
+    cursor.execute("""CREATE TRIGGER IF NOT EXISTS scooter_locations_delete AFTER DELETE ON Scooters
+        BEGIN
+            DELETE FROM ScooterLocations WHERE id = old.scooter_id;
+        END""")
+    # Scooters added before the index existed (or by a restore that predates it)
+    cursor.execute(f"""INSERT INTO ScooterLocations
+        SELECT scooter_id, latitude, latitude, longitude, longitude FROM Scooters
+        WHERE {located.format('Scooters')} AND scooter_id NOT IN (SELECT id FROM ScooterLocations)""")
+
+
+def find_user_by_username(username: str, role_level: str = None):
+    """Look up a user by plaintext username through the blind index.
+
+    Returns the row (id, username, password, first_name, last_name, role_level) or None.
+    """
+    if not username:
+        return None
+    sql = "SELECT id, username, password, first_name, last_name, role_level FROM Users WHERE username_index = ?"
+    params = [blind_index(username)]
+    if role_level:
+        sql += " AND role_level = ?"
+        params.append(role_level)
+
+    return get_connection().execute(sql, params).fetchone()
+
+
+def new_customer_id():
+    """A traveller id: the last two digits of the year, seven random digits and a checksum digit.
+
+    The checksum is the sum of the first nine digits modulo 10. See unused_customer_ids for ids not taken yet.
+    """
+    digits = [int(d) for d in str(datetime.datetime.now().year)[-2:]]
+    digits += [secrets.randbelow(10) for _ in range(7)]
+    return ''.join(map(str, digits)) + str(sum(digits) % 10)
+
+
+def unused_customer_ids(conn, count):
+    """count new customer ids that are not in Travellers yet; call inside the transaction that inserts them."""
+    import json
+    ids = set()
+    while len(ids) < count:
+        fresh = {new_customer_id() for _ in range(count - len(ids))} - ids
+        taken = conn.execute("SELECT customer_id FROM Travellers WHERE customer_id IN (SELECT value FROM json_each(?))",
+                             (json.dumps(sorted(fresh)),))
+        ids |= fresh - {row[0] for row in taken}
+    return list(ids)
+
+
 def validate_and_prepare_value(table: str, column: str, new_data):
     """Validate and prepare a value for storage according to ALLOWED_COLUMNS and TYPE_MAP.
 
@@ -183,7 +365,7 @@ def validate_and_prepare_value(table: str, column: str, new_data):
         if not isinstance(new_data, str):
             new_data = str(new_data)
         try:
-            return encrypt_data(public_key(), new_data)
+            return get_cipher().encrypt(new_data.encode('utf-8'))
         except Exception as e:
             raise ValueError(f"Encryption failed: {e}")
 
@@ -212,11 +394,21 @@ def validate_and_prepare_value(table: str, column: str, new_data):
     return str(new_data)
 
 
+def _forget_roles(table, row_ids):
+    # Logged-in sessions cache their user's role; a changed or deleted user is re-checked on next use
+    if table == 'Users':
+        import acl
+        for row_id in row_ids:
+            acl.invalidate(user_id=row_id)
+
+
 def update_column(table: str, column: str, id_field: str, id_value, prepared_value) -> bool:
     """Safely update a single column in a table after validating identifiers.
 
     - Validates that table and column are in ALLOWED_COLUMNS.
     - Validates id_field is a safe identifier (basic regex).
+    - Keeps the blind index (see BLIND_INDEXES) and the n-gram search index in sync for encrypted columns.
+    - Drops the affected rows from the decrypted-row cache.
     - Executes a parameterized UPDATE and returns True if rows were affected.
     """
     import re
@@ -228,13 +420,46 @@ def update_column(table: str, column: str, id_field: str, id_value, prepared_val
     if not re.match(r'^[A-Za-z_][A-Za-z0-9_]*$', id_field):
         raise ValueError("Invalid id field identifier")
 
-    conn = sqlite3.connect("scooterfleet.db")
-    cur = conn.cursor()
-    sql = f"UPDATE {table} SET {column} = ? WHERE {id_field} = ?"
-    cur.execute(sql, (prepared_value, id_value))
-    conn.commit()
-    rowcount = cur.rowcount
-    conn.close()
+    assignments = f"{column} = ?"
+    params = [prepared_value]
+    plaintext = None
+    if ALLOWED_COLUMNS[table][column]:
+        plaintext = decrypt_data(private_key(), prepared_value)
+    index_column = BLIND_INDEXES.get(table, {}).get(column)
+    if index_column:
+        assignments += f", {index_column} = ?"
+        params.append(blind_index(plaintext))
+    params.append(id_value)
+
+    pk = PRIMARY_KEYS.get(table)
+    sql = f"UPDATE {table} SET {assignments} WHERE {id_field} = ?"
+    with transaction() as conn:
+        row_ids = []
+        if pk:
+            if id_field == pk:
+                row_ids = [id_value]
+            else:
+                row_ids = [r[0] for r in conn.execute(f"SELECT {pk} FROM {table} WHERE {id_field} = ?", (id_value,))]
+        rowcount = conn.execute(sql, params).rowcount
+        if plaintext is not None and rowcount > 0:
+            for row_id in row_ids:
+                search_index.index_row(conn, table, row_id, {column: plaintext})
+    for row_id in row_ids:
+        row_cache.invalidate(table, row_id)
+    _forget_roles(table, row_ids)
+    return rowcount > 0
+
+
+def delete_row(table: str, row_id) -> bool:
+    """Delete one row by primary key, together with its search tokens and cached plaintext."""
+    if table not in PRIMARY_KEYS:
+        raise ValueError("Invalid table specified for delete")
+    pk = PRIMARY_KEYS[table]
+    with transaction() as conn:
+        rowcount = conn.execute(f"DELETE FROM {table} WHERE {pk} = ?", (row_id,)).rowcount
+        search_index.remove_row(conn, table, row_id)
+    row_cache.invalidate(table, row_id)
+    _forget_roles(table, [row_id])
     return rowcount > 0
 
 
@@ -243,31 +468,17 @@ def create_recovery_token_for_username(decrypted_username: str, validity_minutes
 
     Returns the plaintext token (to be delivered to the user) or None if user not found.
     """
-    conn = sqlite3.connect("scooterfleet.db")
-    cur = conn.cursor()
-    cur.execute("SELECT id, username FROM Users")
-    rows = cur.fetchall()
-    target_id = None
-    for rid, enc_uname in rows:
-        try:
-            if decrypt_data(private_key(), enc_uname).lower() == decrypted_username.lower():
-                target_id = rid
-                break
-        except Exception:
-            continue
-
-    if target_id is None:
-        conn.close()
+    user_row = find_user_by_username(decrypted_username)
+    if user_row is None:
         return None
+    target_id = user_row[0]
 
     token = secrets.token_urlsafe(24)
     token_hash = hashlib.sha256(token.encode('utf-8')).hexdigest()
     expires_at = (datetime.datetime.utcnow() + datetime.timedelta(minutes=validity_minutes)).isoformat()
 
-    cur.execute("INSERT INTO PasswordRecoveryTokens (user_id, token_hash, expires_at, used) VALUES (?, ?, ?, 0)",
-                (target_id, token_hash, expires_at))
-    conn.commit()
-    conn.close()
+    get_connection().execute("INSERT INTO PasswordRecoveryTokens (user_id, token_hash, expires_at, used) VALUES (?, ?, ?, 0)",
+                             (target_id, token_hash, expires_at))
     return token
 
 
@@ -275,34 +486,21 @@ def verify_and_consume_recovery_token(decrypted_username: str, token: str) -> bo
     """Verify a recovery token for the given decrypted username. If valid, mark it used and return True.
     Otherwise return False.
     """
-    conn = sqlite3.connect("scooterfleet.db")
-    cur = conn.cursor()
-    cur.execute("SELECT id, username FROM Users")
-    rows = cur.fetchall()
-    target_id = None
-    for rid, enc_uname in rows:
-        try:
-            if decrypt_data(private_key(), enc_uname).lower() == decrypted_username.lower():
-                target_id = rid
-                break
-        except Exception:
-            continue
-
-    if target_id is None:
-        conn.close()
+    user_row = find_user_by_username(decrypted_username)
+    if user_row is None:
         return False
+    target_id = user_row[0]
 
     token_hash = hashlib.sha256(token.encode('utf-8')).hexdigest()
     now = datetime.datetime.utcnow().isoformat()
-    cur.execute("SELECT id FROM PasswordRecoveryTokens WHERE user_id = ? AND token_hash = ? AND used = 0 AND expires_at >= ?",
-                (target_id, token_hash, now))
-    row = cur.fetchone()
-    if not row:
-        conn.close()
-        return False
-
-    token_id = row[0]
-    cur.execute("UPDATE PasswordRecoveryTokens SET used = 1 WHERE id = ?", (token_id,))
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT id FROM PasswordRecoveryTokens WHERE user_id = ? AND token_hash = ? AND used = 0 AND expires_at >= ?",
+                    (target_id, token_hash, now))
+        row = cur.fetchone()
+        if not row:
+            return False
+
+        token_id = row[0]
+        cur.execute("UPDATE PasswordRecoveryTokens SET used = 1 WHERE id = ?", (token_id,))
     return True
@@ -0,0 +1,105 @@
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+# Settings (override through the environment or configure())
+DB_PATH = os.environ.get('UM_DB_PATH', 'scooterfleet.db')
+BUSY_TIMEOUT_MS = int(os.environ.get('UM_DB_BUSY_TIMEOUT_MS', '5000'))
+SYNCHRONOUS = os.environ.get('UM_DB_SYNCHRONOUS', 'NORMAL').upper()
+CACHE_SIZE_KB = int(os.environ.get('UM_DB_CACHE_SIZE_KB', '16384'))
+STATEMENT_CACHE_SIZE = int(os.environ.get('UM_DB_STATEMENT_CACHE', '256'))
+
+_SYNCHRONOUS_MODES = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+
+_local = threading.local()
+_lock = threading.Lock()
+_connections = []
+_generation = 0
+
+
+def configure(db_path=None, busy_timeout_ms=None, synchronous=None, cache_size_kb=None, statement_cache_size=None):
+    """Change connection settings. Open connections are closed so the next use picks them up."""
+    global DB_PATH, BUSY_TIMEOUT_MS, SYNCHRONOUS, CACHE_SIZE_KB, STATEMENT_CACHE_SIZE
+    if db_path is not None:
+        DB_PATH = db_path
+    if busy_timeout_ms is not None:
+        BUSY_TIMEOUT_MS = int(busy_timeout_ms)
+    if synchronous is not None:
+        SYNCHRONOUS = synchronous.upper()
+    if cache_size_kb is not None:
+        CACHE_SIZE_KB = int(cache_size_kb)
+    if statement_cache_size is not None:
+        STATEMENT_CACHE_SIZE = int(statement_cache_size)
+    close_all()
+
+
+def _open():
+    if SYNCHRONOUS not in _SYNCHRONOUS_MODES:
+        raise ValueError(f"Invalid synchronous mode: {SYNCHRONOUS}")
+    # isolation_level=None: single statements autocommit, multi-step work goes through transaction()
+    conn = sqlite3.connect(
+        DB_PATH,
+        timeout=BUSY_TIMEOUT_MS / 1000,
+        isolation_level=None,
+        cached_statements=STATEMENT_CACHE_SIZE,
+        check_same_thread=False
+    )
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+    conn.execute(f"PRAGMA synchronous={SYNCHRONOUS}")
+    conn.execute(f"PRAGMA cache_size=-{CACHE_SIZE_KB}")
+    return conn
+
+
+def get_connection():
+    """Return this thread's long-lived connection, opening it on first use."""
+    conn = getattr(_local, 'connection', None)
+    if conn is None or getattr(_local, 'generation', None) != _generation:
+        conn = _open()
+        with _lock:
+            _connections.append(conn)
+        _local.connection = conn
+        _local.generation = _generation
+        _local.depth = 0
+    return conn
+
+
+@contextmanager
+def transaction():
+    """Run a block of statements as one transaction and commit once at the end.
+
+    Nested use joins the outer transaction; an exception rolls the whole thing back.
+    """
+    conn = get_connection()
+    if _local.depth > 0:
+        _local.depth += 1
+        try:
+            yield conn
+        finally:
+            _local.depth -= 1
+        return
+
+    conn.execute("BEGIN IMMEDIATE")
+    _local.depth = 1
+    try:
+        yield conn
+    except BaseException:
+        _local.depth = 0
+        conn.execute("ROLLBACK")
+        raise
+    _local.depth = 0
+    conn.execute("COMMIT")
+
+
+def close_all():
+    """Close every connection opened by this process (e.g. before the database file is replaced)."""
+    global _generation
+    with _lock:
+        for conn in _connections:
+            try:
+                conn.close()
+            except Exception:
+                pass
+        _connections.clear()
+        _generation += 1
@@ -1,13 +1,12 @@
-import sqlite3
 from getpass import getpass
 import bcrypt
 import um_members
 import time
-from safe_data import decrypt_data, private_key
+import database
+from db_connection import get_connection
 from validation import validate_password
 from super_admin import scooter_menu
-from log_config import logmanager as log_manager
-log_instance = log_manager()
+from log_config import log_instance
 
 def menu(username):
     while True:
@@ -33,24 +32,14 @@ def menu(username):
             log_instance.log_activity(f"{username}", "System", "Invalid input in the main menu", "No")
 
 def update_password(username):
-    connection = sqlite3.connect("scooterfleet.db")
-    cursor = connection.cursor()
-
     um_members.clear()
     print("\n--- Update Password ---")
-    cursor.execute("SELECT * FROM Users")
-    user_data = cursor.fetchall()
-    decrypted_username = ""
-    found_password = ""
-    for i in range(len(user_data)):
-        decrypted_username = decrypt_data(private_key(), user_data[i][1])
-        if decrypted_username == username:
-            found_password = user_data[i][2]
-            break
-        if i == len(user_data) - 1:
-            print("User not found")
-            log_instance.log_activity(username, "Update password", "Nonexistent service engineer tried to update password", "Yes")
-            exit()
+    user_row = database.find_user_by_username(username)
+    if user_row is None:
+        print("User not found")
+        log_instance.log_activity(username, "Update password", "Nonexistent service engineer tried to update password", "Yes")
+        exit()
+    found_password = user_row[2]
 
     input_password = getpass("Enter your current password: ")
     if not bcrypt.checkpw(input_password.encode('utf-8'), found_password):
@@ -75,17 +64,7 @@ def update_password(username):
                 continue
             else:
                 hashed_password = bcrypt.hashpw(new_password.encode('utf-8'), bcrypt.gensalt())
-                cursor.execute("SELECT * FROM Users")
-                user_data = cursor.fetchall()
-                decrypted_username = ""
-                for i in range(len(user_data)):
-                    decrypted_username = decrypt_data(private_key(), user_data[i][1])
-                    if decrypted_username == username:
-                        encrypted_username = user_data[i][1]
-                        break
-                cursor.execute("UPDATE Users SET password = ? WHERE username = ?", (hashed_password, encrypted_username))
-                connection.commit()
-                connection.close()
+                get_connection().execute("UPDATE Users SET password = ? WHERE id = ?", (hashed_password, user_row[0]))
                 um_members.clear()
                 print("Password updated successfully")
                 log_instance.log_activity(username, "Update password", f"Password updated successfully for user: '{username}'", "No")
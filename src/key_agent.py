@@ -0,0 +1,210 @@
+"""Local key agent: derives the data key once and hands it to later runs, so they skip PBKDF2.
+
+The agent reads um.salt from the directory it is started in, asks for the passphrase (or takes
+UM_PASSPHRASE), derives the key and serves it on a Unix socket in a 0700 directory of the
+current user. Only connections from the same user are answered (SO_PEERCRED where available),
+a request must name the salt so an agent for another installation is never used, and the
+agent exits after UM_KEY_AGENT_IDLE seconds without requests. Where the platform allows, the
+key is held in memory locked against swapping and the process is made non-dumpable.
+
+safe_data asks the agent first and derives the key itself when no agent answers.
+
+Usage: python key_agent.py start     (runs in the foreground; end with Ctrl+C or `stop`)
+       python key_agent.py stop
+       python key_agent.py status
+"""
+import hashlib
+import os
+import socket
+import stat
+import struct
+import sys
+import tempfile
+
+# Seconds without requests after which the agent exits
+IDLE_TIMEOUT = int(os.environ.get('UM_KEY_AGENT_IDLE', '900'))
+# Seconds a client waits for the agent before deriving the key itself
+CLIENT_TIMEOUT = 0.5
+
+
+def socket_path():
+    if os.environ.get('UM_KEY_AGENT_SOCKET'):
+        return os.environ['UM_KEY_AGENT_SOCKET']
+    base = os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir()
+    return os.path.join(base, f'um-key-agent-{os.getuid()}', 'agent.sock')
+
+
+def salt_id(salt):
+    return hashlib.sha256(b'um-key-agent:' + salt).hexdigest()[:32]
+
+
+def _private_dir(path):
+    """True when path is a directory owned by this user that nobody else can enter."""
+    try:
+        info = os.lstat(path)
+    except OSError:
+        return False
+    return stat.S_ISDIR(info.st_mode) and info.st_uid == os.getuid() and not info.st_mode & 0o077
+
+
+def _request(message):
+    path = socket_path()
+    if not _private_dir(os.path.dirname(path)):
+        return None
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(CLIENT_TIMEOUT)
+    try:
+        client.connect(path)
+        client.sendall(message + b'\n')
+        reply = b''
+        while not reply.endswith(b'\n'):
+            data = client.recv(4096)
+            if not data:
+                break
+            reply += data
+        return reply.strip()
+    except OSError:
+        return None
+    finally:
+        client.close()
+
+
+def supported():
+    return hasattr(socket, 'AF_UNIX') and hasattr(os, 'getuid')
+
+
+def fetch_key(salt):
+    """The key held by a running agent for this salt, or None (also when asking fails in any way)."""
+    if not supported():
+        return None
+    try:
+        reply = _request(b'KEY ' + salt_id(salt).encode('ascii'))
+    except Exception:
+        return None
+    if reply and reply.startswith(b'OK '):
+        return reply[3:]
+    return None
+
+
+def _libc():
+    import ctypes
+    import ctypes.util
+    name = ctypes.util.find_library('c')
+    return ctypes.CDLL(name, use_errno=True) if name else None
+
+
+def _protect_process(buffer):
+    # Best effort: no swapping of the key, no core dumps or ptrace from other processes of the user
+    import ctypes
+    libc = _libc()
+    if libc is None:
+        return False
+    locked = libc.mlock(ctypes.addressof(buffer), ctypes.sizeof(buffer)) == 0
+    if sys.platform.startswith('linux'):
+        PR_SET_DUMPABLE = 4
+        libc.prctl(PR_SET_DUMPABLE, 0, 0, 0, 0)
+    return locked
+
+
+def _peer_uid(conn):
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return os.getuid()
+    creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+    _pid, uid, _gid = struct.unpack('3i', creds)
+    return uid
+
+
+def _bind(path):
+    directory = os.path.dirname(path)
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    if not _private_dir(directory):
+        raise RuntimeError(f"{directory} must be a directory owned by you with mode 0700")
+    if os.path.exists(path):
+        if _request(b'PING') == b'OK':
+            raise RuntimeError("A key agent is already running")
+        os.remove(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0o177)
+    try:
+        server.bind(path)
+    finally:
+        os.umask(old_umask)
+    server.listen(8)
+    return server
+
+
+def serve(key, salt):
+    """Answer key requests until stopped or idle for IDLE_TIMEOUT seconds."""
+    # ctypes is only needed here, so clients asking for the key don't pay for importing it
+    import ctypes
+    buffer = ctypes.create_string_buffer(key, len(key))
+    locked = _protect_process(buffer)
+    expected = salt_id(salt).encode('ascii')
+    path = socket_path()
+    server = _bind(path)
+    server.settimeout(IDLE_TIMEOUT if IDLE_TIMEOUT > 0 else None)
+    print(f"Key agent listening on {path} (memory {'locked' if locked else 'not locked'}, "
+          f"idle timeout {IDLE_TIMEOUT} s)")
+    try:
+        while True:
+            try:
+                conn, _addr = server.accept()
+            except socket.timeout:
+                print("Idle timeout, stopping")
+                return
+            with conn:
+                if _peer_uid(conn) != os.getuid():
+                    continue
+                conn.settimeout(CLIENT_TIMEOUT)
+                try:
+                    request = conn.recv(256).strip()
+                except OSError:
+                    continue
+                if request == b'PING':
+                    conn.sendall(b'OK\n')
+                elif request == b'STOP':
+                    conn.sendall(b'OK\n')
+                    return
+                elif request == b'KEY ' + expected:
+                    conn.sendall(b'OK ' + buffer.raw + b'\n')
+                else:
+                    conn.sendall(b'ERR unknown request or another salt\n')
+    finally:
+        server.close()
+        if os.path.exists(path):
+            os.remove(path)
+        ctypes.memset(buffer, 0, len(key))
+
+
+def main(argv):
+    if len(argv) != 2 or argv[1] not in ('start', 'stop', 'status'):
+        print("Usage: python key_agent.py start|stop|status")
+        return 1
+    if not supported():
+        print("The key agent needs Unix domain sockets, which this platform does not have")
+        return 1
+    if argv[1] == 'status':
+        print("running" if _request(b'PING') == b'OK' else "not running")
+        return 0
+    if argv[1] == 'stop':
+        print("stopped" if _request(b'STOP') == b'OK' else "not running")
+        return 0
+
+    import safe_data
+    if not os.path.exists(safe_data.SALT_PATH):
+        print(f"No {safe_data.SALT_PATH} here; start the agent in the application directory")
+        return 1
+    with open(safe_data.SALT_PATH, 'rb') as f:
+        salt = f.read()
+    # Derived directly: safe_data._get_key would ask the agent, i.e. ourselves
+    passphrase = os.environ.get('UM_PASSPHRASE') or safe_data.getpass('Enter passphrase for data encryption/decryption: ')
+    key = safe_data._derive_key_from_passphrase(passphrase, salt)
+    try:
+        serve(key, salt)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -1,16 +1,276 @@
 import logging
-from logging.handlers import TimedRotatingFileHandler
+from logging.handlers import TimedRotatingFileHandler, BaseRotatingHandler
 import os
 import base64
-from safe_data import encrypt_data, public_key, decrypt_data, private_key
+import atexit
+import queue
+import signal
+import threading
+import time
+from safe_data import get_cipher, encrypt_many, blind_index
+import log_index
+
+# Settings (override through the environment or configure())
+# In async mode log_activity only queues the entry; a background thread encrypts and writes batches
+ASYNC = os.environ.get('UM_LOG_ASYNC', '1') != '0'
+BATCH_SIZE = int(os.environ.get('UM_LOG_BATCH_SIZE', '256'))
+FLUSH_INTERVAL = float(os.environ.get('UM_LOG_FLUSH_INTERVAL', '0.5'))
+# Convert each rotated log to a block-encrypted segment (see log_segments) when it rolls over
+SEGMENTS = os.environ.get('UM_LOG_SEGMENTS', '0') == '1'
+
+_queue = queue.Queue()
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def configure(async_mode=None, batch_size=None, flush_interval=None):
+    """Change the logging mode. Entries already queued are written first."""
+    global ASYNC, BATCH_SIZE, FLUSH_INTERVAL
+    flush()
+    if async_mode is not None:
+        ASYNC = bool(async_mode)
+    if batch_size is not None:
+        BATCH_SIZE = max(1, int(batch_size))
+    if flush_interval is not None:
+        FLUSH_INTERVAL = float(flush_interval)
+
+
+def _exit_on_signal(signum, frame):
+    # Unwind normally so atexit flushes the queue; flushing from inside the handler could deadlock on the queue's lock
+    raise SystemExit(128 + signum)
+
+
+def _install_signal_handlers():
+    if threading.current_thread() is not threading.main_thread():
+        return
+    for name in ('SIGTERM', 'SIGHUP'):
+        signum = getattr(signal, name, None)
+        if signum is not None and signal.getsignal(signum) == signal.SIG_DFL:
+            signal.signal(signum, _exit_on_signal)
+
+
+def _start_writer():
+    global _writer
+    with _writer_lock:
+        if _writer is None or not _writer.is_alive():
+            _writer = threading.Thread(target=_write_loop, name='audit-log-writer', daemon=True)
+            _writer.start()
+            _install_signal_handlers()
+
+
+def _user_key(username):
+    """Key of a username in the suspicious-event index and watermarks: its keyed blind index, never the name."""
+    return blind_index(username or '')
+
+
+def _line_user_key(line):
+    _ts, _level, decrypted = decrypt_log_line(line)
+    return bytes.fromhex(_user_key(decrypted.split(" - ", 1)[0]))
+
+
+class IndexedFileHandler(TimedRotatingFileHandler):
+    """TimedRotatingFileHandler that keeps the sidecar indexes of log_index up to date."""
+
+    def _open(self):
+        # newline='': the offsets count one byte per '\n', so no '\r\n' translation (as on Windows)
+        stream = open(self.baseFilename, self.mode, encoding=self.encoding, errors=self.errors, newline='')
+        # Repairs indexes of logs written before the index existed or cut short by a crash
+        log_index.ensure(self.baseFilename)
+        log_index.backfill_suspicious(self.baseFilename, log_index.rotated_files(self.baseFilename), _line_user_key)
+        return stream
+
+    def emit(self, record):
+        try:
+            if self.shouldRollover(record):
+                self.doRollover()
+            self.write_lines([self.format(record)], [record])
+        except Exception:
+            self.handleError(record)
+
+    def write_lines(self, lines, records):
+        """Append formatted lines with one write and index them. The caller holds the handler lock."""
+        if self.stream is None:
+            self.stream = self._open()
+        self.stream.flush()
+        position = os.path.getsize(self.baseFilename)
+        offsets = []
+        chunks = []
+        for line in lines:
+            chunk = line + self.terminator
+            offsets.append(position)
+            position += len(chunk.encode('utf-8'))
+            chunks.append(chunk)
+        self.stream.write("".join(chunks))
+        self.stream.flush()
+        log_index.append(self.baseFilename, offsets)
+        log_index.record_suspicious(os.path.dirname(self.baseFilename), [
+            (record.created, offset, bytes.fromhex(_user_key(getattr(record, 'audit_user', ''))))
+            for record, offset in zip(records, offsets) if record.levelno >= logging.WARNING
+        ])
+
+    def rotate(self, source, dest):
+        super().rotate(source, dest)
+        log_index.move(source, dest)
+        if source == self.baseFilename:
+            log_index.assign_rotated(os.path.dirname(self.baseFilename), dest.rsplit('.', 1)[-1])
+            self.rotated_path = dest
+
+    def doRollover(self):
+        self.rotated_path = None
+        super().doRollover()
+        if SEGMENTS and self.rotated_path and os.path.exists(self.rotated_path):
+            convert_rotated_log(self.rotated_path)
+        log_index.prune(os.path.dirname(self.baseFilename))
+        log_index.compact_suspicious(os.path.dirname(self.baseFilename))
+
+
+def convert_rotated_log(path):
+    """Replace a rotated text log with a block-encrypted segment, moving its suspicious-event references along."""
+    import log_segments
+    base = path.rsplit('.', 1)[0]
+    log_index.backfill_suspicious(base, log_index.rotated_files(base), _line_user_key)
+    offsets = log_segments.convert(path)
+    log_index.remap_suspicious(os.path.dirname(path), path.rsplit('.', 1)[-1], offsets)
+    log_index.prune(os.path.dirname(path))
+
+
+def open_log_view(file_path, persist=False):
+    """(view, transform) for a text log or, if only that exists, its segment; transform gives (timestamp, level, message)."""
+    import log_segments
+    if not os.path.exists(file_path) and os.path.exists(file_path + log_segments.EXTENSION):
+        return log_segments.SegmentReader(file_path + log_segments.EXTENSION), split_log_line
+    return log_index.LogView(file_path, persist=persist), decrypt_log_line
+
+
+def _write_records(handler, records):
+    """Write records through handler with a single write, rolling the file over first if it is due."""
+    if not isinstance(handler, logging.StreamHandler):
+        for record in records:
+            handler.handle(record)
+        return
+    records = [record for record in records if record.levelno >= handler.level]
+    if not records:
+        return
+    handler.acquire()
+    try:
+        if isinstance(handler, BaseRotatingHandler) and handler.shouldRollover(records[0]):
+            handler.doRollover()
+        lines = [handler.format(record) for record in records]
+        if isinstance(handler, IndexedFileHandler):
+            handler.write_lines(lines, records)
+        else:
+            if handler.stream is None:
+                handler.stream = handler._open()
+            handler.stream.write("".join(line + handler.terminator for line in lines))
+            handler.flush()
+    finally:
+        handler.release()
+
+
+def _write_batch(batch):
+    tokens = encrypt_many([raw_entry for _logger, _level, _username, raw_entry, _created in batch])
+    by_logger = {}
+    for (logger, level, username, _raw_entry, created), token in zip(batch, tokens):
+        record = logger.makeRecord(logger.name, level, __file__, 0, base64.b64encode(token).decode('ascii'), None, None,
+                                   extra={'audit_user': username})
+        # Keep the time of the log_activity call, not of the write
+        record.created = created
+        record.msecs = (created - int(created)) * 1000
+        by_logger.setdefault(logger, []).append(record)
+    for logger, records in by_logger.items():
+        for handler in logger.handlers:
+            _write_records(handler, records)
+
+
+def _write_loop():
+    batch = []
+    deadline = None
+    while True:
+        timeout = max(0.0, deadline - time.monotonic()) if batch else None
+        try:
+            item = _queue.get(timeout=timeout)
+        except queue.Empty:
+            item = None
+
+        waiter = None
+        if isinstance(item, threading.Event):
+            waiter = item
+        elif item is not None:
+            if not batch:
+                deadline = time.monotonic() + FLUSH_INTERVAL
+            batch.append(item)
+
+        if batch and (item is None or waiter or len(batch) >= BATCH_SIZE):
+            try:
+                _write_batch(batch)
+            except Exception as e:
+                print(f"Writing audit log entries failed: {e}")
+            batch = []
+        if waiter:
+            waiter.set()
+
+
+def flush(timeout=5.0):
+    """Block until every entry queued so far has been written."""
+    if _writer is None or not _writer.is_alive():
+        return
+    done = threading.Event()
+    _queue.put(done)
+    done.wait(timeout)
+
+
+atexit.register(flush)
+
+
+def split_log_line(line):
+    """Split an already decrypted log line into (timestamp, level, message)."""
+    parts = line.split(" - ", 2)
+    while len(parts) < 3:
+        parts.append('')
+    return parts[0], parts[1], parts[2]
+
+
+UNREADABLE = "<unreadable log entry>"
+
+
+def decrypt_log_line(line, strict=False):
+    """Split a log line into (timestamp, level, decrypted message).
+
+    A message that can't be decrypted reads as UNREADABLE, or raises ValueError with strict=True.
+    """
+    parts = line.split(" - ", 2)
+    decrypted = UNREADABLE
+    if len(parts) >= 3:
+        b64msg = parts[2].strip()
+        try:
+            try:
+                ciphertext = base64.b64decode(b64msg)
+            except Exception:
+                try:
+                    import ast as _ast
+                    ciphertext = _ast.literal_eval(b64msg)
+                except Exception:
+                    ciphertext = None
+
+            if ciphertext:
+                decrypted = get_cipher().decrypt(ciphertext).decode('utf-8')
+            else:
+                decrypted = b64msg
+        except Exception:
+            decrypted = UNREADABLE
+    if strict and decrypted is UNREADABLE:
+        raise ValueError("unreadable log entry")
+
+    ts = parts[0] if len(parts) > 0 else ''
+    level = parts[1] if len(parts) > 1 else ''
+    return ts, level, decrypted
+
 
 class logmanager:
-    unread_suspicious_count = 0
 
     def __init__(self, log_dir="logs", log_file="scooterfleet.log"):
         self.log_dir = log_dir
         self.log_file_path = os.path.join(log_dir, log_file)
-        self.unread_suspicious_count = 0 
         
         if not os.path.exists(self.log_dir):
             os.makedirs(self.log_dir)
@@ -19,7 +279,8 @@ class logmanager:
         if not self.logger.hasHandlers():
             self.logger.setLevel(logging.INFO)
 
-            handler = TimedRotatingFileHandler(self.log_file_path, when='midnight', interval=1, backupCount=30)
+            handler = IndexedFileHandler(self.log_file_path, when='midnight', interval=1, backupCount=30,
+                                         encoding='utf-8')
             handler.setLevel(logging.INFO)
 
             formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
@@ -29,27 +290,93 @@ class logmanager:
 
     def log_activity(self, username, description, additional_info=None, suspicious='No'):
         raw_entry = f"{username} - {description} - {additional_info or ''} - Suspicious: {suspicious}"
-        ciphertext = encrypt_data(public_key(), raw_entry)
+        if ASYNC:
+            level = logging.WARNING if suspicious == 'Yes' else logging.INFO
+            _queue.put((self.logger, level, str(username), raw_entry, time.time()))
+            _start_writer()
+            return
+
+        ciphertext = get_cipher().encrypt(raw_entry.encode('utf-8'))
         try:
             b64 = base64.b64encode(ciphertext).decode('ascii')
         except Exception:
             b64 = repr(ciphertext)
 
         if suspicious == 'Yes':
-            self.logger.warning(b64)
-            logmanager.unread_suspicious_count += 1
+            self.logger.warning(b64, extra={'audit_user': str(username)})
         else:
-            self.logger.info(b64)
+            self.logger.info(b64, extra={'audit_user': str(username)})
+
+    def flush(self):
+        flush()
+
+    def unread_suspicious(self, username):
+        """Suspicious entries logged since username last read them (two small file reads, no log scan)."""
+        flush()
+        return log_index.suspicious_count(self.log_dir) - log_index.read_watermark(self.log_dir, _user_key(username))
 
-    def show_notifications(self):
-        if logmanager.unread_suspicious_count > 0:
-            print(f"\n*** You have {logmanager.unread_suspicious_count} unread suspicious activity logs. ***\n")
+    def mark_suspicious_read(self, username):
+        log_index.set_watermark(self.log_dir, _user_key(username), log_index.suspicious_count(self.log_dir))
+
+    def show_notifications(self, username):
+        unread = self.unread_suspicious(username)
+        if unread > 0:
+            print(f"\n*** You have {unread} unread suspicious activity logs. ***\n")
         else:
             print("\nNo unread suspicious acitivities.\n")
 
+    def see_suspicious(self, username, page_size=20):
+        """Page through suspicious entries only, starting at the first one username has not read."""
+        from ui_helpers import prompt_with_back, clear as ui_clear
+        flush()
+        total = log_index.suspicious_count(self.log_dir)
+        seen = log_index.read_watermark(self.log_dir, _user_key(username))
+        pages = max(1, (total + page_size - 1) // page_size)
+        page = min(seen, max(total - 1, 0)) // page_size
+        while True:
+            ui_clear()
+            for number, _created, rotated, offset, _user in log_index.suspicious_events(self.log_dir, page * page_size, page_size):
+                file_path = f"{self.log_file_path}.{rotated}" if rotated else self.log_file_path
+                marker = "NEW " if number >= seen else ""
+                try:
+                    if os.path.exists(file_path) or not rotated:
+                        with open(file_path, 'rb') as log_file:
+                            log_file.seek(offset)
+                            ts, level, decrypted = decrypt_log_line(log_file.readline().decode('utf-8', errors='replace'))
+                    else:
+                        # Converted to a segment: the offset is the entry number
+                        view, transform = open_log_view(file_path)
+                        with view:
+                            ts, level, decrypted = transform(view.line(offset))
+                except FileNotFoundError:
+                    print(f"{marker}<log file {os.path.basename(file_path)} is no longer kept>")
+                    continue
+                print(f"{marker}{ts} - {level} - {decrypted}")
+            if total == 0:
+                print("No suspicious activity logged.")
+
+            print(f"\n--- Page {page + 1} / {pages} ---\n")
+            print("1. Next page")
+            print("2. Previous page")
+            print("3. Go back")
+            choice = prompt_with_back("Choose an option (1/2/3): ")
+            if choice is None or choice == "3":
+                self.mark_suspicious_read(username)
+                break
+            if choice == "1":
+                if page < pages - 1:
+                    page += 1
+            elif choice == "2":
+                if page > 0:
+                    page -= 1
+            else:
+                ui_clear()
+                print("Invalid input")
+
         
-    def see_logs(self, date=None):
+    def see_logs(self, date=None, username=None):
 
+        flush()
         file_path = self.log_file_path
         if date:
             file_path = f'{self.log_file_path}.{date}'
@@ -57,42 +384,16 @@ class logmanager:
         import um_members
 
         try:
-            with open(file_path, 'r') as file:
-                lines = file.readlines()
-                total_lines = len(lines)
+            # Rotated logs are never written again, so a missing index can be saved for next time
+            view, transform = open_log_view(file_path, persist=bool(date))
+            with view:
+                total_lines = len(view)
                 pages = (total_lines + 19) // 20
 
                 page = 0
                 while True:
                     um_members.clear()
-                    start_index = page * 20
-                    end_index = min((page + 1) * 20, total_lines)
-                    current_page_lines = lines[start_index:end_index]
-
-                    for line in current_page_lines:
-                        parts = line.split(" - ", 2)
-                        decrypted = "<unreadable log entry>"
-                        if len(parts) >= 3:
-                            b64msg = parts[2].strip()
-                            try:
-                                try:
-                                    ciphertext = base64.b64decode(b64msg)
-                                except Exception:
-                                    try:
-                                        import ast as _ast
-                                        ciphertext = _ast.literal_eval(b64msg)
-                                    except Exception:
-                                        ciphertext = None
-
-                                if ciphertext:
-                                    decrypted = decrypt_data(private_key(), ciphertext)
-                                else:
-                                    decrypted = b64msg
-                            except Exception:
-                                decrypted = "<unreadable log entry>"
-
-                        ts = parts[0] if len(parts) > 0 else ''
-                        level = parts[1] if len(parts) > 1 else ''
+                    for ts, level, decrypted in view.page(page, 20, transform):
                         print(str(ts), "- ", end="")
                         print(str(level), "- ", end="")
                         print(decrypted)
@@ -106,7 +407,8 @@ class logmanager:
 
                     choice = prompt_with_back("Choose an option (1/2/3): ")
                     if choice is None:
-                        logmanager.unread_suspicious_count = 0
+                        if username:
+                            self.mark_suspicious_read(username)
                         break
 
                     if choice == "1":
@@ -116,11 +418,36 @@ class logmanager:
                         if page > 0:
                             page -= 1
                     elif choice == "3":
-                        logmanager.unread_suspicious_count = 0
+                        if username:
+                            self.mark_suspicious_read(username)
                         break
                     else:
                         ui_clear()
                         print("Invalid input")
                     
         except FileNotFoundError:
-            print(f"The file {file_path} does not exist.")
\ No newline at end of file
+            print(f"The file {file_path} does not exist.")
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def shared_logmanager():
+    """The logmanager the application logs through, created on first use."""
+    global _shared
+    if _shared is None:
+        with _shared_lock:
+            if _shared is None:
+                _shared = logmanager()
+    return _shared
+
+
+class _SharedLogmanager:
+    # What modules bind at import time; the log directory and file handler are only set up
+    # when something is first logged or looked up
+    def __getattr__(self, name):
+        return getattr(shared_logmanager(), name)
+
+
+log_instance = _SharedLogmanager()
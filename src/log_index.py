@@ -0,0 +1,403 @@
+"""Sidecar indexes for the audit log: line offsets, page reads through mmap, and suspicious events.
+
+For every log file `logs/<name>` the index `logs/.index/<name>.idx` holds the byte offset of
+the start of each line as a little-endian uint64, so line N is found with one 8-byte read.
+The writer (log_config.IndexedFileHandler) appends offsets as it writes lines and moves the
+index along with the file on rollover. The index lives in a subdirectory so the rotating
+handler's backupCount clean-up never sees it.
+
+`logs/.index/suspicious.idx` lists every warning-level (suspicious) entry as a fixed-size
+record, so counting them, and finding the Nth one, takes a single stat or seek. Per-admin
+read watermarks (record counts) live next to it in `suspicious.read`. On rollover the events
+every admin has read are dropped from the front and the watermarks moved down to match.
+"""
+import json
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+OFFSET = struct.Struct('<Q')
+INDEX_DIR = '.index'
+# `<log>.<date>`, or `<log>.<date>.seg` once converted to a block-encrypted segment (see log_segments)
+ROTATED_SUFFIX = re.compile(r'^\d{4}-\d{2}-\d{2}(\.seg)?$')
+
+# Suspicious event: unix time, byte offset of the line, rotated-file date ('' while in the active file),
+# and the first 16 bytes of the username's keyed blind index (the log itself stays the only plaintext)
+SUSPICIOUS = struct.Struct('<dQ10s16s')
+SUSPICIOUS_FILE = 'suspicious.idx'
+WATERMARK_FILE = 'suspicious.read'
+
+# Decrypted pages kept by page(); a page of an append-only log never changes once it is full
+PAGE_CACHE_SIZE = int(os.environ.get('UM_LOG_PAGE_CACHE', '32'))
+
+_page_cache = OrderedDict()
+_page_cache_lock = threading.Lock()
+_watermark_lock = threading.Lock()
+
+
+def index_path(log_path):
+    directory, name = os.path.split(log_path)
+    return os.path.join(directory, INDEX_DIR, name + '.idx')
+
+
+def _scan_offsets(data, start, end):
+    """Offsets of the lines that start in data[start:end]."""
+    offsets = []
+    position = start
+    while position < end:
+        offsets.append(position)
+        newline = data.find(b'\n', position, end)
+        if newline == -1:
+            break
+        position = newline + 1
+    return offsets
+
+
+def append(log_path, offsets):
+    """Record the start offsets of lines just appended to log_path."""
+    if not offsets:
+        return
+    path = index_path(log_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'ab') as index_file:
+        index_file.write(b''.join(OFFSET.pack(offset) for offset in offsets))
+
+
+def rebuild(log_path):
+    """Rewrite the index of log_path from the file itself. Returns the number of lines."""
+    path = index_path(log_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    offsets = []
+    if os.path.exists(log_path) and os.path.getsize(log_path) > 0:
+        with open(log_path, 'rb') as log_file, mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            offsets = _scan_offsets(data, 0, len(data))
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as index_file:
+        index_file.write(b''.join(OFFSET.pack(offset) for offset in offsets))
+    os.replace(temp_path, path)
+    return len(offsets)
+
+
+def ensure(log_path):
+    """Rebuild the index if it does not describe log_path up to its current end.
+
+    Cheap when the index is in order: only the last indexed line is read.
+    """
+    size = os.path.getsize(log_path) if os.path.exists(log_path) else 0
+    path = index_path(log_path)
+    index_size = os.path.getsize(path) if os.path.exists(path) else 0
+    if size == 0:
+        if index_size:
+            rebuild(log_path)
+        return
+    if index_size == 0 or index_size % OFFSET.size:
+        rebuild(log_path)
+        return
+    with open(path, 'rb') as index_file:
+        index_file.seek(index_size - OFFSET.size)
+        (last,) = OFFSET.unpack(index_file.read(OFFSET.size))
+    with open(log_path, 'rb') as log_file:
+        log_file.seek(last)
+        tail = log_file.read(size - last) if last < size else b''
+    # In order if the last indexed line is the last line of the file and ends with a newline
+    if last >= size or tail.find(b'\n') != len(tail) - 1:
+        rebuild(log_path)
+
+
+def move(source, dest):
+    """Move the index of a log file that was renamed from source to dest."""
+    if os.path.exists(index_path(source)):
+        os.makedirs(os.path.dirname(index_path(dest)), exist_ok=True)
+        os.replace(index_path(source), index_path(dest))
+
+
+def rotated_files(log_path, start_date=None):
+    """Rotated files `<log>.<date>` of log_path, oldest first; with start_date, only those dated on or after it."""
+    directory, base = os.path.split(log_path)
+    rotated = []
+    if os.path.isdir(directory or '.'):
+        for name in os.listdir(directory or '.'):
+            suffix = name[len(base) + 1:]
+            if name.startswith(base + '.') and ROTATED_SUFFIX.match(suffix):
+                if start_date is None or suffix[:10] >= start_date:
+                    rotated.append((suffix, os.path.join(directory, name)))
+    return [path for _suffix, path in sorted(rotated)]
+
+
+def prune(log_dir):
+    """Remove indexes whose log file no longer exists."""
+    directory = os.path.join(log_dir, INDEX_DIR)
+    if not os.path.isdir(directory):
+        return
+    for name in os.listdir(directory):
+        if name == SUSPICIOUS_FILE:
+            continue
+        if name.endswith('.idx') and not os.path.exists(os.path.join(log_dir, name[:-4])):
+            os.remove(os.path.join(directory, name))
+
+
+class LogView:
+    """Random access to the lines of a log file through mmap and its sidecar index.
+
+    Opening and reading a page costs the same whatever the size of the file. Lines written
+    after the index was last updated are picked up by scanning only the unindexed tail;
+    with persist=True (for files nobody is writing to any more) a missing index is saved.
+    """
+
+    def __init__(self, log_path, persist=False):
+        self.path = log_path
+        self._log_file = open(log_path, 'rb')
+        size = os.fstat(self._log_file.fileno()).st_size
+        self._data = mmap.mmap(self._log_file.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+        self._key = (os.path.abspath(log_path), os.fstat(self._log_file.fileno()).st_ino)
+
+        self._index = b''
+        self._index_file = None
+        index = index_path(log_path)
+        if not os.path.exists(index) and persist and size:
+            rebuild(log_path)
+        if os.path.exists(index) and os.path.getsize(index) >= OFFSET.size:
+            self._index_file = open(index, 'rb')
+            self._index = mmap.mmap(self._index_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        indexed = len(self._index) // OFFSET.size
+        # Trust the index only as far as the mapped file reaches; scan whatever follows it
+        while indexed and self._indexed_offset(indexed - 1) >= len(self._data):
+            indexed -= 1
+        self._indexed = indexed
+        tail_start = 0
+        if indexed:
+            last = self._indexed_offset(indexed - 1)
+            newline = self._data.find(b'\n', last)
+            tail_start = len(self._data) if newline == -1 else newline + 1
+        self._tail = _scan_offsets(self._data, tail_start, len(self._data))
+
+    def _indexed_offset(self, number):
+        return OFFSET.unpack_from(self._index, number * OFFSET.size)[0]
+
+    def _offset(self, number):
+        if number < self._indexed:
+            return self._indexed_offset(number)
+        return self._tail[number - self._indexed]
+
+    def __len__(self):
+        return self._indexed + len(self._tail)
+
+    def line(self, number):
+        start = self._offset(number)
+        end = self._offset(number + 1) if number + 1 < len(self) else len(self._data)
+        return self._data[start:end].decode('utf-8', errors='replace').rstrip('\r\n')
+
+    def byte_range(self, start, count):
+        """(first byte, end byte) of lines start..start+count."""
+        end_line = start + count
+        end = self._offset(end_line) if end_line < len(self) else len(self._data)
+        return self._offset(start), end
+
+    def lines(self, start, count):
+        return [self.line(number) for number in range(start, min(start + count, len(self)))]
+
+    def page(self, number, size, transform=None):
+        """Lines of page `number` (0-based), each passed through transform. Full pages are cached."""
+        start = number * size
+        full = start + size <= len(self)
+        key = (self._key, size, number, transform)
+        if full:
+            with _page_cache_lock:
+                if key in _page_cache:
+                    _page_cache.move_to_end(key)
+                    return _page_cache[key]
+        lines = self.lines(start, size)
+        if transform:
+            lines = [transform(line) for line in lines]
+        if full:
+            with _page_cache_lock:
+                _page_cache[key] = lines
+                while len(_page_cache) > PAGE_CACHE_SIZE:
+                    _page_cache.popitem(last=False)
+        return lines
+
+    def close(self):
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+        if isinstance(self._index, mmap.mmap):
+            self._index.close()
+        if self._index_file:
+            self._index_file.close()
+        self._log_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _suspicious_path(log_dir):
+    return os.path.join(log_dir, INDEX_DIR, SUSPICIOUS_FILE)
+
+
+def record_suspicious(log_dir, events):
+    """Append (created, offset, user_key) events for suspicious lines just written to the active log."""
+    if not events:
+        return
+    path = _suspicious_path(log_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'ab') as index_file:
+        index_file.write(b''.join(SUSPICIOUS.pack(created, offset, b'', user_key[:16]) for created, offset, user_key in events))
+
+
+def suspicious_count(log_dir):
+    path = _suspicious_path(log_dir)
+    return os.path.getsize(path) // SUSPICIOUS.size if os.path.exists(path) else 0
+
+
+def assign_rotated(log_dir, suffix):
+    """Point the events of the active log at its rotated name `<log>.<suffix>`.
+
+    Only the events since the previous rollover are touched; they are the tail of the file.
+    """
+    path = _suspicious_path(log_dir)
+    count = suspicious_count(log_dir)
+    if not count:
+        return
+    name = suffix.encode('ascii')[:10]
+    with open(path, 'r+b') as index_file:
+        number = count - 1
+        while number >= 0:
+            index_file.seek(number * SUSPICIOUS.size)
+            created, offset, rotated, user_key = SUSPICIOUS.unpack(index_file.read(SUSPICIOUS.size))
+            if rotated.rstrip(b'\0'):
+                break
+            index_file.seek(number * SUSPICIOUS.size)
+            index_file.write(SUSPICIOUS.pack(created, offset, name, user_key))
+            number -= 1
+
+
+def suspicious_events(log_dir, start, count):
+    """Events start..start+count as (number, created, log file name, offset, user_key) tuples."""
+    path = _suspicious_path(log_dir)
+    total = suspicious_count(log_dir)
+    start = max(0, start)
+    events = []
+    if start >= total:
+        return events
+    with open(path, 'rb') as index_file:
+        index_file.seek(start * SUSPICIOUS.size)
+        data = index_file.read(min(count, total - start) * SUSPICIOUS.size)
+    for i in range(len(data) // SUSPICIOUS.size):
+        created, offset, rotated, user_key = SUSPICIOUS.unpack_from(data, i * SUSPICIOUS.size)
+        events.append((start + i, created, rotated.rstrip(b'\0').decode('ascii'), offset, user_key))
+    return events
+
+
+def remap_suspicious(log_dir, suffix, offsets):
+    """Replace the offsets of the events in `<log>.<suffix>` using offsets ({old offset: new position})."""
+    path = _suspicious_path(log_dir)
+    if not os.path.exists(path):
+        return
+    name = suffix.encode('ascii')[:10]
+    with open(path, 'r+b') as index_file:
+        data = bytearray(index_file.read())
+        for start in range(0, len(data) - len(data) % SUSPICIOUS.size, SUSPICIOUS.size):
+            created, offset, rotated, user_key = SUSPICIOUS.unpack_from(data, start)
+            if rotated.rstrip(b'\0') == name and offset in offsets:
+                SUSPICIOUS.pack_into(data, start, created, offsets[offset], rotated, user_key)
+        index_file.seek(0)
+        index_file.write(data)
+
+
+def _line_time(line):
+    try:
+        return time.mktime(time.strptime(line[:19], "%Y-%m-%d %H:%M:%S"))
+    except ValueError:
+        return 0.0
+
+
+def backfill_suspicious(log_path, rotated_files, user_key_of):
+    """Build suspicious.idx from existing logs (oldest first) if it does not exist yet.
+
+    The level is in the clear, so only the warning lines are decrypted (by user_key_of(line)).
+    """
+    log_dir = os.path.dirname(log_path)
+    path = _suspicious_path(log_dir)
+    if os.path.exists(path):
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    records = []
+    for file_path in list(rotated_files) + [log_path]:
+        # Segments are only written once this index exists (log_config.convert_rotated_log makes sure)
+        if not os.path.exists(file_path) or file_path.endswith('.seg'):
+            continue
+        suffix = '' if file_path == log_path else file_path.rsplit('.', 1)[-1]
+        with open(file_path, 'rb') as log_file:
+            offset = 0
+            for raw in log_file:
+                line = raw.decode('utf-8', errors='replace')
+                if line.split(" - ", 2)[1:2] == ['WARNING']:
+                    records.append(SUSPICIOUS.pack(_line_time(line), offset, suffix.encode('ascii')[:10], user_key_of(line)[:16]))
+                offset += len(raw)
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as index_file:
+        index_file.write(b''.join(records))
+    os.replace(temp_path, path)
+
+
+def _watermark_path(log_dir):
+    return os.path.join(log_dir, INDEX_DIR, WATERMARK_FILE)
+
+
+def _read_watermarks(log_dir):
+    try:
+        with open(_watermark_path(log_dir)) as watermark_file:
+            return json.load(watermark_file)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def _write_watermarks(log_dir, watermarks):
+    path = _watermark_path(log_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as watermark_file:
+        json.dump(watermarks, watermark_file)
+    os.replace(temp_path, path)
+
+
+def read_watermark(log_dir, user_key):
+    """Number of suspicious events the user has seen."""
+    return _read_watermarks(log_dir).get(user_key, 0)
+
+
+def set_watermark(log_dir, user_key, seen):
+    with _watermark_lock:
+        watermarks = _read_watermarks(log_dir)
+        watermarks[user_key] = max(int(seen), watermarks.get(user_key, 0))
+        _write_watermarks(log_dir, watermarks)
+
+
+def compact_suspicious(log_dir):
+    """Drop the events every admin with a watermark has seen, and renumber the watermarks. Returns the number dropped.
+
+    Called on rollover, so suspicious.idx grows with the unread events rather than with the age of the log.
+    """
+    path = _suspicious_path(log_dir)
+    with _watermark_lock:
+        watermarks = _read_watermarks(log_dir)
+        drop = min(min(watermarks.values(), default=0), suspicious_count(log_dir))
+        if drop <= 0:
+            return 0
+        # Watermarks first: a crash in between shows some events as unread again rather than hiding new ones
+        _write_watermarks(log_dir, {key: max(0, seen - drop) for key, seen in watermarks.items()})
+        with open(path, 'rb') as index_file:
+            index_file.seek(drop * SUSPICIOUS.size)
+            data = index_file.read()
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as index_file:
+            index_file.write(data)
+        os.replace(temp_path, path)
+    return drop
@@ -0,0 +1,226 @@
+"""Search the audit log across the active file and every rotated `scooterfleet.log.<date>`.
+
+Files are cut into line ranges (through log_index), or block ranges for segments, that are
+filtered and decrypted on the crypto_pool process pool; the per-file results are merged in
+timestamp order and streamed, so the first page shows as soon as the first ranges are done.
+Entries are (timestamp, level, username, description, additional_info, suspicious) tuples.
+"""
+import base64
+import datetime
+import heapq
+import os
+import time
+from collections import deque
+
+import crypto_pool
+import log_index
+import log_segments
+from acl import require_role
+from log_config import log_instance
+from ui_helpers import clear as ui_clear, prompt_with_back
+
+# Lines per task sent to the pool, and tasks kept queued ahead per file
+CHUNK_LINES = int(os.environ.get('UM_LOG_QUERY_CHUNK', '2000'))
+AHEAD = 2
+
+def log_files(log_path, start_date=None):
+    """The rotated files of log_path, oldest first, then log_path itself.
+
+    A file `<log>.<date>` only holds entries written before the end of that date, so with a
+    start_date the files that end before it are skipped.
+    """
+    files = log_index.rotated_files(log_path, start_date)
+    if os.path.exists(log_path):
+        files.append(log_path)
+    return files
+
+
+def _parse_entry(text):
+    body, _sep, flag = text.rpartition(" - Suspicious: ")
+    parts = body.split(" - ", 2)
+    while len(parts) < 3:
+        parts.append('')
+    return parts[0], parts[1], parts[2], flag
+
+
+def _matches(lines, filters, decrypt=None):
+    """Entries among lines ("<timestamp> - <LEVEL> - <message>") that pass filters.
+
+    decrypt(message) turns the message into plaintext, or the message already is plaintext.
+    """
+    start_date, end_date, username, text, suspicious = filters
+    for line in lines:
+        parts = line.split(" - ", 2)
+        if len(parts) < 3:
+            continue
+        timestamp, level, message = parts
+        # Date and suspicious flag are in the clear, so those filters cost no decryption
+        day = timestamp[:10]
+        if (start_date and day < start_date) or (end_date and day > end_date):
+            continue
+        if suspicious is not None and (level.strip() == 'WARNING') != suspicious:
+            continue
+        if decrypt:
+            try:
+                message = decrypt(message)
+            except Exception:
+                continue
+        user, description, additional_info, flag = _parse_entry(message)
+        if username and user.lower() != username:
+            continue
+        if text and text not in description.lower() and text not in additional_info.lower():
+            continue
+        yield timestamp, level.strip(), user, description, additional_info, flag
+
+
+def _query_range(path, start, end, filters):
+    cipher = crypto_pool.worker_cipher()
+    with open(path, 'rb') as log_file:
+        log_file.seek(start)
+        data = log_file.read(end - start)
+    lines = data.decode('utf-8', errors='replace').splitlines()
+    return list(_matches(lines, filters, lambda message: cipher.decrypt(base64.b64decode(message.strip())).decode('utf-8')))
+
+
+def _query_blocks(path, first, last, filters):
+    with log_segments.SegmentReader(path, crypto_pool.worker_key()) as reader:
+        return list(_matches((line for sequence in range(first, last) for line in reader.block(sequence)), filters))
+
+
+def _ranges(path):
+    """Tasks for one file as (function, start, end), and the number of entries in it."""
+    if path.endswith(log_segments.EXTENSION):
+        with log_segments.SegmentReader(path) as reader:
+            step = max(1, CHUNK_LINES // reader.block_entries)
+            blocks = len(reader.index)
+            return [(_query_blocks, first, min(first + step, blocks)) for first in range(0, blocks, step)], len(reader)
+    # Rotated files are never written again, so their index can be saved if it is missing
+    with log_index.LogView(path, persist=bool(log_index.ROTATED_SUFFIX.match(path.rsplit('.', 1)[-1]))) as view:
+        return [(_query_range,) + view.byte_range(start, CHUNK_LINES) for start in range(0, len(view), CHUNK_LINES)], len(view)
+
+
+def _serial(path, ranges, filters):
+    for task, start, end in ranges:
+        yield from task(path, start, end, filters)
+
+
+def _pooled(path, ranges, filters):
+    # Submits the first ranges right away; later ones are queued as results are consumed
+    pending = deque()
+    remaining = iter(ranges)
+
+    def top_up():
+        while len(pending) < AHEAD:
+            next_range = next(remaining, None)
+            if next_range is None:
+                return
+            task, start, end = next_range
+            pending.append(crypto_pool.submit(task, path, start, end, filters))
+
+    top_up()
+
+    def entries():
+        try:
+            while pending:
+                future = pending.popleft()
+                top_up()
+                yield from future.result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+    return entries()
+
+
+def query(log_path, start_date=None, end_date=None, username=None, text=None, suspicious=None):
+    """Yield matching entries from all log files in timestamp order.
+
+    Dates are 'YYYY-MM-DD' strings and inclusive; username matches exactly and text as a
+    substring of the description or additional info (both case-insensitive); suspicious is
+    True, False or None for either.
+    """
+    filters = (start_date, end_date, (username or '').lower() or None, (text or '').lower() or None, suspicious)
+    plans = []
+    total_lines = 0
+    for path in log_files(log_path, start_date):
+        ranges, lines = _ranges(path)
+        plans.append((path, ranges))
+        total_lines += lines
+
+    if crypto_pool.WORKERS <= 1 or total_lines < crypto_pool.PARALLEL_THRESHOLD:
+        streams = [_serial(path, ranges, filters) for path, ranges in plans]
+    else:
+        streams = [_pooled(path, ranges, filters) for path, ranges in plans]
+    merged = heapq.merge(*streams, key=lambda entry: entry[0])
+    try:
+        yield from merged
+    finally:
+        for stream in streams:
+            stream.close()
+
+
+def show_results(entries, page_size=20):
+    """Page through an entry iterator, pulling only as many entries as have been shown."""
+    loaded = []
+    exhausted = False
+    page = 0
+    while True:
+        ui_clear()
+        while not exhausted and len(loaded) < (page + 1) * page_size + 1:
+            try:
+                loaded.append(next(entries))
+            except StopIteration:
+                exhausted = True
+        current = loaded[page * page_size:(page + 1) * page_size]
+        if not current:
+            print("No matching log entries")
+        for timestamp, level, user, description, additional_info, flag in current:
+            print(f"{timestamp} - {level} - {user} - {description} - {additional_info} - Suspicious: {flag}")
+
+        more = len(loaded) > (page + 1) * page_size
+        total = str(len(loaded)) if exhausted else f"{len(loaded)}+"
+        print(f"\n--- Page {page + 1} ({total} matches) ---\n")
+        print("1. Next page")
+        print("2. Previous page")
+        print("3. Go back")
+        choice = prompt_with_back("Choose an option (1/2/3): ")
+        if choice is None or choice == "3":
+            entries.close()
+            return
+        if choice == "1":
+            if more:
+                page += 1
+        elif choice == "2":
+            if page > 0:
+                page -= 1
+        else:
+            print("Invalid input")
+            time.sleep(1)
+
+
+def _prompt_date(prompt):
+    while True:
+        value = input(prompt).strip()
+        if value == "":
+            return None
+        try:
+            datetime.datetime.strptime(value, "%Y-%m-%d")
+            return value
+        except ValueError:
+            print("Invalid date format. Expected YYYY-MM-DD.")
+
+
+@require_role('system_admin')
+def query_logs_menu(username, log_path=None):
+    print("\n--- Search logs ---")
+    print("Leave a field empty to not filter on it.")
+    start_date = _prompt_date("From date (yyyy-mm-dd): ")
+    end_date = _prompt_date("To date (yyyy-mm-dd): ")
+    user = input("Username: ").strip()
+    text = input("Description contains: ").strip()
+    flag = input("Suspicious only? (y/n, empty for all): ").strip().lower()
+    suspicious = {"y": True, "n": False}.get(flag)
+
+    log_instance.log_activity(username, "System", "Searched the logs", "No")
+    log_instance.flush()
+    show_results(query(log_path or log_instance.log_file_path, start_date, end_date, user, text, suspicious))
@@ -0,0 +1,270 @@
+"""Block-encrypted log segments: a compact, sealed format for rotated audit logs.
+
+A text log stores every entry as its own Fernet token in base64; a segment stores the same
+entries ("<timestamp> - <LEVEL> - <plaintext>") in blocks of BLOCK_ENTRIES, each block
+optionally zlib-compressed and sealed as one AES-256-GCM unit.
+
+Layout:
+    header   HEADER: magic, version, flags, entries per block, creation time
+    blocks   BLOCK header (magic, sequence number, entry count, payload length, nonce) + ciphertext
+    index    one INDEX_ENTRY (offset, first entry number, entry count) per block
+    footer   FOOTER: index offset, block count, magic
+
+A text line that could not be decrypted is stored verbatim behind the RAW flag character, so
+converting never loses it; readers show it as an unreadable entry and original() returns it.
+
+The file header and the block header are the associated data of every block, so a block that
+is moved, reordered or taken from another file fails to decrypt. The index is only a lookup
+aid: the sequence number in each block is checked against its position.
+
+Usage: python log_segments.py convert <log file> [...]   (writes <log file>.seg, removes the text log)
+       python log_segments.py verify <segment file> [...]
+"""
+import os
+import struct
+import sys
+import time
+import zlib
+from collections import OrderedDict
+
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+import safe_data
+
+MAGIC = b'UMLSEG01'
+VERSION = 1
+FLAG_ZLIB = 1
+EXTENSION = '.seg'
+
+HEADER = struct.Struct('<8sBBHd')
+BLOCK = struct.Struct('<4sQII12s')
+BLOCK_MAGIC = b'UMBK'
+INDEX_ENTRY = struct.Struct('<QQI')
+FOOTER = struct.Struct('<QI8s')
+FOOTER_MAGIC = b'UMLSEGIX'
+ENTRY_LENGTH = struct.Struct('<I')
+# Marks an entry holding the original text line instead of "<timestamp> - <LEVEL> - <plaintext>"
+RAW = '\x00'
+
+BLOCK_ENTRIES = int(os.environ.get('UM_LOG_BLOCK_ENTRIES', '256'))
+COMPRESS = os.environ.get('UM_LOG_BLOCK_COMPRESS', '1') != '0'
+
+# Decrypted blocks kept per reader
+BLOCK_CACHE_SIZE = 8
+
+
+class SegmentError(Exception):
+    pass
+
+
+def _pack_entries(entries):
+    return b''.join(ENTRY_LENGTH.pack(len(data)) + data for data in (entry.encode('utf-8') for entry in entries))
+
+
+def _unpack_entries(payload, count):
+    entries = []
+    position = 0
+    for _ in range(count):
+        (length,) = ENTRY_LENGTH.unpack_from(payload, position)
+        position += ENTRY_LENGTH.size
+        entries.append(payload[position:position + length].decode('utf-8', errors='replace'))
+        position += length
+    return entries
+
+
+def _display(entry):
+    if not entry.startswith(RAW):
+        return entry
+    import log_config
+    timestamp, level, _message = log_config.split_log_line(entry[len(RAW):])
+    return f"{timestamp} - {level} - {log_config.UNREADABLE}"
+
+
+def write_segment(path, entries, key=None, block_entries=None, compress=None):
+    """Write plaintext entries (an iterable of strings) as a sealed segment. Returns the number of entries."""
+    block_entries = block_entries or BLOCK_ENTRIES
+    compress = COMPRESS if compress is None else compress
+    aead = AESGCM(safe_data.log_block_key(key))
+    header = HEADER.pack(MAGIC, VERSION, FLAG_ZLIB if compress else 0, block_entries, time.time())
+
+    index = []
+    total = 0
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as segment:
+        segment.write(header)
+
+        def write_block(block):
+            payload = _pack_entries(block)
+            if compress:
+                payload = zlib.compress(payload, 6)
+            nonce = os.urandom(12)
+            sequence = len(index)
+            # The payload length is that of the ciphertext, which includes the 16-byte tag
+            block_header = BLOCK.pack(BLOCK_MAGIC, sequence, len(block), len(payload) + 16, nonce)
+            ciphertext = aead.encrypt(nonce, payload, header + block_header)
+            index.append((segment.tell(), total - len(block), len(block)))
+            segment.write(block_header + ciphertext)
+
+        block = []
+        for entry in entries:
+            block.append(entry)
+            total += 1
+            if len(block) >= block_entries:
+                write_block(block)
+                block = []
+        if block:
+            write_block(block)
+
+        index_offset = segment.tell()
+        segment.write(b''.join(INDEX_ENTRY.pack(*item) for item in index))
+        segment.write(FOOTER.pack(index_offset, len(index), FOOTER_MAGIC))
+        segment.flush()
+        os.fsync(segment.fileno())
+    os.replace(temp_path, path)
+    return total
+
+
+class SegmentReader:
+    """Random access to the entries of a segment; only the blocks that are read get decrypted.
+
+    Offers the same line()/lines()/page() interface as log_index.LogView, returning the
+    plaintext "<timestamp> - <LEVEL> - <entry>" lines.
+    """
+
+    def __init__(self, path, key=None):
+        self.path = path
+        self._file = open(path, 'rb')
+        self._aead = AESGCM(safe_data.log_block_key(key))
+        self._header = self._file.read(HEADER.size)
+        if len(self._header) < HEADER.size:
+            raise SegmentError(f"{path}: truncated header")
+        magic, version, self.flags, self.block_entries, self.created = HEADER.unpack(self._header)
+        if magic != MAGIC or version != VERSION:
+            raise SegmentError(f"{path}: not a log segment")
+
+        self._file.seek(-FOOTER.size, os.SEEK_END)
+        index_offset, block_count, footer_magic = FOOTER.unpack(self._file.read(FOOTER.size))
+        if footer_magic != FOOTER_MAGIC:
+            raise SegmentError(f"{path}: missing block index (incomplete segment?)")
+        self._file.seek(index_offset)
+        data = self._file.read(block_count * INDEX_ENTRY.size)
+        self.index = [INDEX_ENTRY.unpack_from(data, i * INDEX_ENTRY.size) for i in range(block_count)]
+        self._blocks = OrderedDict()
+
+    def __len__(self):
+        if not self.index:
+            return 0
+        _offset, first, count = self.index[-1]
+        return first + count
+
+    def block(self, sequence):
+        """Decrypted entries of one block."""
+        return [_display(entry) for entry in self._stored(sequence)]
+
+    def _stored(self, sequence):
+        if sequence in self._blocks:
+            self._blocks.move_to_end(sequence)
+            return self._blocks[sequence]
+        offset, _first, expected = self.index[sequence]
+        self._file.seek(offset)
+        block_header = self._file.read(BLOCK.size)
+        magic, stored_sequence, count, length, nonce = BLOCK.unpack(block_header)
+        if magic != BLOCK_MAGIC or stored_sequence != sequence or count != expected:
+            raise SegmentError(f"{self.path}: block {sequence} is out of place")
+        try:
+            payload = self._aead.decrypt(nonce, self._file.read(length), self._header + block_header)
+        except Exception:
+            raise SegmentError(f"{self.path}: block {sequence} failed authentication")
+        if self.flags & FLAG_ZLIB:
+            payload = zlib.decompress(payload)
+        entries = _unpack_entries(payload, count)
+        self._blocks[sequence] = entries
+        while len(self._blocks) > BLOCK_CACHE_SIZE:
+            self._blocks.popitem(last=False)
+        return entries
+
+    def original(self, number):
+        """The text log line of an entry that could not be decrypted when converted, else None."""
+        sequence = self._block_of(number)
+        entry = self._stored(sequence)[number - self.index[sequence][1]]
+        return entry[len(RAW):] if entry.startswith(RAW) else None
+
+    def _block_of(self, number):
+        # Every block but the last holds block_entries entries
+        return min(number // self.block_entries, len(self.index) - 1)
+
+    def line(self, number):
+        sequence = self._block_of(number)
+        return self.block(sequence)[number - self.index[sequence][1]]
+
+    def lines(self, start, count):
+        return [self.line(number) for number in range(start, min(start + count, len(self)))]
+
+    def page(self, number, size, transform=None):
+        lines = self.lines(number * size, size)
+        return [transform(line) for line in lines] if transform else lines
+
+    def __iter__(self):
+        for sequence in range(len(self.index)):
+            yield from self.block(sequence)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def convert(log_path, remove=True):
+    """Convert a text log of Fernet lines to `<log_path>.seg`.
+
+    Returns {byte offset in the text log: entry number} so references into the text log
+    (the suspicious-event index) can be moved over. Lines that don't decrypt are stored
+    verbatim (see RAW), so the text log can be removed without losing them.
+    """
+    import log_config
+    offsets = {}
+
+    def entries():
+        with open(log_path, 'rb') as log_file:
+            offset = 0
+            for number, raw in enumerate(log_file):
+                offsets[offset] = number
+                offset += len(raw)
+                line = raw.decode('utf-8', errors='replace').rstrip('\r\n')
+                try:
+                    timestamp, level, plaintext = log_config.decrypt_log_line(line, strict=True)
+                except ValueError:
+                    yield RAW + line
+                    continue
+                yield f"{timestamp} - {level} - {plaintext}"
+
+    write_segment(log_path + EXTENSION, entries())
+    if remove:
+        os.remove(log_path)
+    return offsets
+
+
+def main(argv):
+    if len(argv) < 3 or argv[1] not in ("convert", "verify"):
+        print("Usage: python log_segments.py convert|verify <file> [...]")
+        return 1
+    for path in argv[2:]:
+        if argv[1] == "convert":
+            import log_config
+            before = os.path.getsize(path)
+            log_config.convert_rotated_log(path)
+            after = os.path.getsize(path + EXTENSION)
+            print(f"{path}: {before} -> {after} bytes ({before / max(after, 1):.1f}x smaller)")
+        else:
+            with SegmentReader(path) as reader:
+                count = sum(1 for _ in reader)
+            print(f"{path}: {len(reader.index)} blocks, {count} entries, all authenticated")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
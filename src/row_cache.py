@@ -0,0 +1,108 @@
+"""Bounded in-process LRU cache of decrypted cells, keyed by table and primary key.
+
+Each cached cell keeps the ciphertext it was decrypted from and is only used while the row
+still holds that exact ciphertext, so a missed invalidation can cost a decrypt but never
+return stale data. Writers still invalidate their rows (update_column, delete_row and the
+insert sites) to free memory early, and refresh() drops everything when PRAGMA data_version
+shows that another connection or process committed changes.
+"""
+import os
+import sys
+import threading
+from collections import OrderedDict
+
+from db_connection import get_connection
+
+MAX_BYTES = int(os.environ.get('UM_ROW_CACHE_BYTES', str(32 * 1024 * 1024)))
+
+# Rough per-entry cost of the key tuple, the dict and the OrderedDict node
+_ENTRY_OVERHEAD = 400
+
+_lock = threading.Lock()
+_entries = OrderedDict()
+_size = 0
+_data_versions = {}
+hits = 0
+misses = 0
+
+
+def configure(max_bytes):
+    global MAX_BYTES
+    with _lock:
+        MAX_BYTES = int(max_bytes)
+        _evict()
+
+
+def _cost(cells):
+    return sum(sys.getsizeof(name) + sys.getsizeof(token) + sys.getsizeof(plain) for name, (token, plain) in cells.items())
+
+
+def _evict():
+    global _size
+    while _size > MAX_BYTES and _entries:
+        _key, (_cells, cost) = _entries.popitem(last=False)
+        _size -= cost
+
+
+def get(table, pk):
+    """Cached cells of a row as {column: (ciphertext, plaintext)}, or None."""
+    global hits, misses
+    with _lock:
+        entry = _entries.get((table, pk))
+        if entry is None:
+            misses += 1
+            return None
+        _entries.move_to_end((table, pk))
+        hits += 1
+        return dict(entry[0])
+
+
+def put(table, pk, cells):
+    """Add {column: (ciphertext, plaintext)} to the cached cells of a row."""
+    global _size
+    if not cells:
+        return
+    with _lock:
+        key = (table, pk)
+        old_cells, old_cost = _entries.pop(key, ({}, 0))
+        merged = dict(old_cells)
+        merged.update(cells)
+        cost = _cost(merged) + _ENTRY_OVERHEAD
+        _entries[key] = (merged, cost)
+        _size += cost - old_cost
+        _evict()
+
+
+def invalidate(table, pk=None):
+    """Forget one row, or a whole table when pk is None."""
+    global _size
+    with _lock:
+        if pk is not None:
+            _cells, cost = _entries.pop((table, pk), (None, 0))
+            _size -= cost
+            return
+        for key in [k for k in _entries if k[0] == table]:
+            _size -= _entries.pop(key)[1]
+
+
+def clear():
+    global _size
+    with _lock:
+        _entries.clear()
+        _size = 0
+
+
+def refresh():
+    """Clear the cache if another connection has committed since this thread's connection last checked."""
+    conn = get_connection()
+    version = conn.execute("PRAGMA data_version").fetchone()[0]
+    with _lock:
+        previous = _data_versions.get(id(conn))
+        _data_versions[id(conn)] = version
+    if previous is not None and previous != version:
+        clear()
+
+
+def stats():
+    with _lock:
+        return {'hits': hits, 'misses': misses, 'entries': len(_entries), 'bytes': _size, 'max_bytes': MAX_BYTES}
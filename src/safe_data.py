@@ -1,20 +1,32 @@
 import os
 import base64
+import hmac
+import hashlib
+import socket
+import threading
 from getpass import getpass
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.backends import default_backend
-from cryptography.fernet import Fernet
 
 # Files
 KEY_PATH = 'um.key'    
 SALT_PATH = 'um.salt'  
 
+# Ask a running key_agent for the key before deriving it (UM_KEY_AGENT=0 to never ask).
+# The agent needs Unix sockets and user ids, so it is never asked on Windows.
+USE_KEY_AGENT = (os.environ.get('UM_KEY_AGENT', '1') != '0'
+                 and hasattr(socket, 'AF_UNIX') and hasattr(os, 'getuid'))
+
 # Internal cache
 _cached_key = None
+_cached_index_key = None
+_cipher = None
+_cipher_lock = threading.Lock()
 
 
 def _derive_key_from_passphrase(passphrase: str, salt: bytes) -> bytes:
+    # Imported here: with a key agent running the KDF is never needed
+    from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.backends import default_backend
     kdf = PBKDF2HMAC(
         algorithm=hashes.SHA256(),
         length=32,
@@ -50,6 +62,11 @@ def _get_key():
 
     if os.path.exists(SALT_PATH):
         salt = _load_or_create_salt()
+        if USE_KEY_AGENT:
+            import key_agent
+            _cached_key = key_agent.fetch_key(salt)
+            if _cached_key is not None:
+                return _cached_key
         passphrase = os.environ.get('UM_PASSPHRASE')
         if not passphrase:
             passphrase = getpass('Enter passphrase for data encryption/decryption: ')
@@ -91,13 +108,92 @@ def public_key():
     return _get_key()
 
 
+def get_cipher():
+    """Return the shared Fernet instance for the data key. Built once; safe to use from any thread."""
+    global _cipher
+    if _cipher is None:
+        # Imported here: cryptography is the slowest import at startup and the menu does not need it yet
+        from cryptography.fernet import Fernet
+        with _cipher_lock:
+            if _cipher is None:
+                _cipher = Fernet(_get_key())
+    return _cipher
+
+
+def _cipher_for(key):
+    if _cached_key is not None and key == _cached_key:
+        return get_cipher()
+    from cryptography.fernet import Fernet
+    return Fernet(key)
+
+
 def encrypt_data(key, data):
     if not isinstance(data, str):
         data = str(data)
-    f = Fernet(key)
+    f = _cipher_for(key)
     return f.encrypt(data.encode('utf-8'))
 
 
 def decrypt_data(key, encrypted_data):
-    f = Fernet(key)
+    f = _cipher_for(key)
     return f.decrypt(encrypted_data).decode('utf-8')
+
+
+def encrypt_many(values):
+    """Encrypt a batch of values with the shared cipher. Non-strings are converted with str()."""
+    f = get_cipher()
+    return [f.encrypt((v if isinstance(v, str) else str(v)).encode('utf-8')) for v in values]
+
+
+def decrypt_many(tokens, strict=True):
+    """Decrypt a batch of tokens with the shared cipher.
+
+    With strict=False a token that cannot be decrypted is returned unchanged instead of raising.
+    """
+    f = get_cipher()
+    if strict:
+        return [f.decrypt(t).decode('utf-8') for t in tokens]
+    result = []
+    for t in tokens:
+        try:
+            result.append(f.decrypt(t).decode('utf-8'))
+        except Exception:
+            result.append(t)
+    return result
+
+
+def index_key(key=None):
+    """HMAC key for blind indexes and search tokens, derived from the Fernet key (pool workers pass theirs)."""
+    return hmac.new(key or _get_key(), b'um-blind-index', hashlib.sha256).digest()
+
+
+def _get_index_key():
+    global _cached_index_key
+    if _cached_index_key is None:
+        _cached_index_key = index_key()
+    return _cached_index_key
+
+
+def log_block_key(key=None):
+    """AES-256-GCM key for block-encrypted log segments (see log_segments), derived from the Fernet key."""
+    return hmac.new(key or _get_key(), b'um-log-blocks', hashlib.sha256).digest()
+
+
+def blind_index(value):
+    """Keyed HMAC of a normalised value so encrypted columns can be looked up without decrypting them."""
+    if not isinstance(value, str):
+        value = str(value)
+    return hmac.new(_get_index_key(), value.strip().lower().encode('utf-8'), hashlib.sha256).hexdigest()
+
+
+def ngram_tokens(value, n=3, key=None):
+    """Keyed tokens for every n-gram of the lower-cased value, for substring search over encrypted columns.
+
+    key is the index_key() to use, by default the one of the loaded key. Values shorter than n produce no tokens.
+    """
+    if not isinstance(value, str):
+        value = str(value)
+    text = value.lower()
+    key = key or _get_index_key()
+    grams = {text[i:i + n] for i in range(len(text) - n + 1)}
+    return {hmac.new(key, b'ngram:' + g.encode('utf-8'), hashlib.sha256).hexdigest()[:24] for g in grams}
@@ -1,18 +1,16 @@
-import sqlite3
 import time
-from safe_data import encrypt_data, public_key
-from log_config import logmanager as log_manager
+import re
+from log_config import log_instance
 from search import display_search_results, search
 import database
+import search_index
+import row_cache
+import spatial
+from crypto_pool import LazyRow
+from db_connection import get_connection, transaction
 from acl import require_role
 from ui_helpers import clear as ui_clear, prompt_with_back
 
-log_instance = log_manager()
-
-
-def _encrypt(v):
-    return encrypt_data(public_key(), v)
-
 
 def _prompt(prompt, validator=None, transform=None, allow_empty=False):
     while True:
@@ -35,9 +33,6 @@ def _prompt(prompt, validator=None, transform=None, allow_empty=False):
 
 @require_role('system_admin')
 def add_scooter(username):
-    connection = sqlite3.connect("scooterfleet.db")
-    cursor = connection.cursor()
-
     print("\n--- Add Scooter ---")
     brand = _prompt("Brand: ", lambda s: 1 <= len(s) <= 50)
     model = _prompt("Model: ", lambda s: 1 <= len(s) <= 50)
@@ -66,21 +61,23 @@ def add_scooter(username):
         database.validate_and_prepare_value('Scooters', 'longitude', str(longitude)),
         database.validate_and_prepare_value('Scooters', 'out_of_service', "1" if out_of_service == "y" else "0"),
         database.validate_and_prepare_value('Scooters', 'mileage', str(mileage)),
-        database.validate_and_prepare_value('Scooters', 'last_maintenance_date', last_maintenance)
+        database.validate_and_prepare_value('Scooters', 'last_maintenance_date', last_maintenance),
+        database.blind_index(serial)
     )
 
-    cursor.execute(
-        """
-        INSERT INTO Scooters (
-            brand, model, serial_number, top_speed, battery_capacity, state_of_charge,
-            target_range_min_soc, target_range_max_soc, latitude, longitude, out_of_service,
-            mileage, last_maintenance_date
-        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """,
-        data
-    )
-    connection.commit()
-    connection.close()
+    with transaction() as connection:
+        cursor = connection.execute(
+            """
+            INSERT INTO Scooters (
+                brand, model, serial_number, top_speed, battery_capacity, state_of_charge,
+                target_range_min_soc, target_range_max_soc, latitude, longitude, out_of_service,
+                mileage, last_maintenance_date, serial_index
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            data
+        )
+        search_index.index_row(connection, 'Scooters', cursor.lastrowid, {'brand': brand, 'model': model, 'serial_number': serial})
+    row_cache.invalidate('Scooters', cursor.lastrowid)
     print("Scooter added successfully")
     log_instance.log_activity(username, "Add scooter", f"Added scooter serial: {serial}", "No")
     time.sleep(1)
@@ -98,7 +95,7 @@ def modify_scooter(username, role):
     choice = display_search_results(results, show_numbers=True, allow_select=True)
     if choice is None:
         return
-    if choice < 1 or choice > len(results)-1:
+    if not results.has_match(choice):
         ui_clear()
         print("Invalid choice")
         return
@@ -147,9 +144,11 @@ def modify_scooter(username, role):
         print("Invalid value")
         return
 
-    enc = _encrypt(str(new_value) if sel != "13" else new_value)
+    if field_name == "out_of_service":
+        new_value = "1" if new_value.lower() == "y" else "0"
     try:
-        ok = database.update_column('Scooters', field_name, 'scooter_id', scooter_id, enc)
+        prepared = database.validate_and_prepare_value('Scooters', field_name, new_value)
+        ok = database.update_column('Scooters', field_name, 'scooter_id', scooter_id, prepared)
         if not ok:
             print("No rows updated")
             return
@@ -173,7 +172,7 @@ def delete_scooter(username):
     choice = display_search_results(results, show_numbers=True, allow_select=True)
     if choice is None:
         return
-    if choice < 1 or choice > len(results)-1:
+    if not results.has_match(choice):
         ui_clear()
         print("Invalid choice")
         return
@@ -183,11 +182,160 @@ def delete_scooter(username):
     if confirm not in ("y", "yes"):
         print("Delete cancelled")
         return
-    connection = sqlite3.connect("scooterfleet.db")
-    cursor = connection.cursor()
-    cursor.execute("DELETE FROM Scooters WHERE scooter_id = ?", (scooter_id,))
-    connection.commit()
-    connection.close()
+    database.delete_row('Scooters', scooter_id)
     print("Scooter deleted")
     log_instance.log_activity(username, "Delete scooter", f"Deleted scooter id: {scooter_id}", "No")
     time.sleep(1)
+
+
+# Typed plaintext columns that can be filtered on in SQL, and the short names accepted for them
+FILTER_COLUMNS = tuple(database.TYPE_MAP['Scooters'])
+FILTER_ALIASES = {"soc": "state_of_charge", "min_soc": "target_range_min_soc", "max_soc": "target_range_max_soc"}
+FILTER_OPERATORS = ("<=", ">=", "!=", "<", ">", "=")
+
+FILTER_PRESETS = {
+    "1": ("Below target range", "state_of_charge < target_range_min_soc"),
+    "2": ("Above target range", "state_of_charge > target_range_max_soc"),
+    "3": ("Out of service", "out_of_service = 1"),
+}
+
+_CONDITION_RE = re.compile(r'^\s*(\w+)\s*(' + "|".join(re.escape(op) for op in FILTER_OPERATORS) + r')\s*(\S+)\s*$')
+
+
+def _filter_column(name):
+    name = FILTER_ALIASES.get(name.lower(), name.lower())
+    return name if name in FILTER_COLUMNS else None
+
+
+def parse_filter(text):
+    """Parse e.g. "SoC < target_range_min_soc and out_of_service = 1" into (column, operator, operand) tuples.
+
+    An operand is either another filter column (compared column to column) or a value of the column's type.
+    Raises ValueError on anything else.
+    """
+    conditions = []
+    for part in re.split(r'\s+and\s+', text.strip(), flags=re.IGNORECASE):
+        match = _CONDITION_RE.match(part)
+        if not match:
+            raise ValueError(f"Invalid condition: {part}")
+        name, operator, operand = match.groups()
+        column = _filter_column(name)
+        if column is None:
+            raise ValueError(f"Cannot filter on {name}")
+        other = _filter_column(operand) if re.match(r'^[A-Za-z_]\w*$', operand) else None
+        if other:
+            conditions.append((column, operator, ('column', other)))
+        else:
+            conditions.append((column, operator, database.validate_and_prepare_value('Scooters', column, operand)))
+    return conditions
+
+
+def filter_scooters(conditions, limit=None):
+    """Scooters matching all conditions (see parse_filter), filtered entirely in SQLite.
+
+    Returns [header, row, ...] like search(); the encrypted columns of a row are only decrypted when read.
+    """
+    where = []
+    params = []
+    for column, operator, operand in conditions:
+        if column not in FILTER_COLUMNS or operator not in FILTER_OPERATORS:
+            raise ValueError(f"Invalid condition: {column} {operator}")
+        if isinstance(operand, tuple):
+            if operand[1] not in FILTER_COLUMNS:
+                raise ValueError(f"Cannot filter on {operand[1]}")
+            where.append(f"{column} {operator} {operand[1]}")
+        else:
+            where.append(f"{column} {operator} ?")
+            params.append(operand)
+
+    columns = ["scooter_id"] + list(database.ALLOWED_COLUMNS['Scooters']) + ["in_service_date"]
+    sql = f"SELECT {', '.join(columns)} FROM Scooters"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY scooter_id"
+    if limit is not None:
+        sql += " LIMIT ?"
+        params.append(int(limit))
+    rows = get_connection().execute(sql, params).fetchall()
+    return [[c.upper() for c in columns]] + [LazyRow(row) for row in rows]
+
+
+@require_role('service_engineer')
+def filter_scooters_menu(username):
+    print("\n--- Filter Scooters ---")
+    for key, (label, condition) in FILTER_PRESETS.items():
+        print(f"{key}. {label} ({condition})")
+    print(f"{len(FILTER_PRESETS) + 1}. Custom filter")
+    choice = prompt_with_back("Choose an option: ")
+    if choice is None:
+        return
+    if choice in FILTER_PRESETS:
+        text = FILTER_PRESETS[choice][1]
+    elif choice == str(len(FILTER_PRESETS) + 1):
+        print("Columns: " + ", ".join(FILTER_COLUMNS))
+        text = input("Filter (e.g. soc < 20 and out_of_service = 0): ").strip()
+    else:
+        ui_clear()
+        print("Invalid choice")
+        return
+
+    try:
+        results = filter_scooters(parse_filter(text))
+    except ValueError as e:
+        print(e)
+        time.sleep(1)
+        return
+    log_instance.log_activity(username, "Filter scooters", f"Filtered scooters on: {text}", "No")
+    if len(results) <= 1:
+        print("No scooters found")
+        time.sleep(1)
+        return
+    display_search_results(results, show_numbers=True)
+
+
+def _prompt_point(label):
+    lat = _prompt(f"{label} latitude (e.g. 51.92250): ", lambda x: -90.0 <= x <= 90.0, transform=float)
+    lon = _prompt(f"{label} longitude (e.g. 4.47917): ", lambda x: -180.0 <= x <= 180.0, transform=float)
+    return lat, lon
+
+
+@require_role('service_engineer')
+def nearby_scooters_menu(username):
+    print("\n--- Scooters near a location ---")
+    print("1. Nearest scooters to a point")
+    print("2. Scooters within a radius")
+    print("3. Scooters in an area (bounding box)")
+    choice = prompt_with_back("Choose an option: ")
+    if choice is None:
+        return
+    if choice == "1":
+        lat, lon = _prompt_point("Your")
+        k = _prompt("How many scooters: ", lambda x: 1 <= x <= 100, transform=int)
+        results = spatial.nearest(lat, lon, k)
+        details = f"{k} nearest to {lat}, {lon}"
+    elif choice == "2":
+        lat, lon = _prompt_point("Centre")
+        radius = _prompt("Radius (km): ", lambda x: x >= 0, transform=float)
+        results = spatial.within_radius(lat, lon, radius)
+        details = f"within {radius} km of {lat}, {lon}"
+    elif choice == "3":
+        min_lat, min_lon = _prompt_point("South-west corner")
+        max_lat, max_lon = _prompt_point("North-east corner")
+        try:
+            results = spatial.in_bbox(min_lat, min_lon, max_lat, max_lon)
+        except ValueError as e:
+            print(e)
+            time.sleep(1)
+            return
+        details = f"in box {min_lat}, {min_lon} - {max_lat}, {max_lon}"
+    else:
+        ui_clear()
+        print("Invalid choice")
+        return
+
+    log_instance.log_activity(username, "Locate scooters", f"Searched scooters {details}", "No")
+    if len(results) <= 1:
+        print("No scooters found")
+        time.sleep(1)
+        return
+    display_search_results(results, show_numbers=True)
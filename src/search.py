@@ -1,19 +1,144 @@
-import sqlite3
 import re
 import time
-from safe_data import private_key, decrypt_data
+import crypto_pool
+import search_index
+import row_cache
 from ui_helpers import clear as ui_clear, prompt_with_back
+import database
+from db_connection import get_connection
 
 def _is_valid_identifier(name: str) -> bool:
     return bool(re.match(r"^[A-Za-z_][A-Za-z0-9_]*$", name))
 
 
 ALLOWED_TABLES = {"USERS", "TRAVELLERS", "SCOOTERS", "RESTORECODES"}
+TABLE_NAMES = {name.upper(): name for name in search_index.INDEXED_TABLES}
 
+# Blind-index columns are lookup keys, never shown or matched against
+HIDDEN_COLUMNS = {c for indexes in database.BLIND_INDEXES.values() for c in indexes.values()}
 
-def search(search_term, table, column="*", role=None):
-    connection = sqlite3.connect("scooterfleet.db")
-    cursor = connection.cursor()
+
+class SearchResults:
+    """Matches of a search, pulled from the scan only when they are needed.
+
+    Indexing works like the list search() used to return: [0] is the header row and
+    matches start at [1]. len() and slicing force the whole scan; paging code should
+    use fetch()/page()/has_match() so only the rows on screen get decrypted.
+    """
+
+    def __init__(self, header, matches):
+        self.header = header
+        self._matches = matches
+        self._rows = []
+        self.exhausted = False
+
+    def fetch(self, count):
+        """Load matches until at least count are available or the scan ends. Returns how many are loaded."""
+        while not self.exhausted and len(self._rows) < count:
+            try:
+                self._rows.append(next(self._matches))
+            except StopIteration:
+                self.exhausted = True
+        return len(self._rows)
+
+    @property
+    def loaded(self):
+        return len(self._rows)
+
+    def has_match(self, number):
+        """True if there is a match with this 1-based number."""
+        return number >= 1 and self.fetch(number) >= number
+
+    def page(self, start, count):
+        """Matches start..start+count (0-based), loading only as far as needed."""
+        self.fetch(start + count)
+        return self._rows[start:start + count]
+
+    def close(self):
+        self._matches.close()
+        self.exhausted = True
+
+    def __getitem__(self, index):
+        if isinstance(index, slice) or index < 0:
+            return ([self.header] + self._all())[index]
+        if index == 0:
+            return self.header
+        if not self.has_match(index):
+            raise IndexError("search result index out of range")
+        return self._rows[index - 1]
+
+    def __len__(self):
+        return len(self._all()) + 1
+
+    def __bool__(self):
+        return self.fetch(1) > 0
+
+    def __iter__(self):
+        yield self.header
+        number = 1
+        while self.has_match(number):
+            yield self._rows[number - 1]
+            number += 1
+
+    def _all(self):
+        while not self.exhausted:
+            self.fetch(len(self._rows) + 1000)
+        return self._rows
+
+
+def _fetch_chunks(connection, query, params, size):
+    # Keyset paging on rowid: every chunk is its own short query, so a search that is paused
+    # at a prompt never holds a read snapshot that would block later writes
+    last_rowid = -2 ** 63
+    while True:
+        rows = connection.execute(query, list(params) + [last_rowid, size]).fetchall()
+        if not rows:
+            break
+        last_rowid = rows[-1][0]
+        yield [row[1:] for row in rows]
+        if len(rows) < size:
+            break
+
+
+def _cache_hooks(table, columns):
+    # Row cache lookups/stores for crypto_pool.iter_matches; cells are reused only while their ciphertext is unchanged
+    pk = database.PRIMARY_KEYS.get(table)
+    if pk not in columns:
+        return None, None
+    pk_index = columns.index(pk)
+
+    def lookup(row):
+        cached = row_cache.get(table, row[pk_index])
+        if not cached:
+            return None
+        return {i: cached[c][1] for i, c in enumerate(columns) if c in cached and cached[c][0] == row[i]}
+
+    def store(row, decrypted):
+        row_cache.put(table, row[pk_index], {columns[i]: (row[i], plain) for i, plain in decrypted.items()})
+
+    return lookup, store
+
+
+def _iter_matches(query, count_query, params, search_term, table, columns, match_columns=None, limit=None):
+    row_cache.refresh()
+    lookup, store = _cache_hooks(table, columns)
+    connection = get_connection()
+    total_rows = connection.execute(count_query, params).fetchone()[0]
+    chunks = _fetch_chunks(connection, query, params, crypto_pool.CHUNK_SIZE)
+    matches = crypto_pool.iter_matches(chunks, search_term, total_rows, match_columns, lookup, store)
+    found = 0
+    try:
+        for match in matches:
+            yield match
+            found += 1
+            if limit is not None and found >= limit:
+                break
+    finally:
+        matches.close()
+
+
+def search(search_term, table, column="*", role=None, limit=None):
+    cursor = get_connection().cursor()
     if search_term is None:
         search_term = ""
     search_term = str(search_term).strip()
@@ -26,7 +151,7 @@ def search(search_term, table, column="*", role=None):
 
     cursor.execute(f"PRAGMA table_info({table})")
     columns_info = cursor.fetchall()
-    columns = [info[1] for info in columns_info if "password" not in info[1].lower()]
+    columns = [info[1] for info in columns_info if "password" not in info[1].lower() and info[1] not in HIDDEN_COLUMNS]
 
     if not columns:
         return f"No columns found in {table}"
@@ -43,38 +168,31 @@ def search(search_term, table, column="*", role=None):
                     break
             column = matched if matched else "*"
 
+    # Every column is fetched so results keep their id; only the match columns are decrypted up front
+    columns_to_query = ", ".join(columns)
     if column == "*":
-        columns_to_query = ", ".join(columns)
+        match_columns = None
     else:
-        if not _is_valid_identifier(column):
-            return "Invalid column name"
-        columns_to_query = column
+        match_columns = [columns.index(column)]
 
+    conditions = []
+    params = []
+    index_filter = None
+    if table in TABLE_NAMES:
+        index_filter = search_index.candidate_filter(TABLE_NAMES[table], columns, search_term, column)
+    if index_filter:
+        conditions.append(index_filter[0])
+        params += index_filter[1]
     if role:
-        query = f"SELECT {columns_to_query} FROM {table} WHERE role_level = ?"
-        cursor.execute(query, (role,))
-    else:
-        query = f"SELECT {columns_to_query} FROM {table}"
-        cursor.execute(query)
-
-    all_data = cursor.fetchall()
-    search_results = []
-    search_results.append([col.upper() for col in columns])
-
-    for row in all_data:
-        decrypted_data = []
-        for item in row:
-            if isinstance(item, (bytes, bytearray)):
-                try:
-                    decrypted_data.append(decrypt_data(private_key(), item))
-                except Exception:
-                    decrypted_data.append(item)
-            else:
-                decrypted_data.append(item)
-        if any(search_term.lower() in str(field).lower() for field in decrypted_data):
-            search_results.append(decrypted_data)
+        conditions.append("role_level = ?")
+        params.append(role)
+    where = (" WHERE " + " AND ".join(conditions)) if conditions else ""
+    page_condition = (" AND " if conditions else " WHERE ") + "rowid > ?"
+    query = f"SELECT rowid, {columns_to_query} FROM {table}{where}{page_condition} ORDER BY rowid LIMIT ?"
+    count_query = f"SELECT COUNT(*) FROM {table}{where}"
 
-    if len(search_results) == 1:
+    search_results = SearchResults([col.upper() for col in columns], _iter_matches(query, count_query, params, search_term, TABLE_NAMES.get(table, table), columns, match_columns, limit))
+    if not search_results:
         return []
     return search_results
 
@@ -83,19 +201,20 @@ def display_search_results(search_results, show_numbers=True, rows_per_page=10,
     if type(search_results) == str:
         print(search_results)
         return None
-    if not search_results or len(search_results) == 0:
+    if not search_results:
         print("No results.")
         return None
+    if isinstance(search_results, list):
+        search_results = SearchResults(search_results[0], iter(search_results[1:]))
 
-    header_cols = search_results[0][:4] if len(search_results[0]) >= 4 else search_results[0]
-    total_items = len(search_results) - 1
-    total_pages = (total_items + rows_per_page - 1) // rows_per_page
+    header_cols = search_results.header[:4] if len(search_results.header) >= 4 else search_results.header
 
     current_page = 0
     while True:
         start = current_page * rows_per_page
         end = start + rows_per_page
-        page_items = search_results[1:][start:end]
+        page_items = search_results.page(start, rows_per_page)
+        has_next = search_results.loaded > end or not search_results.exhausted
 
         header = ("     " if show_numbers else "") + "".join(c.ljust(20) for c in header_cols)
         print(header)
@@ -106,13 +225,13 @@ def display_search_results(search_results, show_numbers=True, rows_per_page=10,
             line = (f"[{i}]  " if show_numbers else "") + "".join(str(c).ljust(20) for c in cols)
             print(line)
 
-        if total_pages == 1 and not allow_select:
+        if current_page == 0 and not has_next and not allow_select:
             return None
 
         nav_parts = []
         if current_page > 0:
             nav_parts.append("P. Previous")
-        if current_page < total_pages - 1:
+        if has_next:
             nav_parts.append("N. Next")
         if allow_select:
             nav_parts.append("Enter number to select")
@@ -127,15 +246,20 @@ def display_search_results(search_results, show_numbers=True, rows_per_page=10,
         if choice.lower() == 'p' and current_page > 0:
             current_page -= 1
             continue
-        if choice.lower() == 'n' and current_page < total_pages - 1:
-            current_page += 1
+        if choice.lower() == 'n' and has_next:
+            if search_results.fetch(end + 1) > end:
+                current_page += 1
+            else:
+                ui_clear()
+                print('No more results')
+                time.sleep(2)
             continue
         if choice.lower() == 'b':
             return None
         if allow_select:
             try:
                 sel = int(choice)
-                if 1 <= sel <= total_items:
+                if search_results.has_match(sel):
                     return sel
                 else:
                     ui_clear()
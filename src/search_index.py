@@ -0,0 +1,140 @@
+"""Keyed n-gram index over the encrypted columns, used to narrow substring searches.
+
+Every encrypted column value is split into lower-cased trigrams and each trigram is stored as
+an HMAC token in SearchTokens. A search term's trigrams must all appear in one column of a row
+for that row to be a candidate; candidates are then decrypted and checked as before, so the
+index only ever removes rows that cannot match.
+
+Databases that already hold data need a one-time `python search_index.py rebuild`; until then
+searches on those tables fall back to a full scan.
+"""
+import sys
+
+import database
+from db_connection import get_connection, transaction
+from safe_data import ngram_tokens, get_cipher
+
+NGRAM = 3
+INDEXED_TABLES = ("Users", "Travellers", "Scooters")
+
+
+def _indexed_columns(table):
+    return [column for column, encrypted in database.ALLOWED_COLUMNS[table].items() if encrypted]
+
+
+def _token_rows(table, row_id, column, value):
+    return [(table, row_id, column, token) for token in ngram_tokens(value, NGRAM)]
+
+
+def index_row(conn, table, row_id, values):
+    """(Re)index the given plaintext column values of one row. Non-encrypted columns are ignored."""
+    if table not in INDEXED_TABLES:
+        return
+    for column, value in values.items():
+        if not database.ALLOWED_COLUMNS[table].get(column):
+            continue
+        conn.execute("DELETE FROM SearchTokens WHERE table_name = ? AND row_id = ? AND column_name = ?", (table, row_id, column))
+        conn.executemany("INSERT INTO SearchTokens (table_name, row_id, column_name, token) VALUES (?, ?, ?, ?)",
+                         _token_rows(table, row_id, column, value))
+
+
+def insert_tokens(conn, table, entries):
+    """Add tokens computed elsewhere (see bulk_import) for new rows. entries: iterable of (row_id, column, tokens)."""
+    # In token order, so the lookup index is filled front to back instead of at random places
+    rows = sorted((token, row_id, column) for row_id, column, tokens in entries for token in tokens)
+    conn.executemany("INSERT INTO SearchTokens (table_name, row_id, column_name, token) VALUES (?, ?, ?, ?)",
+                     ((table, row_id, column, token) for token, row_id, column in rows))
+
+
+def remove_row(conn, table, row_id):
+    conn.execute("DELETE FROM SearchTokens WHERE table_name = ? AND row_id = ?", (table, row_id))
+
+
+def is_built(table):
+    row = get_connection().execute("SELECT built FROM SearchIndexState WHERE table_name = ?", (table,)).fetchone()
+    return bool(row and row[0])
+
+
+def candidate_filter(table, columns, term, column="*"):
+    """SQL condition (and params) limiting table to rows that may contain term, or None if the index can't help.
+
+    Encrypted columns are narrowed through the token index, plaintext columns with LIKE.
+    Plaintext columns that still hold encrypted blobs are always kept as candidates.
+    """
+    if table not in INDEXED_TABLES or len(term) < NGRAM or not is_built(table):
+        return None
+
+    if column != "*":
+        columns = [column]
+    encrypted = [c for c in columns if database.ALLOWED_COLUMNS[table].get(c)]
+    plaintext = [c for c in columns if c not in encrypted]
+    pk = database.PRIMARY_KEYS[table]
+
+    conditions = []
+    params = []
+    if encrypted:
+        tokens = sorted(ngram_tokens(term, NGRAM))
+        placeholders = ", ".join("?" for _ in tokens)
+        token_sql = f"SELECT row_id FROM SearchTokens INDEXED BY idx_search_tokens_lookup WHERE table_name = ? AND token IN ({placeholders})"
+        params += [table] + tokens
+        if column != "*":
+            token_sql += " AND column_name = ?"
+            params.append(column)
+        token_sql += " GROUP BY row_id, column_name HAVING COUNT(DISTINCT token) = ?"
+        params.append(len(tokens))
+        conditions.append(f"{pk} IN ({token_sql})")
+
+    like = "%" + term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+    for c in plaintext:
+        conditions.append(f"(CAST({c} AS TEXT) LIKE ? ESCAPE '\\' OR typeof({c}) = 'blob')")
+        params.append(like)
+
+    if not conditions:
+        return "0", []
+    return "(" + " OR ".join(conditions) + ")", params
+
+
+def rebuild(table=None):
+    """Rebuild the index for one table (or all indexed tables) from the stored data. Returns rows indexed per table."""
+    tables = [table] if table else list(INDEXED_TABLES)
+    cipher = get_cipher()
+    counts = {}
+    for t in tables:
+        if t not in INDEXED_TABLES:
+            raise ValueError(f"Table {t} is not indexed")
+        pk = database.PRIMARY_KEYS[t]
+        columns = _indexed_columns(t)
+        counts[t] = 0
+        with transaction() as conn:
+            conn.execute("DELETE FROM SearchTokens WHERE table_name = ?", (t,))
+            cursor = conn.execute(f"SELECT {pk}, {', '.join(columns)} FROM {t}")
+            while True:
+                rows = cursor.fetchmany(500)
+                if not rows:
+                    break
+                token_rows = []
+                for row in rows:
+                    for column, value in zip(columns, row[1:]):
+                        try:
+                            plaintext = cipher.decrypt(value).decode('utf-8') if isinstance(value, (bytes, bytearray)) else value
+                        except Exception:
+                            continue
+                        token_rows += _token_rows(t, row[0], column, plaintext)
+                conn.executemany("INSERT INTO SearchTokens (table_name, row_id, column_name, token) VALUES (?, ?, ?, ?)", token_rows)
+                counts[t] += len(rows)
+            conn.execute("INSERT OR REPLACE INTO SearchIndexState (table_name, built) VALUES (?, 1)", (t,))
+    return counts
+
+
+def main(argv):
+    if len(argv) < 2 or argv[1] != "rebuild":
+        print("Usage: python search_index.py rebuild [Users|Travellers|Scooters]")
+        return 1
+    database.create_or_connect_db()
+    for table, count in rebuild(argv[2] if len(argv) > 2 else None).items():
+        print(f"{table}: indexed {count} rows")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
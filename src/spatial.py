@@ -0,0 +1,135 @@
+"""Location queries over the ScooterLocations R*Tree (nearest, bounding box, radius).
+
+The R*Tree stores coordinates as 32-bit floats rounded outwards, so it is only used to find
+candidates; exact latitude/longitude from Scooters decide the result. Distances are great-circle
+distances in kilometres.
+"""
+import math
+
+import database
+from crypto_pool import LazyRow
+from db_connection import get_connection
+
+EARTH_RADIUS_KM = 6371.0088
+# Must match EARTH_RADIUS_KM: a larger value makes the candidate boxes smaller than the circles they cover
+KM_PER_DEGREE_LAT = math.pi * EARTH_RADIUS_KM / 180
+
+# First search radius for nearest(); it doubles until enough scooters are found
+NEAREST_START_KM = 0.5
+
+COLUMNS = ["scooter_id"] + list(database.ALLOWED_COLUMNS['Scooters']) + ["in_service_date"]
+
+
+def distance_km(lat1, lon1, lat2, lon2):
+    """Haversine distance between two points in kilometres."""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lon2 - lon1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def _box_around(lat, lon, radius_km):
+    """(min_lat, min_lon, max_lat, max_lon) containing every point within radius_km of (lat, lon)."""
+    d_lat = radius_km / KM_PER_DEGREE_LAT
+    min_lat, max_lat = max(-90.0, lat - d_lat), min(90.0, lat + d_lat)
+    cos_lat = math.cos(math.radians(max(abs(min_lat), abs(max_lat))))
+    if cos_lat <= 1e-9 or radius_km / (KM_PER_DEGREE_LAT * cos_lat) >= 180.0:
+        return min_lat, -180.0, max_lat, 180.0
+    d_lon = radius_km / (KM_PER_DEGREE_LAT * cos_lat)
+    min_lon, max_lon = lon - d_lon, lon + d_lon
+    if min_lon < -180.0 or max_lon > 180.0:
+        # Crosses the antimeridian; search the whole longitude band rather than two boxes
+        return min_lat, -180.0, max_lat, 180.0
+    return min_lat, min_lon, max_lat, max_lon
+
+
+def _candidates(min_lat, min_lon, max_lat, max_lon):
+    """(scooter_id, latitude, longitude) of the scooters inside the box."""
+    return get_connection().execute(
+        """SELECT s.scooter_id, s.latitude, s.longitude
+           FROM ScooterLocations AS l JOIN Scooters AS s ON s.scooter_id = l.id
+           WHERE l.max_lat >= ? AND l.min_lat <= ? AND l.max_lon >= ? AND l.min_lon <= ?
+             AND s.latitude BETWEEN ? AND ? AND s.longitude BETWEEN ? AND ?""",
+        (min_lat, max_lat, min_lon, max_lon, min_lat, max_lat, min_lon, max_lon)
+    ).fetchall()
+
+
+def _rows(ids, distances=None):
+    """[header, row, ...] for the given scooter ids, in that order, with an optional DISTANCE_KM column."""
+    header = [c.upper() for c in COLUMNS]
+    if distances is not None:
+        header.append("DISTANCE_KM")
+    if not ids:
+        return [header]
+    placeholders = ", ".join("?" for _ in ids)
+    fetched = get_connection().execute(
+        f"SELECT {', '.join(COLUMNS)} FROM Scooters WHERE scooter_id IN ({placeholders})", list(ids)
+    ).fetchall()
+    by_id = {row[0]: row for row in fetched}
+    rows = []
+    for i, scooter_id in enumerate(ids):
+        if scooter_id not in by_id:
+            continue
+        raw = by_id[scooter_id]
+        if distances is not None:
+            raw = raw + (round(distances[i], 3),)
+        rows.append(LazyRow(raw))
+    return [header] + rows
+
+
+def _check_point(lat, lon):
+    if not (-90.0 <= lat <= 90.0 and -180.0 <= lon <= 180.0):
+        raise ValueError("Latitude must be within -90..90 and longitude within -180..180")
+
+
+def in_bbox(min_lat, min_lon, max_lat, max_lon, limit=None):
+    """Scooters inside the box, ordered by scooter_id. Returns [header, row, ...] like search()."""
+    _check_point(min_lat, min_lon)
+    _check_point(max_lat, max_lon)
+    if min_lat > max_lat or min_lon > max_lon:
+        raise ValueError("The minimum corner must be south-west of the maximum corner")
+    ids = sorted(row[0] for row in _candidates(min_lat, min_lon, max_lat, max_lon))
+    if limit is not None:
+        ids = ids[:limit]
+    return _rows(ids)
+
+
+def within_radius(lat, lon, radius_km, limit=None):
+    """Scooters within radius_km of the point, nearest first, with their distance."""
+    _check_point(lat, lon)
+    if radius_km < 0:
+        raise ValueError("Radius must not be negative")
+    found = []
+    for scooter_id, s_lat, s_lon in _candidates(*_box_around(lat, lon, radius_km)):
+        distance = distance_km(lat, lon, s_lat, s_lon)
+        if distance <= radius_km:
+            found.append((distance, scooter_id))
+    found.sort()
+    if limit is not None:
+        found = found[:limit]
+    return _rows([scooter_id for _d, scooter_id in found], [d for d, _id in found])
+
+
+def nearest(lat, lon, k=5):
+    """The k scooters nearest to the point, nearest first, with their distance.
+
+    Searches a growing box around the point; a candidate only counts once it lies within the
+    radius the box is guaranteed to cover, so the result is exact.
+    """
+    _check_point(lat, lon)
+    if k <= 0:
+        return _rows([], [])
+    radius = NEAREST_START_KM
+    while True:
+        found = []
+        for scooter_id, s_lat, s_lon in _candidates(*_box_around(lat, lon, radius)):
+            distance = distance_km(lat, lon, s_lat, s_lon)
+            if distance <= radius:
+                found.append((distance, scooter_id))
+        if len(found) >= k or radius >= math.pi * EARTH_RADIUS_KM:
+            break
+        radius *= 2
+    found.sort()
+    found = found[:k]
+    return _rows([scooter_id for _d, scooter_id in found], [d for d, _id in found])
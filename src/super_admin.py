@@ -1,10 +1,16 @@
-import sqlite3
 import database
+from db_connection import get_connection, transaction
+import search_index
+import row_cache
+import backup
+import backup_repo
+import backup_scheduler
 
 import um_members
 import traveller
 import user
 import scooter_logic
+import log_query
 from validation import (
     validate_first_name,
     validate_last_name,
@@ -20,24 +26,23 @@ from validation import (
     validate_username,
     )
 
-from log_config import logmanager as log_manager
-log_instance = log_manager()
+from log_config import log_instance
 
 import bcrypt
 from safe_data import private_key, decrypt_data
 
 from search import search, display_search_results
 
+import acl
 from acl import require_role
 
 from ui_helpers import prompt_with_back, clear as ui_clear
 
 import time
 import datetime
-import random
 import zipfile
+import sqlite3
 import os
-import shutil
 import secrets
 import string
 
@@ -50,7 +55,7 @@ super_password="Admin_123?"
 def menu():
     while True:
         um_members.clear()
-        log_instance.show_notifications()
+        log_instance.show_notifications(super_username)
         print("\n--- Super Administrator Menu ---")
         print(f"--Welcome super admin--\n")
         print("1. List of users")
@@ -90,8 +95,7 @@ def menu():
             time.sleep(2)
 
 def list_users(username, role_filter=None):
-    connection = sqlite3.connect("scooterfleet.db")
-    cursor = connection.cursor()
+    cursor = get_connection().cursor()
 
     if role_filter:
         cursor.execute("SELECT id, username, role_level FROM users WHERE role_level =?" ,(role_filter,))
@@ -124,7 +128,6 @@ def list_users(username, role_filter=None):
         pass
     display_search_results(search_results, show_numbers=False)
     input("Press Enter to return...")
-    connection.close()
 
 def service_engineer_menu(username):
     while True:
@@ -190,16 +193,14 @@ def systemadmin_menu(username):
             log_instance.log_activity(username, "System", "Invalid input in the admin menu", "No")
 
 def system_menu(username, role):
-    connection = sqlite3.connect("scooterfleet.db")
-    cursor = connection.cursor()
     while True:
         um_members.clear()
+        # A restore replaces the database file, so the cursor is taken per pass
+        cursor = get_connection().cursor()
 
         if not os.path.exists('backup'):
             os.makedirs('backup')
-        backup_path = "backup/backup.sql"
-        zip_path = "backup/backup.zip"
-        log_dir = "logs"
+        legacy_zip_path = "backup/backup.zip"
 
         print("\n--- System menu ---")
         print("1. Make a backup")
@@ -208,22 +209,30 @@ def system_menu(username, role):
             print("3. Generate one-use restore code for system admin")
             print("4. Revoke a restore code")
             print("5. See logs")
-            print("6. Go back")
+            print("6. Search logs")
+            print("7. See suspicious activity")
+            print("8. Backup status")
+            print("9. Go back")
         else:
             print("3. See logs")
-            print("4. Go back")
+            print("4. Search logs")
+            print("5. See suspicious activity")
+            print("6. Backup status")
+            print("7. Go back")
 
         choice = input("Choose an option: ").strip()
 
         if choice == "1":
-            create_zip(backup_path, log_dir, zip_path)
-            print("Backup created")
-            log_instance.log_activity(username, "System", "Backup created", "No")
+            if backup_scheduler.start_backup(username):
+                print("Backup started in the background; its result shows under Backup status")
+                log_instance.log_activity(username, "System", "Backup started", "No")
+            else:
+                print("A backup is already running")
             time.sleep(2)
         elif choice == "2":
             if role == "super_admin":
-                restore_backup("scooterfleet.db", zip_path)
-                log_instance.log_activity(username, "System", "Backup restored", "No")
+                if restore_backup(backup_repo.latest_manifest() or backup.latest_archive() or legacy_zip_path):
+                    log_instance.log_activity(username, "System", "Backup restored", "No")
             else:
                 code = input("Enter restore code: ").strip()
                 cursor.execute("SELECT id, admin_user_id, backup_filename, used FROM RestoreCodes WHERE code = ?", (code,))
@@ -233,69 +242,64 @@ def system_menu(username, role):
                     log_instance.log_activity(username, "System", "Invalid restore code attempt", "Yes")
                 else:
                     code_id, admin_user_id, backup_filename, used = row
-                    cursor.execute("SELECT id, username FROM Users WHERE role_level='system_admin'")
-                    admins = cursor.fetchall()
-                    current_admin_id = None
-                    for aid, enc_uname in admins:
-                        if decrypt_data(private_key(), enc_uname) == username:
-                            current_admin_id = aid
-                            break
+                    admin_row = database.find_user_by_username(username, role_level='system_admin')
+                    current_admin_id = admin_row[0] if admin_row else None
                     if used or current_admin_id != admin_user_id:
                         print("Restore code not valid for this account or already used.")
                         log_instance.log_activity(username, "System", "Restore code invalid/used", "Yes")
-                    else:
-                        restore_backup("scooterfleet.db", backup_filename)
-                        cursor.execute("UPDATE RestoreCodes SET used = 1 WHERE id = ?", (code_id,))
-                        connection.commit()
+                    elif restore_backup(backup_filename):
+                        get_connection().execute("UPDATE RestoreCodes SET used = 1 WHERE id = ?", (code_id,))
                         log_instance.log_activity(username, "System", "Backup restored using restore code", "No")
             time.sleep(2)
         elif choice == "3" and role == "super_admin":
             admin_username = input("Enter system admin username to authorize: ").strip().lower()
-            cursor.execute("SELECT id, username FROM Users WHERE role_level = 'system_admin'")
-            admins = cursor.fetchall()
-            target_id = None
-            for aid, enc_uname in admins:
-                if decrypt_data(private_key(), enc_uname).lower() == admin_username:
-                    target_id = aid
-                    break
+            admin_row = database.find_user_by_username(admin_username, role_level='system_admin')
+            target_id = admin_row[0] if admin_row else None
             if not target_id:
                 print("System admin not found.")
                 time.sleep(2)
                 continue
             code = ''.join(secrets.choice(string.ascii_uppercase + string.digits) for _ in range(10))
-            code_zip = f"backup/backup_{int(time.time())}.zip"
-            create_zip(backup_path, log_dir, code_zip)
-            cursor.execute("INSERT INTO RestoreCodes (code, admin_user_id, backup_filename, used) VALUES (?, ?, ?, 0)", (code, target_id, code_zip))
-            connection.commit()
-            print(f"Restore code generated: {code}\nLinked backup: {code_zip}")
+            print("Making the backup for the code...")
+            manifest_path, _stats = backup_scheduler.run_now(username)
+            cursor.execute("INSERT INTO RestoreCodes (code, admin_user_id, backup_filename, used) VALUES (?, ?, ?, 0)", (code, target_id, manifest_path))
+            print(f"Restore code generated: {code}\nLinked backup: {manifest_path}")
             log_instance.log_activity(username, "System", f"Generated restore code for {admin_username}", "No")
             input("Press Enter to continue...")
         elif (choice == "4" and role == "super_admin") or (choice == "3" and role != "super_admin"):
             if role == "super_admin":
                 code = input("Enter code to revoke: ").strip()
                 cursor.execute("DELETE FROM RestoreCodes WHERE code = ?", (code,))
-                connection.commit()
                 print("Restore code revoked (if existed).")
                 log_instance.log_activity(username, "System", "Restore code revoked", "No")
                 time.sleep(2)
             else:
                 date = input("Keep empty for today's logs or enter date (yyyy-mm-dd): ").strip()
                 um_members.clear()
-                log_instance.see_logs(date)
+                log_instance.see_logs(date, username)
         elif (choice == "5" and role == "super_admin") or (choice == "4" and role != "super_admin"):
             if role == "super_admin":
                 date = input("Keep empty for today's logs or enter date (yyyy-mm-dd): ").strip()
                 um_members.clear()
-                log_instance.see_logs(date)
+                log_instance.see_logs(date, username)
             else:
-                break
+                um_members.clear()
+                log_query.query_logs_menu(username)
         elif (choice == "6" and role == "super_admin"):
+            um_members.clear()
+            log_query.query_logs_menu(username)
+        elif (choice == "7" and role == "super_admin") or (choice == "5" and role != "super_admin"):
+            um_members.clear()
+            log_instance.see_suspicious(username)
+        elif (choice == "8" and role == "super_admin") or (choice == "6" and role != "super_admin"):
+            um_members.clear()
+            show_backup_status()
+        elif (choice == "9" and role == "super_admin") or (choice == "7" and role != "super_admin"):
             break
         else:
             print("Invalid input")
             log_instance.log_activity(username, "System", "Invalid input in the system menu", "No")
             time.sleep(2)
-    connection.close()
 
 def traveller_menu(username):
     while True:
@@ -334,7 +338,9 @@ def scooter_menu(username, role):
         print("2. Modify scooter")
         print("3. Delete scooter" if role != "service_engineer" else "")
         print("4. Search scooter")
-        print("5. Go back")
+        print("5. Filter scooters")
+        print("6. Find scooters near a location")
+        print("7. Go back")
         choice = input("Choose an option: ").strip()
 
         if choice == "1" and role != "service_engineer":
@@ -346,6 +352,10 @@ def scooter_menu(username, role):
         elif choice == "4":
             search_people("scooter", username)
         elif choice == "5":
+            scooter_logic.filter_scooters_menu(username)
+        elif choice == "6":
+            scooter_logic.nearby_scooters_menu(username)
+        elif choice == "7":
             break
         else:
             print("Invalid input")
@@ -394,7 +404,7 @@ def modify_user(role, username):
             if choice is None:
                 print("Operation canceled.")
                 break
-            if 1 <= choice <= len(search_results) - 1:
+            if search_results.has_match(choice):
                 selected_result = search_results[choice]
                 um_members.clear()
             else:
@@ -471,13 +481,13 @@ def modify_user(role, username):
             if search_term is None:
                 break
             search_results = search(search_term, "Travellers")
-            if (len(search_results) == 0):
+            if not search_results:
                 um_members.clear()
                 print("No travellers found")
                 time.sleep(2)
                 return
             else:
-                traveller_to_update = show_travellers(search_results[1:], username, from_modify=True)
+                traveller_to_update = show_travellers(search_results, username, from_modify=True)
                 if traveller_to_update is None:
                     break
                 while True:
@@ -544,8 +554,7 @@ def modify_user(role, username):
 
 @require_role('system_admin')
 def delete_user(role, username):
-    connection = sqlite3.connect("scooterfleet.db")
-    cursor = connection.cursor()
+    cursor = get_connection().cursor()
 
     while True:
         print(f"\n--- Delete {role} ---")
@@ -569,7 +578,7 @@ def delete_user(role, username):
                 print("Invalid input")
                 time.sleep(2)
                 break
-            if choice < 1 or choice > len(results)-1:
+            if not results.has_match(choice):
                 print("Invalid choice")
                 time.sleep(2)
                 break
@@ -589,8 +598,7 @@ def delete_user(role, username):
                 print("Delete cancelled")
                 time.sleep(1)
                 break
-            cursor.execute("DELETE FROM Travellers WHERE customer_id = ?", (cust_id,))
-            connection.commit()
+            database.delete_row('Travellers', cust_id)
             print(f"{role.capitalize()} deleted successfully")
             log_instance.log_activity(username, "Delete traveller", f"Deleted traveller with id: {cust_id}", "No")
             time.sleep(2)
@@ -608,7 +616,7 @@ def delete_user(role, username):
             if choice is None:
                 break
             try:
-                if choice < 1 or choice > len(search_results)-1:
+                if not search_results.has_match(choice):
                     um_members.clear()
                     print("Invalid choice. Please select a valid number.")
                     time.sleep(2)
@@ -625,8 +633,7 @@ def delete_user(role, username):
                 print("Delete cancelled")
                 time.sleep(1)
                 break
-            cursor.execute("DELETE FROM Users WHERE id = ?", (selected_id,))
-            connection.commit()
+            database.delete_row('Users', selected_id)
             print("User deleted successfully")
             try:
                 enc_uname = selected[1]
@@ -640,9 +647,8 @@ def delete_user(role, username):
 @require_role('system_admin')
 def reset_pw(role, username):
     um_members.clear()
-    connection = sqlite3.connect("scooterfleet.db")
-    cursor = connection.cursor()
-    
+    cursor = get_connection().cursor()
+
     while True:
         print(f"\n--- Reset password of {role} ---")
         search_results = search_people(role, username)
@@ -687,7 +693,6 @@ def reset_pw(role, username):
         else:
             decrypted_name = decrypt_data(private_key(), user_to_change[0][0])
             cursor.execute("UPDATE Users SET password = ? WHERE id = ?", (bcrypt.hashpw("Temp_123?456".encode('utf-8'), bcrypt.gensalt()), pw_to_reset))
-            connection.commit()
             print("Password reset successfully")
             log_instance.log_activity(username, "Reset password", f"Reset password of {role} with username: {decrypted_name}", "No")
             time.sleep(2)
@@ -695,9 +700,6 @@ def reset_pw(role, username):
 
 @require_role('system_admin')
 def add_traveller(username):
-    connection = sqlite3.connect("scooterfleet.db")
-    cursor = connection.cursor()
-
     um_members.clear()
     print("\n--- Register Traveller ---")
 
@@ -727,18 +729,7 @@ def add_traveller(username):
     mobile = input_and_validate("Enter 8-digit mobile (DDDDDDDD): ", validate_phone_number)
     driving_license = input_and_validate("Enter driving license (XXDDDDDDD or XDDDDDDDD): ", validate_driving_license)
 
-    current_date = str(datetime.datetime.now().year)
-    customer_id = current_date[-2:]
-    checksum = sum(int(d) for d in customer_id)
-    for _ in range(7):
-        rn = random.randint(0, 9)
-        customer_id += str(rn)
-        checksum += rn
-    checksum %= 10
-    customer_id += str(checksum)
-
     data = (
-        customer_id,
         database.validate_and_prepare_value('Travellers', 'first_name', first_name),
         database.validate_and_prepare_value('Travellers', 'last_name', last_name),
         database.validate_and_prepare_value('Travellers', 'birthday', birthday),
@@ -752,15 +743,20 @@ def add_traveller(username):
         database.validate_and_prepare_value('Travellers', 'driving_license_number', driving_license)
     )
 
-    cursor.execute("""
-        INSERT INTO Travellers (
-            customer_id, first_name, last_name, birthday, gender, street_name,
-            house_number, zip_code, city, email, mobile_phone, driving_license_number
-        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    """, data)
-
-    connection.commit()
-    connection.close()
+    with transaction() as connection:
+        customer_id = database.unused_customer_ids(connection, 1)[0]
+        connection.execute("""
+            INSERT INTO Travellers (
+                customer_id, first_name, last_name, birthday, gender, street_name,
+                house_number, zip_code, city, email, mobile_phone, driving_license_number
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (customer_id,) + data)
+        search_index.index_row(connection, 'Travellers', customer_id, {
+            'first_name': first_name, 'last_name': last_name, 'birthday': birthday, 'gender': gender,
+            'street_name': street, 'house_number': house_number, 'zip_code': zip_code, 'city': city,
+            'email': email, 'mobile_phone': "+31-6-" + mobile, 'driving_license_number': driving_license
+        })
+    row_cache.invalidate('Travellers', customer_id)
 
     um_members.clear()
     print("Traveller registered successfully")
@@ -800,7 +796,7 @@ def search_people(role, username):
             time.sleep(2)
             return None
         else:
-            id_to_update = show_travellers(search_results[1:], username, from_modify=False)
+            id_to_update = show_travellers(search_results, username, from_modify=False)
             return id_to_update
     elif role in ["system_admin", "service_engineer"]:
         search_results = search(search_term, "Users", role=role)
@@ -822,6 +818,7 @@ def search_people(role, username):
         return None
 
 def show_travellers(travellers, username, from_modify=False):
+    # travellers is a SearchResults: [0] is the header, records are pulled one page at a time
     if not travellers:
         um_members.clear()
         print("No travellers found")
@@ -830,13 +827,14 @@ def show_travellers(travellers, username, from_modify=False):
 
     from ui_helpers import prompt_with_back, clear as ui_clear
 
-    current = 0
+    current = 1
     while True:
         ui_clear()
         print("\n--- Traveller Data ---")
         traveller.ShowData(travellers[current])
 
-        print(f"\n--- page {current + 1} / {len(travellers)} ---")
+        total = str(travellers.loaded) if travellers.exhausted else f"{travellers.loaded}+"
+        print(f"\n--- page {current} / {total} ---")
         print("N. Next")
         print("P. Previous")
         print("B. Go back")
@@ -849,21 +847,21 @@ def show_travellers(travellers, username, from_modify=False):
             return None
         choice = choice.lower()
         if choice == "n":
-            if current == len(travellers) - 1:
+            if not travellers.has_match(current + 1):
                 print("You have reached the last page")
                 time.sleep(2)
             else:
                 current += 1
         elif choice == "p":
-            if current == 0:
+            if current == 1:
                 print("You are already at the first page")
                 time.sleep(2)
             else:
                 current -= 1
         else:
             try:
-                idx = int(choice) - 1
-                if idx < 0 or idx >= len(travellers):
+                idx = int(choice)
+                if not travellers.has_match(idx):
                     ui_clear()
                     print("Invalid input")
                     log_instance.log_activity(username, "Search traveller", "Invalid input in search traveller", "No")
@@ -876,56 +874,44 @@ def show_travellers(travellers, username, from_modify=False):
                 time.sleep(2)
                 return None
 
-def make_backup(backup_path):
-    connection = sqlite3.connect("scooterfleet.db")
-    with open(backup_path, 'w') as backup_file:
-        for line in connection.iterdump():
-            backup_file.write('%s\n' % line)
-    connection.close()
-    
-def collect_log_files(log_dir, temp_dir):
-    if not os.path.exists(temp_dir):
-        os.makedirs(temp_dir)
-    today = datetime.date.today()
-    thirty_days_ago = today - datetime.timedelta(days=30)
-    for filename in os.listdir(log_dir):
-        filepath = os.path.join(log_dir, filename)
-        if os.path.isfile(filepath):
-            modified_time = datetime.date.fromtimestamp(os.path.getmtime(filepath))
-            if modified_time >= thirty_days_ago:
-                shutil.copy(filepath, temp_dir)
-
-def create_zip(backup_path, log_dir, zip_path):
-    temp_dir = 'temp_logs'
-    make_backup(backup_path)
-    collect_log_files(log_dir, temp_dir)
-    with zipfile.ZipFile(zip_path, 'w') as zipf:
-        zipf.write(backup_path, os.path.basename(backup_path))
-        for log_file in os.listdir(temp_dir):
-            log_file_path = os.path.join(temp_dir, log_file)
-            zipf.write(log_file_path, os.path.basename(log_file_path))
-    shutil.rmtree(temp_dir)
-
-def restore_backup(db_path, zip_path):
-    if not os.path.exists(zip_path):
+def _format_time(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S') if timestamp else "never"
+
+def show_backup_status():
+    status = backup_scheduler.status()
+    print("\n--- Backup status ---")
+    if status['running']:
+        print(f"Running: started {_format_time(status['running']['started'])} by {status['running']['trigger']}")
+    print(f"Last backup: {_format_time(status.get('last_run'))}")
+    if status.get('last_run'):
+        print(f"  by {status.get('trigger')}, took {status.get('duration', 0):.1f} s, "
+              f"{status.get('total_bytes', 0) / 1e6:.1f} MB backed up, {status.get('new_bytes', 0) / 1e6:.1f} MB new")
+        print(f"  {status.get('manifest')}")
+    if status.get('last_error'):
+        print(f"Last failure: {_format_time(status.get('last_error_at'))}: {status['last_error']}")
+    if status['next_run']:
+        print(f"Next scheduled check: {_format_time(status['next_run'])} (every {status['interval'] / 3600:g} h, skipped when nothing changed)")
+    else:
+        print("Scheduled backups are off")
+    print(f"Repository size: {backup_repo.disk_usage() / 1e6:.1f} MB")
+    input("\nPress Enter to go back")
+
+def restore_backup(zip_path):
+    if not zip_path or not os.path.exists(zip_path):
         print("No backup found")
         time.sleep(2)
-        return
-    else:
-        connection = sqlite3.connect(db_path)
-        cursor = connection.cursor()
-        database.clear_database()
-        with zipfile.ZipFile(zip_path, 'r') as zipf:
-            zipf.extractall('backup')
-        backup_file_path = os.path.join('backup', 'backup.sql')
-        with open(backup_file_path, 'r') as backup_file:
-            sql_script = backup_file.read()
-            cursor.executescript(sql_script)
-        connection.commit()
-        connection.close()
-        if os.path.exists('backup'):
-            for file in os.listdir('backup'):
-                os.remove(os.path.join('backup', file))
-            os.rmdir('backup')
-        print("Backup restored")
+        return False
+    if backup_scheduler.status()['running']:
+        print("Waiting for the running backup to finish...")
+    try:
+        with backup_scheduler.exclusive():
+            backup.restore_archive(zip_path)
+    except (backup.BackupError, sqlite3.DatabaseError, zipfile.BadZipFile) as e:
+        print(f"Restore failed, the database was not changed: {e}")
         time.sleep(2)
+        return False
+    # Users may differ in the restored database
+    acl.invalidate()
+    print("Backup restored")
+    time.sleep(2)
+    return True
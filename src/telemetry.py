@@ -0,0 +1,295 @@
+"""Telemetry ingestion: state of charge, position and mileage reported by the scooters themselves.
+
+Records are read line by line from files, a pipe (`-` for stdin) or a local socket
+(`unix:/path/to/socket`, any number of clients). A line is either CSV
+
+    serial_number,soc,lat,lon,mileage,ts
+
+or a JSON object with those keys; ts is Unix time in seconds or an ISO 8601 string.
+Scooters are found by the blind index on serial_number, so no row is decrypted.
+
+Updates are collected for WINDOW seconds (or until MAX_BATCH scooters are waiting). Within a
+window only the newest record per scooter is kept, and a record older than the last one
+applied to that scooter is dropped. Each window is then written with one executemany in one
+short transaction, so interactive users wait at most for one batch and never for the stream.
+
+Usage: python telemetry.py SOURCE [SOURCE ...]
+"""
+import datetime
+import json
+import math
+import os
+import queue
+import re
+import socket
+import sys
+import threading
+import time
+
+import database
+from db_connection import transaction
+from log_config import log_instance
+
+# Seconds updates are coalesced before they are written
+WINDOW = float(os.environ.get('UM_TELEMETRY_WINDOW', '1.0'))
+# Scooters per transaction; a full window is written early
+MAX_BATCH = int(os.environ.get('UM_TELEMETRY_BATCH', '5000'))
+# Lines read ahead of the writer; readers wait when it is full
+QUEUE_SIZE = 100000
+# Seconds a serial number -> scooter lookup (or an unknown serial) is trusted
+ID_TTL = 60.0
+REPORT_INTERVAL = 5.0
+
+SERIAL = re.compile(r'^[A-Za-z0-9]{10,17}$')
+FIELDS = ('serial_number', 'soc', 'lat', 'lon', 'mileage', 'ts')
+
+_UPDATE = ("UPDATE Scooters SET state_of_charge = ?, latitude = ?, longitude = ?, mileage = ? "
+           "WHERE scooter_id = ?")
+_END = object()
+
+
+def configure(window=None, max_batch=None):
+    global WINDOW, MAX_BATCH
+    if window is not None:
+        WINDOW = max(0.0, float(window))
+    if max_batch is not None:
+        MAX_BATCH = max(1, int(max_batch))
+
+
+def _timestamp(value):
+    if isinstance(value, str) and not re.match(r'^-?[0-9.]+$', value.strip()):
+        moment = datetime.datetime.fromisoformat(value.strip().replace('Z', '+00:00'))
+        return moment.timestamp()
+    return float(value)
+
+
+def parse_record(line):
+    """(serial_number, soc, lat, lon, mileage, ts) from a CSV or JSON line, or raise ValueError."""
+    line = line.strip()
+    if line.startswith('{'):
+        data = json.loads(line)
+        try:
+            values = [data[field] for field in FIELDS]
+        except KeyError as e:
+            raise ValueError(f"missing {e.args[0]}")
+    else:
+        values = [value.strip() for value in line.split(',')]
+        if len(values) != len(FIELDS):
+            raise ValueError(f"expected {len(FIELDS)} fields")
+    serial = str(values[0])
+    if not SERIAL.match(serial):
+        raise ValueError("invalid serial_number")
+    soc = int(float(values[1]))
+    lat, lon, mileage = float(values[2]), float(values[3]), float(values[4])
+    ts = _timestamp(values[5])
+    if not 0 <= soc <= 100:
+        raise ValueError("soc out of range")
+    if not (-90.0 <= lat <= 90.0 and -180.0 <= lon <= 180.0):
+        raise ValueError("position out of range")
+    if not (math.isfinite(mileage) and mileage >= 0) or not math.isfinite(ts):
+        raise ValueError("invalid mileage or ts")
+    return serial, soc, lat, lon, mileage, ts
+
+
+class Ingestor:
+    """Coalesces parsed records per scooter and writes them in batches."""
+
+    def __init__(self):
+        self.pending = {}
+        self.applied_ts = {}
+        self.stats = {'received': 0, 'invalid': 0, 'coalesced': 0, 'unknown': 0, 'stale': 0,
+                      'written': 0, 'batches': 0}
+        self._ids = {}
+        self._ids_loaded = time.monotonic()
+
+    def add_line(self, line):
+        if not line.strip():
+            return
+        self.stats['received'] += 1
+        try:
+            record = parse_record(line)
+        except (ValueError, TypeError):
+            self.stats['invalid'] += 1
+            return
+        previous = self.pending.get(record[0])
+        if previous is not None:
+            self.stats['coalesced'] += 1
+            if previous[5] > record[5]:
+                return
+        self.pending[record[0]] = record
+
+    def _resolve(self, serials):
+        """serial_number -> scooter_id (None when unknown) for serials, looking up the missing ones."""
+        if time.monotonic() - self._ids_loaded > ID_TTL:
+            # Scooters are added, deleted and renumbered now and then
+            self._ids.clear()
+            self._ids_loaded = time.monotonic()
+        missing = {database.blind_index(serial): serial for serial in serials if serial not in self._ids}
+        if missing:
+            for serial in missing.values():
+                self._ids[serial] = None
+            rows = database.get_connection().execute(
+                "SELECT serial_index, scooter_id FROM Scooters WHERE serial_index IN (SELECT value FROM json_each(?))",
+                (json.dumps(list(missing)),))
+            for index, scooter_id in rows:
+                self._ids[missing[index]] = scooter_id
+        return self._ids
+
+    def flush(self):
+        """Write the pending updates. Returns the number of scooters updated."""
+        if not self.pending:
+            return 0
+        records, self.pending = self.pending, {}
+        ids = self._resolve(records)
+        rows = []
+        for serial, (_serial, soc, lat, lon, mileage, ts) in records.items():
+            scooter_id = ids.get(serial)
+            if scooter_id is None:
+                self.stats['unknown'] += 1
+            elif ts <= self.applied_ts.get(scooter_id, float('-inf')):
+                self.stats['stale'] += 1
+            else:
+                rows.append((soc, lat, lon, mileage, scooter_id, ts))
+        # In primary key order, so the pages are visited once and front to back
+        rows.sort(key=lambda row: row[4])
+        for start in range(0, len(rows), MAX_BATCH):
+            batch = rows[start:start + MAX_BATCH]
+            with transaction() as conn:
+                conn.executemany(_UPDATE, (row[:5] for row in batch))
+            for row in batch:
+                self.applied_ts[row[4]] = row[5]
+            self.stats['batches'] += 1
+        self.stats['written'] += len(rows)
+        return len(rows)
+
+
+def _read_source(path, lines):
+    try:
+        if path == '-':
+            for line in sys.stdin:
+                lines.put(line)
+        else:
+            with open(path, encoding='utf-8', errors='replace') as source:
+                for line in source:
+                    lines.put(line)
+    finally:
+        lines.put(_END)
+
+
+def _client(conn, lines):
+    with conn, conn.makefile('r', encoding='utf-8', errors='replace') as stream:
+        for line in stream:
+            lines.put(line)
+
+
+def _listen(path):
+    """A Unix socket at path that only this user can connect to."""
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except OSError:
+            os.remove(path)  # left behind by an ingester that has stopped
+        else:
+            raise RuntimeError(f"Another ingester is listening on {path}")
+        finally:
+            probe.close()
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0o177)
+    try:
+        server.bind(path)
+    finally:
+        os.umask(old_umask)
+    server.listen(16)
+    return server
+
+
+def _accept(server, lines):
+    # Every client sends lines until it disconnects
+    while True:
+        conn, _addr = server.accept()
+        threading.Thread(target=_client, args=(conn, lines), name='telemetry-client', daemon=True).start()
+
+
+def start_readers(sources, lines):
+    """Start a reader thread per source. Returns the number of sources that end (files and pipes)."""
+    ending = 0
+    for source in sources:
+        if source.startswith('unix:'):
+            target, args = _accept, (_listen(source[len('unix:'):]), lines)
+        else:
+            target, args = _read_source, (source, lines)
+            ending += 1
+        threading.Thread(target=target, args=args, name='telemetry-reader', daemon=True).start()
+    return ending
+
+
+def run(sources, report=None):
+    """Ingest from sources until all files and pipes have ended (forever with a socket). Returns the stats."""
+    lines = queue.Queue(QUEUE_SIZE)
+    ending = start_readers(sources, lines)
+    listening = len(sources) > ending
+    ingestor = Ingestor()
+    deadline = time.monotonic() + WINDOW
+    next_report = time.monotonic() + REPORT_INTERVAL
+    try:
+        while ending or listening:
+            try:
+                line = lines.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                line = None
+            if line is _END:
+                ending -= 1
+            elif line is not None:
+                ingestor.add_line(line)
+            now = time.monotonic()
+            if now >= deadline or len(ingestor.pending) >= MAX_BATCH:
+                ingestor.flush()
+                deadline = now + WINDOW
+            if report and now >= next_report:
+                report(ingestor.stats)
+                next_report = now + REPORT_INTERVAL
+    except KeyboardInterrupt:
+        pass
+    finally:
+        ingestor.flush()
+        stats = ingestor.stats
+        log_instance.log_activity("System", "Telemetry ingestion",
+                                  f"{stats['received']} records, {stats['written']} scooter updates, "
+                                  f"{stats['invalid']} invalid, {stats['unknown']} unknown", "No")
+    return ingestor.stats
+
+
+def main(argv):
+    if len(argv) < 2:
+        print("Usage: python telemetry.py FILE|-|unix:SOCKET_PATH [...]")
+        return 1
+    for source in argv[1:]:
+        if source != '-' and not source.startswith('unix:') and not os.path.exists(source):
+            print(f"No such file: {source}")
+            return 1
+    database.create_or_connect_db()
+    started = time.monotonic()
+    last = {'time': started, 'received': 0}
+
+    def progress(stats):
+        now = time.monotonic()
+        rate = (stats['received'] - last['received']) / (now - last['time'])
+        last.update(time=now, received=stats['received'])
+        print(f"{stats['received']} records ({rate:.0f}/sec), {stats['written']} scooter updates, "
+              f"{stats['invalid']} invalid, {stats['unknown']} unknown", flush=True)
+
+    try:
+        stats = run(argv[1:], report=progress)
+    except (RuntimeError, OSError) as e:
+        print(e)
+        return 1
+    elapsed = time.monotonic() - started
+    print(f"Done: {stats['received']} records in {elapsed:.1f} s ({stats['received'] / max(elapsed, 1e-9):.0f}/sec), "
+          f"{stats['written']} scooter updates in {stats['batches']} transactions, {stats['coalesced']} coalesced, "
+          f"{stats['stale']} out of order, {stats['invalid']} invalid, {stats['unknown']} unknown")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
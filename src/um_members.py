@@ -1,15 +1,12 @@
-import engineer
-import admin
-
-import sqlite3
+import acl
 import database
+import backup_scheduler
+from db_connection import get_connection
 
-import bcrypt
 from getpass import getpass
 from safe_data import private_key, decrypt_data
 
-from log_config import logmanager as log_manager
-log_instance = log_manager()
+from log_config import log_instance
 
 import time
 from ui_helpers import clear as ui_clear
@@ -19,6 +16,7 @@ from validation import validate_password
 def main():
     log_instance.log_activity("System", "Program started", "No", "No")
     database.create_or_connect_db()
+    backup_scheduler.start()
     main_menu()
 
 
@@ -38,6 +36,8 @@ def main_menu():
         elif choice == "3":
             print("Exiting the program. Goodbye!")
             log_instance.log_activity("System", "Program exited", "No", "No")
+            backup_scheduler.stop()
+            log_instance.flush()
             break
         else:
             print("Invalid input")
@@ -49,39 +49,36 @@ def Login():
     max_attempts = 3
     attempts = 0
 
-    connection = sqlite3.connect("scooterfleet.db")
-    cursor = connection.cursor()
-    cursor.execute("SELECT username, password, first_name, last_name, role_level FROM Users")
-    data = cursor.fetchall()
-
     while attempts < max_attempts:
         clear()
         print("\n--- Login ---")
         username_input = input("Enter your username: ").strip().lower()
         password_input = getpass("Enter your password: ")
 
-        user_data = []
-        for user in data:
-            decrypted_username = decrypt_data(private_key(), user[0]).lower()
-            if decrypted_username == username_input:
-                user_data = user
-                break
+        user_data = database.find_user_by_username(username_input)
 
         if user_data:
-            decrypted_username = decrypt_data(private_key(), user_data[0])
-            stored_hash = user_data[1]
-            first_name = decrypt_data(private_key(), user_data[2])
-            last_name = decrypt_data(private_key(), user_data[3])
-            role_level = user_data[4]
+            decrypted_username = decrypt_data(private_key(), user_data[1])
+            stored_hash = user_data[2]
+            first_name = decrypt_data(private_key(), user_data[3])
+            last_name = decrypt_data(private_key(), user_data[4])
+            role_level = user_data[5]
 
+            import bcrypt
             if bcrypt.checkpw(password_input.encode('utf-8'), stored_hash):
                 attempts = 0
-                if role_level == "service_engineer":
-                    log_instance.log_activity(decrypted_username, "Login successful", f"{first_name} {last_name} (service engineer) logged in", "No")
-                    engineer.menu(decrypted_username)
-                elif role_level == "system_admin":
-                    log_instance.log_activity(decrypted_username, "Login successful", f"{first_name} {last_name} (system admin) logged in", "No")
-                    admin.menu(decrypted_username)
+                acl.login(decrypted_username, user_data[0], role_level)
+                try:
+                    if role_level == "service_engineer":
+                        log_instance.log_activity(decrypted_username, "Login successful", f"{first_name} {last_name} (service engineer) logged in", "No")
+                        import engineer
+                        engineer.menu(decrypted_username)
+                    elif role_level == "system_admin":
+                        log_instance.log_activity(decrypted_username, "Login successful", f"{first_name} {last_name} (system admin) logged in", "No")
+                        import admin
+                        admin.menu(decrypted_username)
+                finally:
+                    acl.logout(decrypted_username)
                 break
             else:
                 attempts += 1
@@ -94,7 +91,11 @@ def Login():
         elif username_input == super_username and password_input == super_password:
             log_instance.log_activity(super_username, "Login successful", "Super admin logged in", "No")
             import super_admin
-            super_admin.menu()
+            acl.login(super_username, None, "super_admin")
+            try:
+                super_admin.menu()
+            finally:
+                acl.logout(super_username)
             break
         else:
             attempts += 1
@@ -106,7 +107,6 @@ def Login():
             print("User not found")
 
         time.sleep(2)
-    connection.close()
 
 
 def clear():
@@ -172,31 +172,17 @@ def reset_password_with_token():
             continue
         break
 
-    conn = sqlite3.connect("scooterfleet.db")
-    cur = conn.cursor()
-    cur.execute("SELECT id, username FROM Users")
-    rows = cur.fetchall()
-    target_enc = None
-    for _rid, enc_uname in rows:
-        try:
-            if decrypt_data(private_key(), enc_uname).lower() == username:
-                target_enc = enc_uname
-                break
-        except Exception:
-            continue
-
-    if not target_enc:
+    user_row = database.find_user_by_username(username)
+    if not user_row:
         ui_clear()
         print("User not found")
         log_instance.log_activity(username, "Password recovery", "User not found during reset", "Yes")
         time.sleep(2)
-        conn.close()
         return
 
+    import bcrypt
     hashed = bcrypt.hashpw(new_password.encode('utf-8'), bcrypt.gensalt())
-    cur.execute("UPDATE Users SET password = ? WHERE username = ?", (hashed, target_enc))
-    conn.commit()
-    conn.close()
+    get_connection().execute("UPDATE Users SET password = ? WHERE id = ?", (hashed, user_row[0]))
     ui_clear()
     print("Password reset successfully")
     log_instance.log_activity(username, "Password recovery", "Password reset using recovery token", "No")
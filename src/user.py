@@ -1,14 +1,15 @@
-import sqlite3
 import time
 import bcrypt
 from getpass import getpass
-from safe_data import private_key, decrypt_data
+from safe_data import blind_index
 from validation import validate_username, validate_password, validate_first_name, validate_last_name
 import um_members
 import database
+from db_connection import transaction
+import search_index
+import row_cache
 
-from log_config import logmanager as log_manager
-log_instance = log_manager()
+from log_config import log_instance
 
 def create_account(role):
     while True:
@@ -25,22 +26,10 @@ def create_account(role):
                 continue
             normalized = userName.lower()
 
-            connection = sqlite3.connect("scooterfleet.db")
-            cursor = connection.cursor()
-            cursor.execute("SELECT username FROM Users")
-            all_usernames = cursor.fetchall()
-            exists = False
-            for (enc_uname,) in all_usernames:
-                dec = decrypt_data(private_key(), enc_uname).lower()
-                if dec == normalized:
-                    exists = True
-                    break
-            if exists:
+            if database.find_user_by_username(normalized):
                 print("Username already exists. Please choose another username.")
                 log_instance.log_activity("", "Create account failed", "Entered already existing username", "No")
-                connection.close()
                 continue
-            connection.close()
             break
 
 
@@ -87,11 +76,10 @@ def create_account(role):
         enc_firstName = database.validate_and_prepare_value('Users', 'first_name', firstName)
         enc_lastName = database.validate_and_prepare_value('Users', 'last_name', lastName)
 
-        connection = sqlite3.connect("scooterfleet.db")
-        cursor = connection.cursor()
-        cursor.execute("""INSERT INTO Users (username, password, first_name, last_name, role_level)
-                          VALUES (?, ?, ?, ?, ?)""", (enc_username, hashedPassword, enc_firstName, enc_lastName, roleLevel))
-        connection.commit()
-        connection.close()
+        with transaction() as connection:
+            cursor = connection.execute("""INSERT INTO Users (username, password, first_name, last_name, role_level, username_index)
+                              VALUES (?, ?, ?, ?, ?, ?)""", (enc_username, hashedPassword, enc_firstName, enc_lastName, roleLevel, blind_index(normalized)))
+            search_index.index_row(connection, 'Users', cursor.lastrowid, {'username': normalized, 'first_name': firstName, 'last_name': lastName})
+        row_cache.invalidate('Users', cursor.lastrowid)
         log_instance.log_activity("", "Acount created", f"Account created successfully with the username: '{normalized}'", "No")
         break
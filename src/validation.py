@@ -2,15 +2,25 @@ import re
 import datetime
 import database
 
+# Compiled once at import; the bulk importer runs these for every row
+_FIRST_NAME = re.compile(r"^[A-Za-z][A-Za-z'\-]{0,29}$")
+_LAST_NAME = re.compile(r"^[A-Za-z][A-Za-z'\-]*(?: [A-Za-z'\-]+)*$")
+_STREET = re.compile(r"^[A-Za-z]+(?:[ -][A-Za-z]+)*$")
+_POSTAL_CODE = re.compile(r"^[1-9][0-9]{3}[A-Z]{2}$")
+_EMAIL = re.compile(r"^[a-zA-Z0-9._%+\-']+@[a-zA-Z0-9.\-]+\.[A-Za-z]{2,}$")
+_PHONE_NUMBER = re.compile(r"^[0-9]{8}$")
+_DRIVING_LICENSE = re.compile(r"^([A-Z]{2}\d{7}|[A-Z]{1}\d{8})$")
+_USERNAME = re.compile(r"^[A-Za-z_][A-Za-z0-9_'.]{7,9}$")
+_PASSWORD_SPECIAL = r"~!@#$%&_\-+=`|\()\{\}\[\]:;'<>,\.?/"
+_PASSWORD = re.compile(rf"^(?=.*[a-z])(?=.*[A-Z])(?=.*\d)(?=.*[{re.escape(_PASSWORD_SPECIAL)}]).{{12,30}}$")
+_CITIES = frozenset(database.Cities)
 
 
 def validate_first_name(first_name):
-    pattern = r"^[A-Za-z][A-Za-z'\-]{0,29}$"
-    return bool(re.match(pattern, first_name))
+    return bool(_FIRST_NAME.match(first_name))
 
 def validate_last_name(last_name):
-    pattern = r"^[A-Za-z][A-Za-z'\-]*(?: [A-Za-z'\-]+)*$"
-    return bool(re.match(pattern, last_name)) and len(last_name) <= 40
+    return bool(_LAST_NAME.match(last_name)) and len(last_name) <= 40
 
 def validate_birthday(birthday):
     try:
@@ -23,8 +33,7 @@ def validate_gender(gender):
     return gender in ("Male", "Female")
 
 def validate_street(street):
-    pattern = r"^[A-Za-z]+(?:[ -][A-Za-z]+)*$"
-    return bool(re.match(pattern, street)) and len(street) <= 50
+    return bool(_STREET.match(street)) and len(street) <= 50
 
 def validate_house_number(house_number):
     try:
@@ -34,26 +43,22 @@ def validate_house_number(house_number):
         return False
 
 def validate_postal_code(postal_code):
-    pattern = r"^[1-9][0-9]{3}[A-Z]{2}$"
-    return bool(re.match(pattern, postal_code))
+    return bool(_POSTAL_CODE.match(postal_code))
 
 def validate_city(city):
-    return city in database.Cities
+    return city in _CITIES
 
 def validate_email(email):
-    pattern = r"^[a-zA-Z0-9._%+\-']+@[a-zA-Z0-9.\-]+\.[A-Za-z]{2,}$"
-    return bool(re.match(pattern, email)) and len(email) <= 50
+    return bool(_EMAIL.match(email)) and len(email) <= 50
 
 def validate_phone_number(phone_number):
-    return bool(re.match(r"^[0-9]{8}$", phone_number))
+    return bool(_PHONE_NUMBER.match(phone_number))
 
 def validate_driving_license(lic):
-    return bool(re.match(r"^([A-Z]{2}\d{7}|[A-Z]{1}\d{8})$", lic))
+    return bool(_DRIVING_LICENSE.match(lic))
 
 def validate_username(username):
-    return bool(re.match(r"^[A-Za-z_][A-Za-z0-9_'.]{7,9}$", username))
+    return bool(_USERNAME.match(username))
 
 def validate_password(password):
-    special = r"~!@#$%&_\-+=`|\()\{\}\[\]:;'<>,\.?/"
-    pattern = rf"^(?=.*[a-z])(?=.*[A-Z])(?=.*\d)(?=.*[{re.escape(special)}]).{{12,30}}$"
-    return bool(re.match(pattern, password))
\ No newline at end of file
+    return bool(_PASSWORD.match(password))
\ No newline at end of file
@@ -0,0 +1,34 @@
+import os
+import sys
+
+import pytest
+
+SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+sys.path.insert(0, SRC)
+
+
+@pytest.fixture
+def throwaway_key(monkeypatch):
+    """A random data key, so no passphrase is asked and no real data is touched."""
+    from cryptography.fernet import Fernet
+    import safe_data
+    monkeypatch.setattr(safe_data, '_cached_key', Fernet.generate_key())
+    monkeypatch.setattr(safe_data, '_cached_index_key', None)
+    monkeypatch.setattr(safe_data, '_cipher', None)
+    return safe_data._cached_key
+
+
+@pytest.fixture
+def throwaway_db(tmp_path, monkeypatch, throwaway_key):
+    """A fresh database in tmp_path, with the working directory moved there for logs and backups."""
+    import database
+    import db_connection
+    monkeypatch.chdir(tmp_path)
+    db_connection.close_all()
+    monkeypatch.setattr(db_connection, 'DB_PATH', str(tmp_path / 'test.db'))
+    database.create_or_connect_db()
+    yield tmp_path
+    # Queued audit entries are encrypted with the throwaway key, so write them out while it is set
+    from log_config import log_instance
+    log_instance.flush()
+    db_connection.close_all()
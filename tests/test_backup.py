@@ -0,0 +1,38 @@
+import os
+import sqlite3
+
+import backup
+import backup_repo
+import db_connection
+from db_connection import transaction
+
+
+def _count(conn):
+    return conn.execute("SELECT COUNT(*) FROM RestoreCodes").fetchone()[0]
+
+
+def _add_code(code):
+    with transaction() as conn:
+        conn.execute("INSERT INTO RestoreCodes (code, admin_user_id, backup_filename) VALUES (?, 1, 'x')", (code,))
+
+
+def test_restore_keeps_other_connections_working(throwaway_db):
+    _add_code('before')
+    manifest, _stats = backup_repo.create_backup()
+    _add_code('after')
+
+    # Stands in for another process with the database open
+    other = sqlite3.connect(db_connection.DB_PATH, isolation_level=None)
+    assert _count(other) == 2
+    wal = os.stat(db_connection.DB_PATH + '-wal')
+
+    backup.restore_archive(manifest)
+
+    assert _count(db_connection.get_connection()) == 1
+    assert _count(other) == 1
+    assert other.execute("PRAGMA integrity_check").fetchone()[0] == 'ok'
+    # The live WAL was written through, not deleted and recreated under the other connection
+    assert os.stat(db_connection.DB_PATH + '-wal').st_ino == wal.st_ino
+    other.execute("INSERT INTO RestoreCodes (code, admin_user_id, backup_filename) VALUES ('other', 1, 'x')")
+    assert _count(db_connection.get_connection()) == 2
+    other.close()
@@ -0,0 +1,33 @@
+import sqlite3
+
+import backup_repo
+import backup_scheduler
+import db_connection
+
+
+def test_failed_scheduled_backup_is_retried(throwaway_db, monkeypatch):
+    monkeypatch.setattr(backup_scheduler, '_last_version', None)
+    create_backup = backup_repo.create_backup
+    calls = []
+
+    def flaky(*args, **kwargs):
+        calls.append(len(calls))
+        if len(calls) == 2:
+            raise OSError("disk full")
+        return create_backup(*args, **kwargs)
+    monkeypatch.setattr(backup_repo, 'create_backup', flaky)
+
+    backup_scheduler._tick()
+    # Another connection writes, as the menus do on their own threads
+    other = sqlite3.connect(db_connection.DB_PATH, isolation_level=None)
+    other.execute("INSERT INTO RestoreCodes (code, admin_user_id, backup_filename) VALUES ('x', 1, 'x')")
+    other.close()
+    backup_scheduler._tick()
+    assert backup_scheduler.status()['last_error'] == "disk full"
+
+    backup_scheduler._tick()
+    assert len(calls) == 3
+    assert backup_scheduler.status()['last_error'] is None
+    # Nothing written since, so the next check skips
+    backup_scheduler._tick()
+    assert len(calls) == 3
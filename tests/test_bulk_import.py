@@ -0,0 +1,29 @@
+import json
+
+import bulk_import
+
+TRAVELLER = {
+    'first_name': "Anna", 'last_name': "Jansen", 'birthday': "1990-05-17", 'gender': "Female",
+    'street_name': "Coolsingel", 'house_number': "12", 'zip_code': "3011AD", 'city': "Rotterdam",
+    'email': "anna@example.com", 'mobile_phone': "12345678", 'driving_license_number': "AB1234567",
+}
+
+
+def test_import_json_array(throwaway_db):
+    path = throwaway_db / 'travellers.json'
+    path.write_text(json.dumps([TRAVELLER, dict(TRAVELLER, email="not an email"), "not a record"], indent=2))
+
+    stats = bulk_import.import_travellers(str(path))
+
+    assert stats['imported'] == 1
+    assert stats['rejected'] == 2
+    assert stats['errors_path'].endswith('travellers.errors.jsonl')
+    with open(stats['errors_path']) as errors:
+        rejected = [json.loads(line) for line in errors]
+    assert [(entry['line'], entry['error']) for entry in rejected] == [(2, "invalid email"), (3, "not a JSON object")]
+
+
+def test_json_that_is_not_an_array_is_refused(throwaway_db):
+    path = throwaway_db / 'travellers.json'
+    path.write_text(json.dumps(TRAVELLER))
+    assert bulk_import.main(['bulk_import.py', str(path)]) == 1
@@ -0,0 +1,11 @@
+import benchmark
+
+
+def test_startup_defers_heavy_modules(tmp_path):
+    _best, loaded = benchmark.measure_imports(runs=1, cwd=tmp_path)
+    assert loaded == []
+
+
+def test_startup_within_import_budget(tmp_path):
+    best, _loaded = benchmark.measure_imports(runs=5, cwd=tmp_path)
+    assert best <= benchmark.IMPORT_BUDGET_MS, f"import um_members took {best:.1f} ms"
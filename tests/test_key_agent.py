@@ -0,0 +1,18 @@
+import os
+import socket
+
+import key_agent
+
+
+def test_fetch_key_without_unix_sockets(monkeypatch):
+    # As on Windows: no AF_UNIX, no os.getuid
+    monkeypatch.delattr(socket, 'AF_UNIX')
+    monkeypatch.delattr(os, 'getuid')
+    assert key_agent.fetch_key(b'salt') is None
+
+
+def test_fetch_key_swallows_unexpected_errors(monkeypatch):
+    def broken(message):
+        raise ValueError("garbled reply")
+    monkeypatch.setattr(key_agent, '_request', broken)
+    assert key_agent.fetch_key(b'salt') is None
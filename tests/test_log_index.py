@@ -0,0 +1,26 @@
+import log_index
+
+
+def _record(log_dir, count):
+    log_index.record_suspicious(str(log_dir), [(float(i), i * 100, b'\0' * 16) for i in range(count)])
+
+
+def test_compact_drops_events_every_admin_has_read(tmp_path):
+    _record(tmp_path, 5)
+    log_index.set_watermark(str(tmp_path), 'alice', 4)
+    log_index.set_watermark(str(tmp_path), 'bob', 2)
+
+    assert log_index.compact_suspicious(str(tmp_path)) == 2
+
+    assert log_index.suspicious_count(str(tmp_path)) == 3
+    assert log_index.read_watermark(str(tmp_path), 'alice') == 2
+    assert log_index.read_watermark(str(tmp_path), 'bob') == 0
+    # The unread events are still the same ones
+    assert [event[3] for event in log_index.suspicious_events(str(tmp_path), 2, 10)] == [400]
+    assert log_index.compact_suspicious(str(tmp_path)) == 0
+
+
+def test_compact_keeps_everything_without_watermarks(tmp_path):
+    _record(tmp_path, 3)
+    assert log_index.compact_suspicious(str(tmp_path)) == 0
+    assert log_index.suspicious_count(str(tmp_path)) == 3
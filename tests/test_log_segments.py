@@ -0,0 +1,28 @@
+import base64
+
+import log_config
+import log_segments
+import safe_data
+
+
+def _log_line(timestamp, message):
+    return f"{timestamp} - INFO - {base64.b64encode(safe_data.get_cipher().encrypt(message.encode())).decode()}\n"
+
+
+def test_convert_keeps_unreadable_lines(tmp_path, throwaway_key):
+    corrupted = "2024-01-01 12:00:01,000 - WARNING - bm90IGEgZmVybmV0IHRva2Vu"
+    log_path = tmp_path / 'scooterfleet.log.2024-01-01'
+    log_path.write_text(_log_line("2024-01-01 12:00:00,000", "first")
+                        + corrupted + "\n"
+                        + _log_line("2024-01-01 12:00:02,000", "third"))
+
+    log_segments.convert(str(log_path))
+
+    assert not log_path.exists()
+    with log_segments.SegmentReader(str(log_path) + log_segments.EXTENSION) as reader:
+        assert len(reader) == 3
+        assert reader.line(0) == "2024-01-01 12:00:00,000 - INFO - first"
+        assert reader.line(1) == f"2024-01-01 12:00:01,000 - WARNING - {log_config.UNREADABLE}"
+        assert reader.original(1) == corrupted
+        assert reader.original(0) is None
+        assert list(reader)[2] == "2024-01-01 12:00:02,000 - INFO - third"
@@ -0,0 +1,48 @@
+import math
+
+import pytest
+
+import safe_data
+import spatial
+from db_connection import transaction
+
+CENTER = (51.9225, 4.47917)
+
+
+def _add_scooter(lat, lon):
+    with transaction() as conn:
+        return conn.execute(
+            """INSERT INTO Scooters (brand, model, serial_number, top_speed, battery_capacity, state_of_charge,
+                target_range_min_soc, target_range_max_soc, latitude, longitude, out_of_service, mileage,
+                last_maintenance_date) VALUES (?, ?, ?, 25.0, 500, 80, 20, 90, ?, ?, 0, 0, '2024-01-01')""",
+            safe_data.encrypt_many(['Brand', 'Model', 'SN00000001']) + [lat, lon]).lastrowid
+
+
+def _point_at(distance_km, bearing_deg):
+    """The point distance_km from CENTER in the given direction, on the sphere spatial measures on."""
+    lat1, lon1 = map(math.radians, CENTER)
+    delta = distance_km / spatial.EARTH_RADIUS_KM
+    theta = math.radians(bearing_deg)
+    lat2 = math.asin(math.sin(lat1) * math.cos(delta) + math.cos(lat1) * math.sin(delta) * math.cos(theta))
+    lon2 = lon1 + math.atan2(math.sin(theta) * math.sin(delta) * math.cos(lat1),
+                             math.cos(delta) - math.sin(lat1) * math.sin(lat2))
+    return math.degrees(lat2), math.degrees(lon2)
+
+
+@pytest.mark.parametrize('bearing', [0, 90, 180, 270, 45])
+def test_within_radius_finds_scooter_just_inside(throwaway_db, bearing):
+    scooter_id = _add_scooter(*_point_at(9.995, bearing))
+    rows = spatial.within_radius(*CENTER, 10)
+    assert [row[0] for row in rows[1:]] == [scooter_id]
+
+
+def test_within_radius_leaves_out_scooter_just_outside(throwaway_db):
+    _add_scooter(*_point_at(10.005, 0))
+    assert spatial.within_radius(*CENTER, 10)[1:] == []
+
+
+def test_nearest_finds_true_nearest_at_box_edge(throwaway_db):
+    # Due north just inside the first search radius vs a farther one east
+    north = _add_scooter(*_point_at(spatial.NEAREST_START_KM * 0.999, 0))
+    _add_scooter(*_point_at(spatial.NEAREST_START_KM * 1.5, 90))
+    assert spatial.nearest(*CENTER, k=1)[1][0] == north